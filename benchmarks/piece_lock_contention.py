@@ -0,0 +1,118 @@
+"""Measures lock contention in FileStructure with many peers.
+
+Simulated peers write blocks of their own pieces while others read blocks of already downloaded pieces. Writes
+are slowed down to emulate a busy disk. Operations are performed either with the per-piece locks of FileStructure
+or under a single lock for the whole torrent, like before. Total time and latency of reads are reported.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/piece_lock_contention.py [--peers N] [--write-delay MS]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from typing import List
+
+# happy_bittorrent.network can't be imported before happy_bittorrent.algorithms because of a circular import
+import happy_bittorrent.algorithms  # noqa: F401
+from happy_bittorrent import file_structure as file_structure_module
+from happy_bittorrent.file_structure import FileStructure
+from happy_bittorrent.models import DownloadInfo, FileInfo
+
+
+PIECE_LENGTH = 2 ** 18
+BLOCK_LENGTH = 2 ** 14
+PIECE_COUNT = 256
+BLOCKS_PER_PEER = 64
+
+
+class NullLock:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def slow_down_writes(delay: float):
+    write_at = file_structure_module.write_at
+
+    def slow_write_at(*args):
+        time.sleep(delay)  # Executed in a worker thread
+        write_at(*args)
+
+    file_structure_module.write_at = slow_write_at
+
+
+async def writing_peer(file_structure: FileStructure, lock, peer_index: int, peer_count: int):
+    data = memoryview(bytes(BLOCK_LENGTH))
+    blocks_per_piece = PIECE_LENGTH // BLOCK_LENGTH
+    # The second half of the pieces is being downloaded, every writing peer has its own pieces
+    pieces = range(PIECE_COUNT // 2 + peer_index, PIECE_COUNT, peer_count)
+    for i in range(BLOCKS_PER_PEER):
+        piece_index = pieces[i // blocks_per_piece % len(pieces)]
+        offset = piece_index * PIECE_LENGTH + i % blocks_per_piece * BLOCK_LENGTH
+        async with lock:
+            await file_structure.write(offset, data)
+
+
+async def reading_peer(file_structure: FileStructure, lock, peer_index: int, latencies: List[float]):
+    for i in range(BLOCKS_PER_PEER):
+        piece_index = (peer_index + i) % (PIECE_COUNT // 2)
+        start_time = time.perf_counter()
+        async with lock:
+            await file_structure.read(piece_index * PIECE_LENGTH + i % 4 * BLOCK_LENGTH, BLOCK_LENGTH)
+        latencies.append(time.perf_counter() - start_time)
+
+
+async def run(download_dir: str, download_info: DownloadInfo, peer_count: int, global_lock: bool):
+    file_structure = FileStructure(download_dir, download_info)
+    lock = asyncio.Lock() if global_lock else NullLock()
+    writer_count = peer_count // 2
+    latencies = []  # type: List[float]
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*([writing_peer(file_structure, lock, i, writer_count) for i in range(writer_count)] +
+                           [reading_peer(file_structure, lock, i, latencies)
+                            for i in range(peer_count - writer_count)]))
+    elapsed = time.perf_counter() - start_time
+    file_structure.close()
+
+    latencies.sort()
+    print('{:11}: total {:5.2f} s, read latency p50 {:6.1f} ms, p99 {:6.1f} ms'.format(
+        'global lock' if global_lock else 'piece locks', elapsed,
+        latencies[len(latencies) // 2] * 1000, latencies[len(latencies) * 99 // 100] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--peers', type=int, default=50, help='Count of peers (half of them write, half read)')
+    parser.add_argument('--write-delay', type=float, default=5, help='Extra latency of every write in ms')
+    parser.add_argument('--dir', help='Directory for temporary files')
+    args = parser.parse_args()
+
+    download_info = DownloadInfo(os.urandom(20), PIECE_LENGTH, bytes(20 * PIECE_COUNT), 'torrent',
+                                 [FileInfo(PIECE_LENGTH * PIECE_COUNT, [])])
+    download_info.reset_run_state()
+
+    download_dir = tempfile.mkdtemp(dir=args.dir)
+    loop = asyncio.get_event_loop()
+    try:
+        file_structure = FileStructure(download_dir, download_info)
+        loop.run_until_complete(file_structure.write(0, memoryview(os.urandom(PIECE_LENGTH * PIECE_COUNT // 2))))
+        file_structure.close()
+
+        slow_down_writes(args.write_delay / 1000)
+        for global_lock in (True, False):
+            loop.run_until_complete(run(download_dir, download_info, args.peers, global_lock))
+    finally:
+        shutil.rmtree(download_dir)
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Compares PiecePicker with the previous piece selection at 100k pieces and 200 peers.
+
+The previous selection filtered the list of non-started pieces by owners, sorted it by availability and removed
+the selected piece from the list. PiecePicker keeps pieces in buckets by availability and updates them when
+peers report new pieces.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/piece_picker.py [--pieces N] [--peers N]
+"""
+
+import argparse
+import os
+import random
+import time
+
+from bitarray import bitarray
+
+from happy_bittorrent.algorithms.piece_picker import PiecePicker
+from happy_bittorrent.models import DownloadInfo, FileInfo, Peer
+
+
+PIECE_LENGTH = 2 ** 18
+PEERS_PER_PICK = 15
+
+
+def previous_select(non_started_pieces, owners, peers) -> int:
+    available = [index for index in non_started_pieces if peers & owners[index]]
+    available.sort(key=lambda index: len(owners[index]))
+    index = available[random.randint(0, min(len(available), 10) - 1)]
+    non_started_pieces.remove(index)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pieces', type=int, default=100000)
+    parser.add_argument('--peers', type=int, default=200)
+    args = parser.parse_args()
+    piece_count = args.pieces
+
+    download_info = DownloadInfo(os.urandom(20), PIECE_LENGTH, bytes(20 * piece_count), 'torrent',
+                                 [FileInfo(piece_count * PIECE_LENGTH, [])])
+    download_info.reset_run_state()
+    availability = download_info.availability
+
+    peers = [Peer('10.0.{}.{}'.format(i // 256, i % 256), 6881) for i in range(args.peers)]
+    owners = [set() for _ in range(piece_count)]
+    for peer in peers:
+        bitfield = bitarray(piece_count, endian='big')
+        bitfield.setall(False)
+        for index in random.sample(range(piece_count), piece_count // 2):
+            bitfield[index] = True
+            owners[index].add(peer)
+        availability.add_peer(peer)
+        availability.add_pieces(peer, bitfield)
+
+    non_started_pieces = list(range(piece_count))
+    random.shuffle(non_started_pieces)
+    iterations = 20
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        previous_select(non_started_pieces, owners, set(random.sample(peers, PEERS_PER_PICK)))
+    previous_time = (time.perf_counter() - start_time) / iterations
+
+    start_time = time.perf_counter()
+    picker = PiecePicker(download_info)
+    build_time = time.perf_counter() - start_time
+
+    iterations = 1000
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        picker.pick(random.sample(peers, PEERS_PER_PICK))
+    pick_time = (time.perf_counter() - start_time) / iterations
+
+    start_time = time.perf_counter()
+    for i in range(iterations):
+        availability.add_piece(peers[i % len(peers)], random.randrange(piece_count))
+    have_time = (time.perf_counter() - start_time) / iterations
+
+    print('{} pieces, {} peers'.format(piece_count, len(peers)))
+    print('previous selection: {:8.3f} ms per piece'.format(previous_time * 1000))
+    print('PiecePicker.pick(): {:8.3f} ms per piece ({:.0f}x faster)'.format(pick_time * 1000,
+                                                                           previous_time / pick_time))
+    print('PiecePicker construction {:.0f} ms, `have` handling {:.1f} us'.format(build_time * 1000,
+                                                                                 have_time * 10 ** 6))
+
+
+if __name__ == '__main__':
+    main()
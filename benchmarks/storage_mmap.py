@@ -0,0 +1,95 @@
+"""Compares FileStructure with regular file I/O and with memory-mapped files.
+
+A torrent is downloaded block by block (write_block, hash_piece, commit_piece) and then uploaded, i.e. every block
+is read with read_block as PeerTCPClient does it. For each phase, wall time and CPU time of the event loop thread
+are reported.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/storage_mmap.py [--size MiB] [--dir DIR]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+# happy_bittorrent.network can't be imported before happy_bittorrent.algorithms because of a circular import
+import happy_bittorrent.algorithms  # noqa: F401
+from happy_bittorrent.file_structure import FileStructure
+from happy_bittorrent.models import DownloadInfo, FileInfo
+
+
+PIECE_LENGTH = 2 ** 20
+BLOCK_LENGTH = 2 ** 14
+FILE_COUNT = 4
+
+
+def make_download_info(total_size: int) -> DownloadInfo:
+    file_size = total_size // FILE_COUNT
+    files = [FileInfo(file_size, ['file{}'.format(i)]) for i in range(FILE_COUNT)]
+    piece_count = (file_size * FILE_COUNT + PIECE_LENGTH - 1) // PIECE_LENGTH
+    info = DownloadInfo(os.urandom(20), PIECE_LENGTH, bytes(20 * piece_count), 'torrent', files)
+    info.reset_run_state()
+    return info
+
+
+class Timer:
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.thread_time() - self._cpu
+
+
+async def run(download_dir: str, download_info: DownloadInfo, use_mmap: bool):
+    file_structure = FileStructure(download_dir, download_info, use_mmap=use_mmap)
+    piece_data = memoryview(os.urandom(PIECE_LENGTH))
+    total_size = download_info.total_size
+
+    with Timer() as download_timer:
+        for index in range(download_info.piece_count):
+            length = download_info.get_real_piece_length(index)
+            for begin in range(0, length, BLOCK_LENGTH):
+                await file_structure.write_block(index, begin, piece_data[begin:min(begin + BLOCK_LENGTH, length)])
+            await file_structure.hash_piece(index)
+            await file_structure.commit_piece(index)
+
+    with Timer() as upload_timer:
+        for index in range(download_info.piece_count):
+            length = download_info.get_real_piece_length(index)
+            for begin in range(0, length, BLOCK_LENGTH):
+                block = await file_structure.read_block(index, begin, min(BLOCK_LENGTH, length - begin))
+                bytes(block)  # The transport copies the block into its buffer
+    file_structure.close()
+
+    mode = 'mmap' if use_mmap else 'files'
+    for phase, timer in (('download', download_timer), ('upload', upload_timer)):
+        print('{:5} {:8}: {:6.0f} MiB/s, event loop CPU {:.2f} s'.format(
+            mode, phase, total_size / timer.wall / 2 ** 20, timer.cpu))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=512, help='Torrent size in MiB')
+    parser.add_argument('--dir', help='Directory for temporary files (on the disk being tested)')
+    args = parser.parse_args()
+
+    download_info = make_download_info(args.size * 2 ** 20)
+    loop = asyncio.get_event_loop()
+    for use_mmap in (False, True, False, True):
+        download_dir = tempfile.mkdtemp(dir=args.dir)
+        try:
+            loop.run_until_complete(run(download_dir, download_info, use_mmap))
+        finally:
+            shutil.rmtree(download_dir)
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
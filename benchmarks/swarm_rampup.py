@@ -0,0 +1,132 @@
+"""Measures how fast a swarm on loopback becomes fully connected with and without peer exchange (ut_pex).
+
+Several torrent managers share a torrent, one of them is a seed. The fake tracker returns only the seed, so other
+peers can be learned only via peer exchange. The average count of connected peers is printed every second.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/swarm_rampup.py [--nodes N] [--duration SECONDS] [--no-pex]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from typing import List
+
+from bitarray import bitarray
+
+from happy_bittorrent.algorithms import announcer
+from happy_bittorrent.algorithms.torrent_manager import TorrentManager
+from happy_bittorrent.file_structure import FileStructure
+from happy_bittorrent.models import DownloadInfo, FileInfo, Peer, TorrentInfo
+from happy_bittorrent.network import PeerTCPClient, PeerTCPServer
+
+
+PIECE_LENGTH = 2 ** 18
+TORRENT_SIZE = 64 * 2 ** 20
+
+
+class FakeTrackerClient:
+    def __init__(self, server_ports: List[int]):
+        self._server_ports = server_ports
+        self.interval = self.min_interval = 30 * 60
+        self.peers = []  # type: List[Peer]
+
+    async def announce(self, server_port: int, event):
+        self.peers = [Peer('127.0.0.1', port) for port in self._server_ports[:1] if port != server_port]
+
+
+async def run(node_count: int, duration: int):
+    data = os.urandom(TORRENT_SIZE)
+    piece_hashes = b''.join(hashlib.sha1(data[begin:begin + PIECE_LENGTH]).digest()
+                            for begin in range(0, TORRENT_SIZE, PIECE_LENGTH))
+    download_info = DownloadInfo(os.urandom(20), PIECE_LENGTH, piece_hashes, 'torrent', [FileInfo(TORRENT_SIZE, [])])
+
+    server_ports = []  # type: List[int]
+    announcer.create_tracker_client = lambda *args: FakeTrackerClient(server_ports)
+
+    download_dirs, servers, managers, tasks = [], [], [], []
+    try:
+        for node_index in range(node_count):
+            download_dir = tempfile.mkdtemp()
+            download_dirs.append(download_dir)
+            node_info = pickle.loads(pickle.dumps(download_info))
+            if node_index == 0:
+                file_structure = FileStructure(download_dir, node_info)
+                await file_structure.write(0, memoryview(data))
+                file_structure.close()
+                downloaded = bitarray(node_info.piece_count, endian='big')
+                downloaded.setall(True)
+                node_info.set_downloaded_pieces(downloaded)
+
+            peer_id = os.urandom(20)
+            torrent_managers = {}
+            server = PeerTCPServer(peer_id, torrent_managers)
+            await server.start()
+            servers.append(server)
+            server_ports.append(server.port)
+
+            torrent_info = TorrentInfo(node_info, [['http://tracker.invalid/announce']], download_dir=download_dir)
+            manager = TorrentManager(torrent_info, peer_id, server.port)
+            torrent_managers[node_info.info_hash] = manager
+            managers.append(manager)
+
+        start_time = time.perf_counter()
+        tasks = [asyncio.ensure_future(manager.run()) for manager in managers]
+        full_mesh_time = None
+        for second in range(1, duration + 1):
+            await asyncio.sleep(1)
+            # Simultaneous connections between two nodes may exist for a moment, so peer IDs are counted
+            peer_counts = [len({data.client._peer.peer_id for data in manager._peer_manager.peer_data.values()})
+                           for manager in managers]
+            complete_count = sum(manager._torrent_info.download_info.complete for manager in managers)
+            print('{:3} s: avg peers {:4.1f}, min peers {:2}, complete {}/{}'.format(
+                second, sum(peer_counts) / node_count, min(peer_counts), complete_count, node_count))
+            if full_mesh_time is None and min(peer_counts) == node_count - 1:
+                full_mesh_time = time.perf_counter() - start_time
+
+        print('Full mesh after', 'more than {} s'.format(duration) if full_mesh_time is None else
+              '{:.1f} s'.format(full_mesh_time))
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        for manager in managers:
+            await manager.stop()
+        for server in servers:
+            await server.stop()
+        await asyncio.sleep(0.1)  # Let cancelled tasks finish
+        for download_dir in download_dirs:
+            shutil.rmtree(download_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--nodes', type=int, default=12)
+    parser.add_argument('--duration', type=int, default=20, help='Duration of the test in seconds')
+    parser.add_argument('--no-pex', action='store_true', help="Don't announce support of the extension protocol")
+    parser.add_argument('--ports', default='21000-21199', help='Range of ports for the nodes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.INFO)
+    first_port, last_port = map(int, args.ports.split('-'))
+    PeerTCPServer.PORT_RANGE = range(first_port, last_port + 1)
+    if args.no_pex:
+        PeerTCPClient.RESERVED_BYTES = bytes(PeerTCPClient.FAST_EXTENSION_BYTE) + \
+            bytes([PeerTCPClient.FAST_EXTENSION_FLAG])
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args.nodes, args.duration))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Measures the piece read cache on the upload path.
+
+Several peers request all blocks of pieces in sequence, their requests are interleaved. Blocks are served either
+with a separate read for every block (the path without the cache) or with FileStructure.read_block, which reads
+the whole piece on the first request. The count of read calls, throughput and cache statistics are reported.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/upload_read_cache.py [--size MiB] [--peers N] [--dir DIR]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+# happy_bittorrent.network can't be imported before happy_bittorrent.algorithms because of a circular import
+import happy_bittorrent.algorithms  # noqa: F401
+from happy_bittorrent import file_structure as file_structure_module
+from happy_bittorrent.file_structure import FileStructure
+from happy_bittorrent.models import DownloadInfo, FileInfo
+
+
+PIECE_LENGTH = 2 ** 20
+BLOCK_LENGTH = 2 ** 14
+
+
+class ReadCounter:
+    """Wraps read_at() used by FileStructure to count read calls."""
+
+    def __init__(self):
+        self.count = 0
+        self._read_at = file_structure_module.read_at
+        file_structure_module.read_at = self._counting_read_at
+
+    def _counting_read_at(self, *args):
+        self.count += 1
+        return self._read_at(*args)
+
+
+async def prepare(download_dir: str, download_info: DownloadInfo):
+    file_structure = FileStructure(download_dir, download_info)
+    data = memoryview(os.urandom(PIECE_LENGTH))
+    for index in range(download_info.piece_count):
+        await file_structure.write(index * PIECE_LENGTH, data[:download_info.get_real_piece_length(index)])
+    file_structure.close()
+
+
+async def serve_peer(file_structure: FileStructure, download_info: DownloadInfo, pieces, cached: bool):
+    for index in pieces:
+        length = download_info.get_real_piece_length(index)
+        for begin in range(0, length, BLOCK_LENGTH):
+            block_length = min(BLOCK_LENGTH, length - begin)
+            if cached:
+                await file_structure.read_block(index, begin, block_length)
+            else:
+                await file_structure.read(index * PIECE_LENGTH + begin, block_length)
+
+
+async def run(download_dir: str, download_info: DownloadInfo, peer_count: int, cached: bool, counter: ReadCounter):
+    file_structure = FileStructure(download_dir, download_info)
+    pieces = list(range(download_info.piece_count))
+    random.shuffle(pieces)
+    statistics = download_info.session_statistics
+    statistics.read_cache_hits = statistics.read_cache_misses = statistics.read_cache_evictions = 0
+
+    counter.count = 0
+    start_time = time.perf_counter()
+    await asyncio.gather(*[serve_peer(file_structure, download_info, pieces[i::peer_count], cached)
+                           for i in range(peer_count)])
+    elapsed = time.perf_counter() - start_time
+    file_structure.close()
+
+    print('{:9}: {:6} reads, {:6.0f} MiB/s, cache hits {}, misses {}, evictions {}'.format(
+        'cache' if cached else 'no cache', counter.count, download_info.total_size / elapsed / 2 ** 20,
+        statistics.read_cache_hits, statistics.read_cache_misses, statistics.read_cache_evictions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=256, help='Torrent size in MiB')
+    parser.add_argument('--peers', type=int, default=20, help='Count of peers downloading concurrently')
+    parser.add_argument('--dir', help='Directory for temporary files (on the disk being tested)')
+    args = parser.parse_args()
+
+    total_size = args.size * 2 ** 20
+    piece_count = (total_size + PIECE_LENGTH - 1) // PIECE_LENGTH
+    download_info = DownloadInfo(os.urandom(20), PIECE_LENGTH, bytes(20 * piece_count), 'torrent',
+                                 [FileInfo(total_size, [])])
+    download_info.reset_run_state()
+
+    download_dir = tempfile.mkdtemp(dir=args.dir)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(prepare(download_dir, download_info))
+        counter = ReadCounter()
+        for cached in (False, True, False, True):
+            loop.run_until_complete(run(download_dir, download_info, args.peers, cached, counter))
+    finally:
+        shutil.rmtree(download_dir)
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
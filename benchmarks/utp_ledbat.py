@@ -0,0 +1,141 @@
+"""Measures uTP throughput and queueing delay over a simulated bottleneck link on loopback.
+
+Datagrams sent by the uploading side pass through a link with a limited rate, a one-way delay and a drop-tail
+queue, so no netem is required. With LEDBAT the sender keeps the queueing delay near the target delay. With
+--loss-based the target is never reached, so only losses limit the window, like with TCP.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/utp_ledbat.py [--rate MB/s] [--delay MS] [--queue KiB] [--loss-based]
+"""
+
+import argparse
+import asyncio
+import os
+
+# happy_bittorrent.network can't be imported before happy_bittorrent.algorithms because of a circular import
+import happy_bittorrent.algorithms  # noqa: F401
+from happy_bittorrent.network.utp import UTPConnection, UTPSocket
+
+
+class SimulatedLink:
+    def __init__(self, rate: float, delay: float, queue_size: int):
+        self._loop = asyncio.get_event_loop()
+        self._rate = rate
+        self._delay = delay
+        self._queue_size = queue_size
+        self._busy_until = 0.0
+        self.queueing_delays = []  # Pairs of a time and the queueing delay of a datagram
+        self.drop_count = 0
+
+    def send(self, utp_socket: UTPSocket, data: bytes, address):
+        now = self._loop.time()
+        queueing_delay = max(self._busy_until - now, 0.0)
+        if queueing_delay * self._rate + len(data) > self._queue_size:
+            self.drop_count += 1
+            return
+        self.queueing_delays.append((now, queueing_delay))
+        self._busy_until = max(self._busy_until, now) + len(data) / self._rate
+        self._loop.call_at(self._busy_until + self._delay, UTPSocket.send_datagram, utp_socket, data, address)
+
+
+class ReceivingProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.received = 0
+
+    def data_received(self, data: bytes):
+        self.received += len(data)
+
+    def eof_received(self):
+        return False
+
+
+class SendingProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+
+class SimulatedSocket(UTPSocket):
+    def __init__(self, link: SimulatedLink):
+        super().__init__()
+        self._link = link
+
+    def send_datagram(self, data: bytes, address):
+        self._link.send(self, data, address)
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    link = SimulatedLink(args.rate * 10 ** 6, args.delay / 1000, args.queue * 2 ** 10)
+    receivers = []
+
+    def create_receiver():
+        protocol = ReceivingProtocol()
+        receivers.append(protocol)
+        return protocol
+
+    server = await UTPSocket.create(0, create_receiver)
+    client = SimulatedSocket(link)
+    await loop.create_datagram_endpoint(lambda: client, local_addr=('127.0.0.1', 0))
+    transport, protocol = await client.create_connection(SendingProtocol, '127.0.0.1',
+                                                         server.get_extra_info('sockname')[1])
+
+    async def write_continuously():
+        data = os.urandom(2 ** 16)
+        while True:
+            await protocol.can_write.wait()
+            transport.write(data)
+            await asyncio.sleep(0)
+
+    writer = asyncio.ensure_future(write_continuously())
+    start_time = loop.time()
+    await asyncio.sleep(args.warmup)
+    measure_start_time = loop.time()
+    received_before = receivers[0].received
+    await asyncio.sleep(args.duration)
+    throughput = (receivers[0].received - received_before) / (loop.time() - measure_start_time)
+
+    writer.cancel()
+    transport.abort()
+    server.close()
+    client.close()
+
+    delays = sorted(delay for sent_time, delay in link.queueing_delays if sent_time >= start_time + args.warmup)
+
+    def percentile(fraction: float) -> float:
+        return delays[min(int(len(delays) * fraction), len(delays) - 1)] * 1000
+
+    print('{}: link {:.1f} MB/s, {:.0f} ms one-way delay, {:.0f} ms queue'.format(
+        'loss-based' if args.loss_based else 'LEDBAT', args.rate, args.delay,
+        args.queue * 2 ** 10 / (args.rate * 10 ** 6) * 1000))
+    print('throughput {:.2f} MB/s ({:.0f}% of the link), queueing delay p50 {:.0f} ms, p90 {:.0f} ms, '
+          'max {:.0f} ms, {} drops'.format(throughput / 10 ** 6, throughput / (args.rate * 10 ** 6) * 100,
+                                          percentile(0.5), percentile(0.9), percentile(0.999), link.drop_count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=float, default=4, help='Link rate in MB/s')
+    parser.add_argument('--delay', type=float, default=20, help='One-way delay in ms')
+    parser.add_argument('--queue', type=int, default=1024, help='Size of the link queue in KiB')
+    parser.add_argument('--warmup', type=float, default=5, help='Seconds before the measurement starts')
+    parser.add_argument('--duration', type=float, default=15, help='Duration of the measurement in seconds')
+    parser.add_argument('--loss-based', action='store_true', help='Disable the delay-based congestion control')
+    args = parser.parse_args()
+
+    if args.loss_based:
+        UTPConnection.TARGET_DELAY = 10 ** 9
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
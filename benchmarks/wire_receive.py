@@ -0,0 +1,116 @@
+"""Compares receiving of peer wire messages with StreamReader and with PeerWireProtocol over loopback.
+
+A separate process sends a handshake followed by `piece` messages with 16 KiB blocks interleaved with `have`
+messages. The StreamReader receiver works like the previous PeerTCPClient._receive_message(): two readexactly()
+calls wrapped in wait_for() per message and a copy of the payload. Throughput and CPU time of the receiving
+process are reported.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/wire_receive.py [--messages N]
+"""
+
+import argparse
+import asyncio
+import struct
+import sys
+import time
+
+# happy_bittorrent.network can't be imported before happy_bittorrent.algorithms because of a circular import
+import happy_bittorrent.algorithms  # noqa: F401
+from happy_bittorrent.network.peer_wire_protocol import PeerWireProtocol
+
+
+BLOCK_LENGTH = 2 ** 14
+HANDSHAKE_LENGTH = 68
+BATCH_SIZE = 64
+
+SENDER_CODE = r'''
+import socket, struct, sys
+port, batch_count, block_length, handshake_length = map(int, sys.argv[1:])
+piece_message = struct.pack('!IBII', 9 + block_length, 7, 0, 0) + bytes(block_length)
+have_message = struct.pack('!IBI', 5, 4, 1)
+batch = (piece_message + have_message) * {batch_size}
+sock = socket.create_connection(('127.0.0.1', port))
+sock.sendall(bytes(handshake_length))
+for _ in range(batch_count):
+    sock.sendall(batch)
+sock.close()
+'''.format(batch_size=BATCH_SIZE)
+
+
+async def start_stream_receiver(done: asyncio.Future) -> asyncio.AbstractServer:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await reader.readexactly(HANDSHAKE_LENGTH)
+        count = size = 0
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.readexactly(4), 3 * 60)
+                (length,) = struct.unpack('!I', data)
+                data = await asyncio.wait_for(reader.readexactly(length), 5)
+                payload = memoryview(data)[1:]
+                count += 1
+                size += len(payload)
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+        done.set_result((count, size))
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+async def start_protocol_receiver(done: asyncio.Future) -> asyncio.AbstractServer:
+    async def handle(protocol: PeerWireProtocol):
+        await protocol.receive_exactly(HANDSHAKE_LENGTH)
+        protocol.start_framing()
+        count = size = 0
+        try:
+            while True:
+                _, payload = await protocol.receive_message()
+                count += 1
+                size += len(payload)
+        except ConnectionError:
+            pass
+        protocol.close()
+        done.set_result((count, size))
+
+    loop = asyncio.get_event_loop()
+    return await loop.create_server(lambda: PeerWireProtocol(lambda protocol: asyncio.ensure_future(handle(protocol))),
+                                    '127.0.0.1', 0)
+
+
+async def run(name: str, start_receiver, batch_count: int):
+    done = asyncio.get_event_loop().create_future()
+    server = await start_receiver(done)
+    port = server.sockets[0].getsockname()[1]
+
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    process = await asyncio.create_subprocess_exec(sys.executable, '-c', SENDER_CODE, str(port), str(batch_count),
+                                                   str(BLOCK_LENGTH), str(HANDSHAKE_LENGTH))
+    count, size = await done
+    elapsed = time.perf_counter() - start_time
+    cpu_time = time.process_time() - start_cpu_time
+    await process.wait()
+    server.close()
+    await server.wait_closed()
+
+    print('{:16}: {} messages, {:6.0f} MiB/s, receiver CPU {:.2f} s ({:.2f} us per message)'.format(
+        name, count, size / elapsed / 2 ** 20, cpu_time, cpu_time / count * 10 ** 6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=80000, help='Count of messages to receive')
+    args = parser.parse_args()
+    batch_count = max(args.messages // (2 * BATCH_SIZE), 1)
+
+    loop = asyncio.get_event_loop()
+    for _ in range(2):
+        loop.run_until_complete(run('StreamReader', start_stream_receiver, batch_count))
+        loop.run_until_complete(run('PeerWireProtocol', start_protocol_receiver, batch_count))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
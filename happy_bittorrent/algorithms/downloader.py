@@ -1,17 +1,19 @@
 import asyncio
-import hashlib
 import logging
-import random
 import time
 from collections import deque, OrderedDict
 from math import ceil
-from typing import List, Optional, Tuple, Iterator
+from typing import List, Optional, Iterator
+
+from bitarray import bitarray
 
 from happy_bittorrent.algorithms.announcer import Announcer
 from happy_bittorrent.algorithms.peer_manager import PeerData, PeerManager
+from happy_bittorrent.algorithms.piece_picker import PiecePicker
 from happy_bittorrent.file_structure import FileStructure
-from happy_bittorrent.models import BlockRequestFuture, Peer, TorrentInfo, TorrentState
+from happy_bittorrent.models import PendingBlockRequest, Peer, TorrentInfo
 from happy_bittorrent.network import EventType
+from happy_bittorrent.resume_journal import ResumeJournal
 from happy_bittorrent.utils import floor_to, import_signals
 
 
@@ -32,7 +34,7 @@ class Downloader(QObject):
 
     def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes,
                  logger: logging.Logger, file_structure: FileStructure,
-                 peer_manager: PeerManager, announcer: Announcer):
+                 peer_manager: PeerManager, announcer: Announcer, resume_journal: Optional[ResumeJournal]=None):
         super().__init__()
 
         self._torrent_info = torrent_info
@@ -43,12 +45,13 @@ class Downloader(QObject):
         self._file_structure = file_structure
         self._peer_manager = peer_manager
         self._announcer = announcer
+        self._resume_journal = resume_journal
 
         self._request_executors = []  # type: List[asyncio.Task]
 
-        self._executors_processed_requests = []  # type: List[List[BlockRequestFuture]]
+        self._executors_processed_requests = []  # type: List[List[PendingBlockRequest]]
 
-        self._non_started_pieces = None   # type: List[int]
+        self._piece_picker = None         # type: Optional[PiecePicker]
         self._download_start_time = None  # type: float
 
         self._piece_block_queue = OrderedDict()
@@ -61,24 +64,15 @@ class Downloader(QObject):
 
     REQUEST_LENGTH = 2 ** 14
 
-    def _get_piece_position(self, index: int) -> Tuple[int, int]:
-        piece_offset = index * self._download_info.piece_length
-        cur_piece_length = self._download_info.get_real_piece_length(index)
-        return piece_offset, cur_piece_length
-
-    async def _flush_piece(self, index: int):
-        piece_offset, cur_piece_length = self._get_piece_position(index)
-        await self._file_structure.flush(piece_offset, cur_piece_length)
-
     FLAG_TRANSMISSION_TIMEOUT = 0.5
 
-    def _send_cancels(self, request: BlockRequestFuture):
-        performers = request.prev_performers
+    def _send_cancels(self, request: PendingBlockRequest):
+        performers = set(request.prev_performers) if request.prev_performers is not None else set()
         if request.performer is not None:
             performers.add(request.performer)
-        source = request.result()
+        performers.discard(request.source)
         peer_data = self._peer_manager.peer_data
-        for peer in performers - {source}:
+        for peer in performers:
             if peer in peer_data:
                 peer_data[peer].client.send_request(request, cancel=True)
 
@@ -90,21 +84,22 @@ class Downloader(QObject):
         for block_begin in range(0, piece_info.length, Downloader.REQUEST_LENGTH):
             block_end = min(block_begin + Downloader.REQUEST_LENGTH, piece_info.length)
             block_length = block_end - block_begin
-            request = BlockRequestFuture(piece_index, block_begin, block_length)
-            request.add_done_callback(self._send_cancels)
+            request = PendingBlockRequest(piece_index, block_begin, block_length)
 
-            blocks_expected.add(request)
+            blocks_expected[block_begin] = request
             request_deque.append(request)
         self._piece_block_queue[piece_index] = request_deque
 
-        self._download_info.interesting_pieces.add(piece_index)
+        self._download_info.interesting_pieces[piece_index] = True
+        availability = self._download_info.availability
         peer_data = self._peer_manager.peer_data
-        for peer in piece_info.owners:
-            peer_data[peer].client.am_interested = True
+        for peer, data in peer_data.items():
+            if availability.has_piece(peer, piece_index):
+                data.client.am_interested = True
 
         concurrent_peers_count = sum(1 for peer, data in peer_data.items() if data.queue_size)
         self._logger.debug('piece %s started (owned by %s alive peers, concurrency: %s peers)',
-                           piece_index, len(piece_info.owners), concurrent_peers_count)
+                           piece_index, availability.get_count(piece_index), concurrent_peers_count)
 
     PIECE_FINISH_SIGNAL_MIN_INTERVAL = 1
 
@@ -112,28 +107,29 @@ class Downloader(QObject):
         piece_info = self._download_info.pieces[piece_index]
 
         piece_info.mark_as_downloaded()
-        self._download_info.downloaded_piece_count += 1
+        self._piece_picker.finish(piece_index)
+        if self._resume_journal is not None:
+            self._resume_journal.append(piece_index)
 
-        self._download_info.interesting_pieces.remove(piece_index)
+        self._download_info.interesting_pieces[piece_index] = False
+        needed_pieces = self._download_info.pieces.needed_bitmap
+        availability = self._download_info.availability
         peer_data = self._peer_manager.peer_data
-        for peer in piece_info.owners:
-            client = peer_data[peer].client
-            for index in self._download_info.interesting_pieces:
-                if client.piece_owned[index]:
-                    break
-            else:
-                client.am_interested = False
+        for peer, data in peer_data.items():
+            if availability.has_piece(peer, piece_index) and not availability.has_any(peer, needed_pieces):
+                data.client.am_interested = False
 
         for data in peer_data.values():
             data.client.send_have(piece_index)
 
         self._logger.debug('piece %s finished', piece_index)
 
-        torrent_state = TorrentState(self._torrent_info)
-        self._logger.info('progress %.1lf%% (%s / %s pieces)', floor_to(torrent_state.progress * 100, 1),
-                          self._download_info.downloaded_piece_count, torrent_state.selected_piece_count)
+        download_info = self._download_info
+        progress = download_info.downloaded_size / download_info.selected_size
+        self._logger.info('progress %.1lf%% (%s / %s pieces)', floor_to(progress * 100, 1),
+                          download_info.downloaded_piece_count, download_info.selected_piece_count)
 
-        if pyqtSignal and self._download_info.downloaded_piece_count < torrent_state.selected_piece_count:
+        if pyqtSignal and download_info.downloaded_piece_count < download_info.selected_piece_count:
             cur_time = time.time()
             if self._last_piece_finish_signal_time is None or \
                     cur_time - self._last_piece_finish_signal_time >= Downloader.PIECE_FINISH_SIGNAL_MIN_INTERVAL:
@@ -146,13 +142,12 @@ class Downloader(QObject):
 
         assert piece_info.are_all_blocks_downloaded()
 
-        piece_offset, cur_piece_length = self._get_piece_position(piece_index)
-        data = await self._file_structure.read(piece_offset, cur_piece_length)
-        actual_digest = hashlib.sha1(data).digest()
+        actual_digest = await self._file_structure.hash_piece(piece_index)
         if actual_digest == piece_info.piece_hash:
-            await self._flush_piece(piece_index)
+            await self._file_structure.commit_piece(piece_index)
             self._finish_downloading_piece(piece_index)
             return
+        self._file_structure.discard_piece(piece_index)
 
         peer_data = self._peer_manager.peer_data
         for peer in piece_info.sources:
@@ -171,20 +166,21 @@ class Downloader(QObject):
     HANG_PENALTY_DURATION = 10
     HANG_PENALTY_COEFF = 100
 
-    def get_peer_download_rate(self, peer: Peer) -> int:
+    def get_peer_download_rate(self, peer: Peer) -> float:
         data = self._peer_manager.peer_data[peer]
 
-        rate = data.client.downloaded  # To reach maximal download speed
+        # To reach maximal download speed
+        rate = self._download_info.session_statistics.get_peer_download_rate(peer)
         if data.hanged_time is not None and time.time() - data.hanged_time <= Downloader.HANG_PENALTY_DURATION:
-            rate //= Downloader.HANG_PENALTY_COEFF
+            rate /= Downloader.HANG_PENALTY_COEFF
         return rate
 
     DOWNLOAD_PEER_COUNT = 15
 
-    def _request_piece_blocks(self, max_pending_count: int, piece_index: int) -> Iterator[BlockRequestFuture]:
+    def _request_piece_blocks(self, max_pending_count: int, piece_index: int) -> Iterator[PendingBlockRequest]:
         if not max_pending_count:
             return
-        piece_info = self._download_info.pieces[piece_index]
+        availability = self._download_info.availability
         peer_data = self._peer_manager.peer_data
 
         request_deque = self._piece_block_queue[piece_index]
@@ -200,8 +196,8 @@ class Downloader(QObject):
                 continue
 
             if performer is None or not performer_data.is_free():
-                available_peers = {peer for peer in piece_info.owners
-                                   if peer_data[peer].is_available()}
+                available_peers = {peer for peer, data in peer_data.items()
+                                   if data.can_request(piece_index) and availability.has_piece(peer, piece_index)}
                 if not available_peers:
                     return
                 performer = max(available_peers, key=self.get_peer_download_rate)
@@ -217,30 +213,38 @@ class Downloader(QObject):
             if pending_count == max_pending_count:
                 return
 
-    RAREST_PIECE_COUNT_TO_SELECT = 10
-
     def _select_new_piece(self, *, force: bool) -> Optional[int]:
         is_appropriate = PeerData.is_free if force else PeerData.is_available
-        appropriate_peers = {peer for peer, data in self._peer_manager.peer_data.items() if is_appropriate(data)}
-        if not appropriate_peers:
+        availability = self._download_info.availability
+        appropriate_peers = []
+        allowed_fast = None    # Pieces we can request from free peers choking us (BEP 6)
+        suggested = None
+        for peer, data in self._peer_manager.peer_data.items():
+            client = data.client
+            if is_appropriate(data):
+                appropriate_peers.append(peer)
+                if client.suggested_pieces is not None:
+                    if suggested is None:
+                        suggested = client.suggested_pieces.copy()
+                    else:
+                        suggested |= client.suggested_pieces
+            elif client.allowed_fast_pieces is not None and data.is_free():
+                peer_allowed_fast = client.allowed_fast_pieces & availability.get_bitfield(peer)
+                if allowed_fast is None:
+                    allowed_fast = peer_allowed_fast
+                else:
+                    allowed_fast |= peer_allowed_fast
+        if not appropriate_peers and allowed_fast is None:
             return None
 
-        pieces = self._download_info.pieces
-        available_pieces = [index for index in self._non_started_pieces
-                            if appropriate_peers & pieces[index].owners]
-        if not available_pieces:
-            return None
-
-        available_pieces.sort(key=lambda index: len(pieces[index].owners))
-        piece_count_to_select = min(len(available_pieces), Downloader.RAREST_PIECE_COUNT_TO_SELECT)
-        return available_pieces[random.randint(0, piece_count_to_select - 1)]
+        return self._piece_picker.pick(appropriate_peers, extra_candidates=allowed_fast, preferred=suggested)
 
     _typical_piece_length = 2 ** 20
     _requests_per_piece = ceil(_typical_piece_length / REQUEST_LENGTH)
     _desired_request_stock = DOWNLOAD_PEER_COUNT * PeerData.DOWNLOAD_REQUEST_QUEUE_SIZE
     DESIRED_PIECE_STOCK = ceil(_desired_request_stock / _requests_per_piece)
 
-    def _request_blocks(self, max_pending_count: int) -> List[BlockRequestFuture]:
+    def _request_blocks(self, max_pending_count: int) -> List[PendingBlockRequest]:
         result = []
         pending_count = 0
         consumed_pieces = []
@@ -258,7 +262,6 @@ class Downloader(QObject):
             piece_stock_small = (piece_stock < Downloader.DESIRED_PIECE_STOCK)
             new_piece_index = self._select_new_piece(force=piece_stock_small)
             if new_piece_index is not None:
-                self._non_started_pieces.remove(new_piece_index)
                 self._start_downloading_piece(new_piece_index)
 
                 result += list(self._request_piece_blocks(max_pending_count - pending_count, new_piece_index))
@@ -269,7 +272,7 @@ class Downloader(QObject):
                 del self._piece_block_queue[piece_index]
 
         if not result:
-            if not self._piece_block_queue and not self._non_started_pieces:
+            if not self._piece_block_queue and not self._piece_picker.pending_count:
                 raise NoRequestsError('No more undistributed requests')
             raise NotEnoughPeersError('No peers to perform a request')
         return result
@@ -304,9 +307,7 @@ class Downloader(QObject):
         self._tasks_waiting_for_more_peers -= 1
 
     def _get_non_finished_pieces(self) -> List[int]:
-        pieces = self._download_info.pieces
-        return [i for i in range(self._download_info.piece_count)
-                if pieces[i].selected and not pieces[i].downloaded]
+        return list(self._download_info.pieces.get_non_finished_bitmap().search(bitarray('1')))
 
     async def _wait_more_requests(self):
         if not self._endgame_mode:
@@ -319,7 +320,33 @@ class Downloader(QObject):
     REQUEST_TIMEOUT = 6
     REQUEST_TIMEOUT_ENDGAME = 1
 
-    async def _execute_block_requests(self, processed_requests: List[BlockRequestFuture]):
+    @staticmethod
+    def _wake_waiter(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    @staticmethod
+    async def _wait_requests(requests: List[PendingBlockRequest], timeout: float):
+        """Waits until any of the requests is done or the timeout expires. One future is shared by all the requests
+        instead of creating a future for each block."""
+
+        if any(request.done() or request.rejected for request in requests):
+            return
+
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        for request in requests:
+            request.waiter = waiter
+        timeout_handle = loop.call_later(timeout, Downloader._wake_waiter, waiter)
+        try:
+            await waiter
+        finally:
+            timeout_handle.cancel()
+            for request in requests:
+                if request.waiter is waiter:
+                    request.waiter = None
+
+    async def _execute_block_requests(self, processed_requests: List[PendingBlockRequest]):
         while True:
             try:
                 max_pending_count = PeerData.DOWNLOAD_REQUEST_QUEUE_SIZE - len(processed_requests)
@@ -341,13 +368,33 @@ class Downloader(QObject):
                 request_timeout = Downloader.REQUEST_TIMEOUT_ENDGAME
             else:
                 request_timeout = Downloader.REQUEST_TIMEOUT
-            requests_done, requests_pending = await asyncio.wait(
-                processed_requests, return_when=asyncio.FIRST_COMPLETED, timeout=request_timeout)
+            await Downloader._wait_requests(processed_requests, request_timeout)
+            requests_done = [request for request in processed_requests if request.done()]
+            requests_rejected = [request for request in processed_requests
+                                 if request.rejected and not request.done()]
+            requests_pending = [request for request in processed_requests
+                                if not request.done() and not request.rejected]
 
             peer_data = self._peer_manager.peer_data
-            if len(requests_pending) < len(processed_requests):
+            if requests_rejected:
+                # The peers told us that they won't send the blocks, so they're requested again without a timeout
+                cur_time = time.time()
+                for request in requests_rejected:
+                    data = peer_data.get(request.performer)
+                    if data is not None:
+                        data.queue_size -= 1
+                        if not data.client.peer_choking:
+                            data.hanged_time = cur_time  # Prefer other peers while this one refuses to upload
+                    request.performer = None
+                    request.rejected = False
+
+                    self._piece_block_queue.setdefault(request.piece_index, deque()).append(request)
+                self._request_deque_relevant.set()
+                self._request_deque_relevant.clear()
+            if requests_done:
                 pieces = self._download_info.pieces
                 for request in requests_done:
+                    self._send_cancels(request)
                     if request.performer in peer_data:
                         peer_data[request.performer].queue_size -= 1
 
@@ -357,7 +404,10 @@ class Downloader(QObject):
                         await self._validate_piece(request.piece_index)
                         piece_info.validating = False
                 processed_requests.clear()
-                processed_requests += list(requests_pending)
+                processed_requests += requests_pending
+            elif requests_rejected:
+                processed_requests.clear()
+                processed_requests += requests_pending
             else:
                 hanged_peers = {request.performer for request in requests_pending} & set(peer_data.keys())
                 cur_time = time.time()
@@ -369,6 +419,8 @@ class Downloader(QObject):
                 for request in requests_pending:
                     if request.performer in peer_data:
                         peer_data[request.performer].queue_size -= 1
+                        if request.prev_performers is None:
+                            request.prev_performers = set()
                         request.prev_performers.add(request.performer)
                     request.performer = None
 
@@ -378,14 +430,12 @@ class Downloader(QObject):
                 self._request_deque_relevant.clear()
 
     async def run(self):
-        self._non_started_pieces = self._get_non_finished_pieces()
+        self._piece_picker = PiecePicker(self._download_info)
         self._download_start_time = time.time()
-        if not self._non_started_pieces:
+        if not self._piece_picker.pending_count:
             self._download_info.complete = True
             return
 
-        random.shuffle(self._non_started_pieces)
-
         for _ in range(Downloader.DOWNLOAD_PEER_COUNT):
             processed_requests = []
             self._executors_processed_requests.append(processed_requests)
@@ -409,3 +459,6 @@ class Downloader(QObject):
             task.cancel()
         if self._request_executors:
             await asyncio.wait(self._request_executors)
+
+        if self._piece_picker is not None:
+            self._piece_picker.close()
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+
+from happy_bittorrent.file_structure import FileStructure
+from happy_bittorrent.models import TorrentInfo
+from happy_bittorrent.utils import import_signals
+
+
+QObject, pyqtSignal = import_signals()
+
+
+__all__ = ['HashChecker']
+
+
+class HashChecker(QObject):
+    """Verifies data of all pieces that already exists on disk and updates the piece states accordingly.
+
+    The data is read in large sequential chunks, and chunks are hashed in a thread pool (hashlib releases the GIL),
+    so the check is limited by the disk and the count of CPU cores.
+    """
+
+    if pyqtSignal:
+        progress = pyqtSignal()
+
+    READ_CHUNK_SIZE = 8 * 2 ** 20
+    PROGRESS_SIGNAL_MIN_INTERVAL = 1
+
+    def __init__(self, torrent_info: TorrentInfo, logger: logging.Logger):
+        super().__init__()
+
+        self._torrent_info = torrent_info
+        self._download_info = torrent_info.download_info
+        self._logger = logger
+
+        self._file_structure = None  # type: Optional[FileStructure]
+        self._executor = None        # type: Optional[ThreadPoolExecutor]
+
+        self._total_size = 0
+        self._checked_size = 0
+        self._last_progress_signal_time = None  # type: Optional[float]
+
+    def _iter_chunks(self) -> Iterator[range]:
+        download_info = self._download_info
+        pieces_per_chunk = max(HashChecker.READ_CHUNK_SIZE // download_info.piece_length, 1)
+        for begin in range(0, download_info.piece_count, pieces_per_chunk):
+            yield range(begin, min(begin + pieces_per_chunk, download_info.piece_count))
+
+    @staticmethod
+    def _hash_pieces(data: bytearray, piece_length: int) -> List[bytes]:
+        view = memoryview(data)
+        return [hashlib.sha1(view[i:i + piece_length]).digest() for i in range(0, len(data), piece_length)]
+
+    def _apply_results(self, indexes: range, digests: List[bytes]):
+        download_info = self._download_info
+        for index, digest in zip(indexes, digests):
+            info = download_info.pieces[index]
+            if digest == info.piece_hash:
+                if not info.downloaded:
+                    info.mark_as_downloaded()
+            else:
+                info.reset_content()
+
+    def _update_progress(self, size: int):
+        self._checked_size += size
+        self._torrent_info.checking_progress = self._checked_size / self._total_size
+
+        if pyqtSignal:
+            cur_time = time.time()
+            if self._last_progress_signal_time is None or \
+                    cur_time - self._last_progress_signal_time >= HashChecker.PROGRESS_SIGNAL_MIN_INTERVAL:
+                self.progress.emit()
+                self._last_progress_signal_time = cur_time
+
+    async def _check_chunk(self, indexes: range):
+        download_info = self._download_info
+        offset = indexes.start * download_info.piece_length
+        length = min(indexes.stop * download_info.piece_length, download_info.total_size) - offset
+
+        data = await self._file_structure.read(offset, length)
+        loop = asyncio.get_event_loop()
+        digests = await loop.run_in_executor(self._executor, HashChecker._hash_pieces,
+                                             data, download_info.piece_length)
+
+        self._apply_results(indexes, digests)
+        self._update_progress(length)
+
+    async def run(self):
+        torrent_info = self._torrent_info
+        download_info = self._download_info
+        chunks = list(self._iter_chunks())
+        self._total_size = max(sum(min(chunk.stop * download_info.piece_length, download_info.total_size) -
+                                   chunk.start * download_info.piece_length for chunk in chunks), 1)
+        self._checked_size = 0
+        torrent_info.checking_progress = 0
+
+        worker_count = os.cpu_count() or 1
+        self._file_structure = FileStructure(torrent_info.download_dir, download_info,
+                                             allocation_policy=torrent_info.allocation_policy)
+        self._executor = ThreadPoolExecutor(worker_count)
+        chunks_in_progress = asyncio.Semaphore(worker_count + 1)  # Let disk reading overlap with hashing
+        tasks = []  # type: List[asyncio.Task]
+        try:
+            for chunk in chunks:
+                await chunks_in_progress.acquire()
+                task = asyncio.ensure_future(self._check_chunk(chunk))
+                task.add_done_callback(lambda _: chunks_in_progress.release())
+                tasks.append(task)
+            if tasks:
+                await asyncio.gather(*tasks)
+
+            download_info.complete = download_info.all_selected_downloaded()
+            self._logger.info('check finished (%s / %s pieces are valid)', download_info.downloaded_piece_count,
+                              download_info.piece_count)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._executor.shutdown(wait=False)
+            self._file_structure.close()
+            torrent_info.checking_progress = None
+
+        if pyqtSignal:
+            self.progress.emit()
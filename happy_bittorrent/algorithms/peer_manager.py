@@ -1,11 +1,11 @@
 import asyncio
 import logging
 import time
-from typing import Dict, Optional, Sequence
+from typing import Dict, List, Optional, Sequence
 
 from happy_bittorrent.file_structure import FileStructure
 from happy_bittorrent.models import Peer, TorrentInfo
-from happy_bittorrent.network import PeerTCPClient
+from happy_bittorrent.network import PeerTCPClient, UTPSocket
 
 
 class PeerData:
@@ -18,6 +18,9 @@ class PeerData:
         self.hanged_time = None  # type: Optional[float]
         self.queue_size = 0
 
+        self.exchanged_peers = None         # type: Optional[Set[Peer]]  # Addresses sent to the peer via ut_pex
+        self.last_exchange_time = None      # type: Optional[float]
+
     @property
     def client(self) -> PeerTCPClient:
         return self._client
@@ -36,14 +39,20 @@ class PeerData:
     def is_available(self) -> bool:
         return self.is_free() and not self._client.peer_choking
 
+    def can_request(self, piece_index: int) -> bool:
+        """Unlike is_available(), takes into account allowed fast pieces of a peer choking us."""
+        return self.is_free() and (not self._client.peer_choking or self._client.is_allowed_fast(piece_index))
+
 
 class PeerManager:
-    def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes,
-                 logger: logging.Logger, file_structure: FileStructure):
+    def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes, server_port: Optional[int],
+                 logger: logging.Logger, file_structure: FileStructure, utp_socket: Optional[UTPSocket]=None):
         # self._torrent_info = torrent_info
         self._download_info = torrent_info.download_info
         self._statistics = self._download_info.session_statistics
         self._our_peer_id = our_peer_id
+        self._server_port = server_port
+        self._utp_socket = utp_socket
 
         self._logger = logger
         self._file_structure = file_structure
@@ -51,6 +60,7 @@ class PeerManager:
         self._peer_data = {}
         self._client_executors = {}          # type: Dict[Peer, asyncio.Task]
         self._keeping_alive_executor = None  # type: Optional[asyncio.Task]
+        self._peer_exchange_executor = None  # type: Optional[asyncio.Task]
         self._last_connecting_time = None    # type: Optional[float]
 
     @property
@@ -61,14 +71,20 @@ class PeerManager:
     def last_connecting_time(self) -> int:
         return self._last_connecting_time
 
-    async def _execute_peer_client(self, peer: Peer, client: PeerTCPClient, *, need_connect: bool):
+    async def _execute_peer_client(self, peer: Peer, client: PeerTCPClient, *, need_connect: bool,
+                                   replaced_task: Optional[asyncio.Task]=None):
+        client.set_peer_exchange_handler(self._handle_exchanged_peers)
         try:
+            if replaced_task is not None:
+                replaced_task.cancel()
+                await asyncio.wait([replaced_task])
+
             if need_connect:
                 await client.connect(self._download_info, self._file_structure)
             else:
                 client.confirm_info_hash(self._download_info, self._file_structure)
 
-            self._peer_data[peer] = PeerData(client, asyncio.Task.current_task(), time.time())
+            self._peer_data[peer] = PeerData(client, asyncio.current_task(), time.time())
             self._statistics.peer_count += 1
 
             await client.run()
@@ -80,18 +96,13 @@ class PeerManager:
             if peer in self._peer_data:
                 self._statistics.peer_count -= 1
                 del self._peer_data[peer]
-
-                for info in self._download_info.pieces:
-                    if peer in info.owners:
-                        info.owners.remove(peer)
-                if peer in self._statistics.peer_last_download:
-                    del self._statistics.peer_last_download[peer]
-                if peer in self._statistics.peer_last_upload:
-                    del self._statistics.peer_last_upload[peer]
+                self._statistics.remove_peer(peer)
 
             client.close()
+            self._download_info.availability.remove_peer(peer)
 
-            del self._client_executors[peer]
+            if self._client_executors.get(peer) is asyncio.current_task():
+                del self._client_executors[peer]
 
     KEEP_ALIVE_TIMEOUT = 2 * 60
 
@@ -103,6 +114,51 @@ class PeerManager:
             for data in self._peer_data.values():
                 data.client.send_keep_alive()
 
+    PEER_EXCHANGE_CHECK_INTERVAL = 5
+    PEER_EXCHANGE_INTERVAL = 60  # Minimal interval between messages to the same peer (BEP 11)
+
+    def _get_exchangeable_peers(self) -> Dict[Peer, int]:
+        availability = self._download_info.availability
+        result = {}
+        for peer, data in self._peer_data.items():
+            address = data.client.listen_address
+            if address is not None:
+                result[address] = PeerTCPClient.PEER_EXCHANGE_SEED_FLAG if availability.is_seed(peer) else 0
+        return result
+
+    async def _execute_peer_exchange(self):
+        # Newly connected peers receive the first list within a few seconds, later deltas are rate-limited
+        while True:
+            await asyncio.sleep(PeerManager.PEER_EXCHANGE_CHECK_INTERVAL)
+
+            cur_time = time.time()
+            exchangeable_peers = self._get_exchangeable_peers()
+            for data in self._peer_data.values():
+                if not data.client.supports_peer_exchange or (
+                        data.last_exchange_time is not None and
+                        cur_time - data.last_exchange_time < PeerManager.PEER_EXCHANGE_INTERVAL):
+                    continue
+
+                sent = data.exchanged_peers if data.exchanged_peers is not None else set()
+                own_address = data.client.listen_address
+                added = [(peer, flags) for peer, flags in exchangeable_peers.items()
+                         if peer not in sent and peer != own_address][:PeerTCPClient.MAX_EXCHANGED_PEERS]
+                dropped = [peer for peer in sent
+                           if peer not in exchangeable_peers][:PeerTCPClient.MAX_EXCHANGED_PEERS]
+                if not added and not dropped:
+                    continue
+
+                data.client.send_peer_exchange(added, dropped)
+                data.exchanged_peers = sent.difference(dropped).union(peer for peer, _ in added)
+                data.last_exchange_time = cur_time
+
+    def _handle_exchanged_peers(self, peers: List[Peer]):
+        # Peers connected to us are known by their ephemeral ports, so they're compared by listen addresses
+        known_addresses = {data.client.listen_address for data in self._peer_data.values()}
+        peers = [peer for peer in peers if peer not in known_addresses]
+        if peers:
+            self.connect_to_peers(peers, False)
+
     MAX_PEERS_TO_ACTIVELY_CONNECT = 30
     MAX_PEERS_TO_ACCEPT = 55
 
@@ -117,29 +173,42 @@ class PeerManager:
         self._logger.debug('trying to connect to %s new peers', min(len(peers), peers_to_connect_count))
 
         for peer in peers[:peers_to_connect_count]:
-            client = PeerTCPClient(self._our_peer_id, peer)
+            client = PeerTCPClient(self._our_peer_id, peer, self._server_port, self._utp_socket)
             self._client_executors[peer] = asyncio.ensure_future(
                 self._execute_peer_client(peer, client, need_connect=True))
 
         self._last_connecting_time = time.time()
 
     def accept_client(self, peer: Peer, client: PeerTCPClient):
-        if len(self._peer_data) > PeerManager.MAX_PEERS_TO_ACCEPT or self._download_info.is_banned(peer) or \
-                peer in self._client_executors:
+        if len(self._peer_data) > PeerManager.MAX_PEERS_TO_ACCEPT or self._download_info.is_banned(peer):
             client.close()
             return
-        self._logger.debug('accepted connection from %s', peer)
+
+        replaced_task = self._client_executors.get(peer)
+        if replaced_task is not None:
+            # We're connected to the same address the connection came from (it happens with uTP, where
+            # connections are made from the listen port). If both sides connected to each other at the same time,
+            # both of them keep the connection initiated by the peer with the lower peer_id.
+            if peer.peer_id is None or peer.peer_id >= self._our_peer_id:
+                client.close()
+                return
+            self._logger.debug('connection to %s is replaced with the incoming one', peer)
+        else:
+            self._logger.debug('accepted connection from %s', peer)
 
         self._client_executors[peer] = asyncio.ensure_future(
-            self._execute_peer_client(peer, client, need_connect=False))
+            self._execute_peer_client(peer, client, need_connect=False, replaced_task=replaced_task))
 
     def invoke(self):
         self._keeping_alive_executor = asyncio.ensure_future(self._execute_keeping_alive())
+        self._peer_exchange_executor = asyncio.ensure_future(self._execute_peer_exchange())
 
     async def stop(self):
         tasks = []
         if self._keeping_alive_executor is not None:
             tasks.append(self._keeping_alive_executor)
+        if self._peer_exchange_executor is not None:
+            tasks.append(self._peer_exchange_executor)
         tasks += list(self._client_executors.values())
 
         for task in tasks:
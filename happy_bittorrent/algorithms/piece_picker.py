@@ -0,0 +1,139 @@
+import random
+from typing import Iterable, List, Optional, Sequence
+
+from bitarray import bitarray
+
+from happy_bittorrent.models import DownloadInfo, Peer
+
+
+__all__ = ['PiecePicker']
+
+
+class PiecePicker:
+    """Selects pieces to download: the rarest first, pieces with higher file priority before others.
+
+    Pieces that weren't started yet are kept in buckets by their owner counts. Each bucket is a bitmap, so
+    intersecting it with pieces owned by the peers we can request from is a single bitarray operation.
+    Buckets are updated incrementally when PieceAvailability reports changed counts.
+    """
+
+    MAX_PIECES_IN_PROGRESS = 256
+
+    def __init__(self, download_info: DownloadInfo):
+        self._download_info = download_info
+        self._availability = download_info.availability
+
+        self._started = bitarray(download_info.piece_count, endian='big')
+        self._started.setall(False)
+        self._in_progress_count = 0
+
+        self._pending = None        # type: bitarray
+        self._pending_count = None  # type: int
+        self._priorities = None     # type: List[Tuple[int, bitarray]]
+        self._buckets = None        # type: Dict[int, bitarray]
+        self.update_selection()
+
+        self._availability.add_listener(self._update_counts)
+        download_info.add_selection_listener(self.update_selection)
+
+    def close(self):
+        self._availability.remove_listener(self._update_counts)
+        self._download_info.remove_selection_listener(self.update_selection)
+
+    def update_selection(self):
+        """Rebuilds the buckets after file priorities or the set of selected files were changed.
+        Pieces that are already started aren't affected."""
+
+        self._pending = self._download_info.pieces.get_non_finished_bitmap()
+        self._pending &= ~self._started
+        self._pending_count = self._pending.count()
+
+        self._priorities = self._download_info.get_piece_priorities()
+
+        self._buckets = {}
+        counts = self._availability.counts
+        for index in self._pending.search(bitarray('1')):
+            self._get_bucket(counts[index])[index] = True
+
+    @property
+    def pending_count(self) -> int:
+        """Count of selected pieces that weren't started yet."""
+        return self._pending_count
+
+    @property
+    def in_progress_count(self) -> int:
+        return self._in_progress_count
+
+    def get_pending_pieces(self) -> List[int]:
+        return list(self._pending.search(bitarray('1')))
+
+    def _get_bucket(self, count: int) -> bitarray:
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = bitarray(self._download_info.piece_count, endian='big')
+            bucket.setall(False)
+            self._buckets[count] = bucket
+        return bucket
+
+    def _update_counts(self, indexes: Sequence[int], delta: int):
+        pending = self._pending
+        counts = self._availability.counts
+        for index in indexes:
+            if pending[index]:
+                new_count = counts[index]
+                self._buckets[new_count - delta][index] = False
+                self._get_bucket(new_count)[index] = True
+
+    @staticmethod
+    def _choose_random(candidates: bitarray) -> int:
+        # Takes the first candidate after a random position, so candidates following long gaps are preferred
+        # a bit. It's enough for tie-breaking and doesn't require to enumerate the candidates.
+        start = random.randrange(len(candidates))
+        try:
+            return candidates.index(True, start)
+        except ValueError:
+            return candidates.index(True)
+
+    def pick(self, peers: Iterable[Peer], *, extra_candidates: Optional[bitarray]=None,
+             preferred: Optional[bitarray]=None) -> Optional[int]:
+        """Selects a piece owned by one of the peers (or present in `extra_candidates`) and marks it as started.
+        Pieces from `preferred` (e.g. suggested by peers) are selected before other pieces of the same priority."""
+
+        if not self._pending_count or self._in_progress_count >= PiecePicker.MAX_PIECES_IN_PROGRESS:
+            return None
+        candidates = self._availability.get_union(peers)
+        if extra_candidates is not None:
+            candidates |= extra_candidates
+        candidates &= self._pending
+        if not candidates.any():
+            return None
+
+        sorted_counts = sorted(self._buckets)
+        for _, priority_pieces in self._priorities:
+            priority_candidates = candidates & priority_pieces
+            if not priority_candidates.any():
+                continue
+            if preferred is not None:
+                preferred_candidates = priority_candidates & preferred
+                if preferred_candidates.any():
+                    priority_candidates = preferred_candidates
+
+            for count in sorted_counts:
+                bucket_candidates = self._buckets[count] & priority_candidates
+                if bucket_candidates.any():
+                    index = PiecePicker._choose_random(bucket_candidates)
+                    self._start(index)
+                    return index
+        raise RuntimeError('Buckets are inconsistent with pending pieces')
+
+    def _start(self, index: int):
+        self._buckets[self._availability.counts[index]][index] = False
+        self._pending[index] = False
+        self._pending_count -= 1
+        self._started[index] = True
+        self._in_progress_count += 1
+
+    def finish(self, index: int):
+        """Marks a piece returned by pick() as downloaded."""
+        self._started[index] = False
+        self._in_progress_count -= 1
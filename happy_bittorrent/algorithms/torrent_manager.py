@@ -10,7 +10,8 @@ from happy_bittorrent.algorithms.speed_measurer import SpeedMeasurer
 from happy_bittorrent.algorithms.uploader import Uploader
 from happy_bittorrent.file_structure import FileStructure
 from happy_bittorrent.models import Peer, TorrentInfo, DownloadInfo
-from happy_bittorrent.network import EventType, PeerTCPClient
+from happy_bittorrent.network import EventType, PeerTCPClient, UTPSocket
+from happy_bittorrent.resume_journal import ResumeJournal
 from happy_bittorrent.utils import import_signals
 
 
@@ -29,7 +30,10 @@ class TorrentManager(QObject):
 
     ANNOUNCE_FAILED_SLEEP_TIME = 30
 
-    def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes, server_port: Optional[int]):
+    USE_MMAP_STORAGE = False
+
+    def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes, server_port: Optional[int], *,
+                 resume_journal: Optional[ResumeJournal]=None, utp_socket: Optional[UTPSocket]=None):
         super().__init__()
         self._torrent_info = torrent_info
         download_info = torrent_info.download_info  # type: DownloadInfo
@@ -44,12 +48,15 @@ class TorrentManager(QObject):
 
         self._executors = []  # type: List[asyncio.Task]
 
-        self._file_structure = FileStructure(torrent_info.download_dir, torrent_info.download_info)
+        self._file_structure = FileStructure(torrent_info.download_dir, torrent_info.download_info,
+                                             use_mmap=TorrentManager.USE_MMAP_STORAGE,
+                                             allocation_policy=torrent_info.allocation_policy)
 
-        self._peer_manager = PeerManager(torrent_info, our_peer_id, self._logger, self._file_structure)
+        self._peer_manager = PeerManager(torrent_info, our_peer_id, server_port, self._logger,
+                                         self._file_structure, utp_socket)
         self._announcer = Announcer(torrent_info, our_peer_id, server_port, self._logger, self._peer_manager)
         self._downloader = Downloader(torrent_info, our_peer_id, self._logger, self._file_structure,
-                                      self._peer_manager, self._announcer)
+                                      self._peer_manager, self._announcer, resume_journal)
         self._uploader = Uploader(torrent_info, self._logger, self._peer_manager)
         self._speed_measurer = SpeedMeasurer(torrent_info.download_info.session_statistics)
         if pyqtSignal:
@@ -90,4 +97,5 @@ class TorrentManager(QObject):
         if executors:
             await asyncio.wait(executors)
 
+        await self._file_structure.spill_piece_buffers()
         self._file_structure.close()
@@ -42,12 +42,10 @@ class Uploader:
             return remaining_peers[index]
         return connected_recently[(index - len(remaining_peers)) % len(connected_recently)]
 
-    def get_peer_upload_rate(self, peer: Peer) -> int:
-        data = self._peer_manager.peer_data[peer]
-
-        rate = data.client.downloaded  # We owe them for downloading
+    def get_peer_upload_rate(self, peer: Peer) -> float:
+        rate = self._statistics.get_peer_download_rate(peer)  # We owe them for downloading
         if self._download_info.complete:
-            rate += data.client.uploaded  # To reach maximal upload speed
+            rate += self._statistics.get_peer_upload_rate(peer)  # To reach maximal upload speed
         return rate
 
     async def execute(self):
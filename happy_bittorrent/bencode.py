@@ -0,0 +1,232 @@
+"""Bencode decoder that allows to process parts of a document in a custom way, and a simple encoder.
+
+Every decoding function returns a value together with the position where it ends. decode_dict() accepts
+functions to build values of particular keys, so a caller can skip values, refer to strings without copying them
+or find out the original bytes of a nested dictionary (e.g. to calculate the info hash) in a single pass.
+"""
+
+from typing import Any, Callable, Dict, List, Tuple
+
+
+__all__ = ['DecodingError', 'encode', 'decode', 'decode_from_file', 'decode_value', 'skip_value', 'decode_string_view',
+           'decode_list', 'decode_dict']
+
+
+Parser = Callable[[bytes, int], Tuple[Any, int]]
+
+
+class DecodingError(ValueError):
+    pass
+
+
+_INT, _LIST, _DICT, _END = b'ilde'
+_DIGITS = frozenset(b'0123456789')
+_DIGIT_BYTES = frozenset(bytes([digit]) for digit in _DIGITS)
+
+
+def _is_canonical_int(representation: bytes) -> bool:
+    # int() would also accept "+3", "1_0", whitespace, leading zeros and "-0", which are invalid in bencode
+    digits = representation[1:] if representation[:1] == b'-' else representation
+    if not digits.isdigit():
+        return False
+    return digits[:1] != b'0' or representation == b'0'
+
+
+def _decode_int(data: bytes, pos: int) -> Tuple[int, int]:
+    end = data.find(b'e', pos)
+    if end == -1:
+        raise DecodingError('Unterminated integer at {}'.format(pos - 1))
+    representation = data[pos:end]
+    if not _is_canonical_int(representation):
+        raise DecodingError('Invalid integer at {}'.format(pos - 1))
+    return int(representation), end + 1
+
+
+def _string_bounds(data: bytes, pos: int) -> Tuple[int, int]:
+    colon = data.find(b':', pos)
+    if colon == -1:
+        raise DecodingError('Invalid string length at {}'.format(pos))
+    length_repr = data[pos:colon]
+    if not length_repr.isdigit():
+        raise DecodingError('Invalid string length at {}'.format(pos))
+    start = colon + 1
+    end = start + int(length_repr)
+    if end > len(data):
+        raise DecodingError('Unterminated string at {}'.format(pos))
+    return start, end
+
+
+def _decode(data: bytes, pos: int) -> Tuple[Any, int]:
+    try:
+        kind = data[pos]
+    except IndexError:
+        raise DecodingError('Unexpected end of data')
+
+    if kind in _DIGITS:
+        start, end = _string_bounds(data, pos)
+        return data[start:end], end
+    if kind == _INT:
+        return _decode_int(data, pos + 1)
+    if kind == _LIST:
+        result = []  # type: List[Any]
+        pos += 1
+        while data[pos:pos + 1] != b'e':
+            value, pos = _decode(data, pos)
+            result.append(value)
+        return result, pos + 1
+    if kind == _DICT:
+        result = {}  # type: Dict[bytes, Any]
+        pos += 1
+        while data[pos:pos + 1] != b'e':
+            key_pos = pos
+            key, pos = _decode(data, pos)
+            if not isinstance(key, bytes):
+                raise DecodingError('Dictionary key is not a string at {}'.format(key_pos))
+            result[key], pos = _decode(data, pos)
+        return result, pos + 1
+    raise DecodingError('Unexpected byte {!r} at {}'.format(bytes([kind]), pos))
+
+
+def _skip(data: bytes, pos: int) -> int:
+    """Returns the end of a value starting at `pos` without building it."""
+
+    # Iterative and with inlined string parsing since it's used to skip large lists (e.g. of files)
+    find = data.find
+    depth = 0
+    try:
+        while True:
+            kind = data[pos]
+            if kind in _DIGITS:
+                colon = find(b':', pos)
+                length_repr = data[pos:colon]
+                if colon == -1 or not length_repr.isdigit():
+                    raise ValueError
+                pos = colon + 1 + int(length_repr)
+            elif kind == _INT:
+                end = find(b'e', pos)
+                if end == -1:
+                    raise ValueError
+                representation = data[pos + 1:end]
+                # Fast path for the usual case of a non-negative integer without leading zeros
+                if not (representation.isdigit() and (representation[0] != 0x30 or end == pos + 2)) and \
+                        not _is_canonical_int(representation):
+                    raise ValueError
+                pos = end + 1
+            elif kind == _LIST or kind == _DICT:
+                depth += 1
+                pos += 1
+                continue
+            elif kind == _END and depth:
+                depth -= 1
+                pos += 1
+            else:
+                raise ValueError
+
+            if not depth:
+                if pos > len(data):
+                    raise ValueError
+                return pos
+    except (ValueError, IndexError):
+        raise DecodingError('Invalid value at {}'.format(pos))
+
+
+def _encode(value: Any, parts: List[bytes]):
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(str(len(value)).encode())
+        parts.append(b':')
+        parts.append(bytes(value))
+    elif isinstance(value, int):
+        parts.append(b'i%de' % value)
+    elif isinstance(value, (list, tuple)):
+        parts.append(b'l')
+        for item in value:
+            _encode(item, parts)
+        parts.append(b'e')
+    elif isinstance(value, dict):
+        parts.append(b'd')
+        items = [(key.encode() if isinstance(key, str) else key, item) for key, item in value.items()]
+        for key, item in sorted(items):
+            _encode(key, parts)
+            _encode(item, parts)
+        parts.append(b'e')
+    else:
+        raise TypeError('Value of type {} is not encodable'.format(type(value).__name__))
+
+
+def encode(value: Any) -> bytes:
+    """Encodes strings (bytes or str), integers, lists and dictionaries. Dictionary keys are sorted as required."""
+
+    parts = []  # type: List[bytes]
+    _encode(value, parts)
+    return b''.join(parts)
+
+
+def decode(data: bytes) -> Any:
+    value, end = decode_value(data, 0)
+    if end != len(data):
+        raise DecodingError('Unexpected data after the end of the value')
+    return value
+
+
+def decode_from_file(filename: str) -> Any:
+    with open(filename, 'rb') as f:
+        return decode(f.read())
+
+
+def decode_value(data: bytes, pos: int) -> Tuple[Any, int]:
+    """Decodes a value starting at `pos`. Returns the value and its end.
+    All the functions below have the same signature, so they can be used as parsers in decode_dict()."""
+
+    try:
+        return _decode(data, pos)
+    except RecursionError:
+        raise DecodingError('Too deep nesting')
+
+
+def skip_value(data: bytes, pos: int) -> Tuple[None, int]:
+    return None, _skip(data, pos)
+
+
+def decode_string_view(data: bytes, pos: int) -> Tuple[memoryview, int]:
+    """Returns a string value as a memoryview over `data`, so the value isn't copied."""
+
+    if data[pos:pos + 1] not in _DIGIT_BYTES:
+        raise DecodingError('String expected at {}'.format(pos))
+    start, end = _string_bounds(data, pos)
+    return memoryview(data)[start:end], end
+
+
+def decode_list(data: bytes, pos: int, parse_item: Parser=decode_value) -> Tuple[List[Any], int]:
+    if data[pos:pos + 1] != b'l':
+        raise DecodingError('List expected at {}'.format(pos))
+
+    result = []
+    pos += 1
+    while data[pos:pos + 1] != b'e':
+        item, pos = parse_item(data, pos)
+        result.append(item)
+    return result, pos + 1
+
+
+def decode_dict(data: bytes, pos: int, parsers: Dict[bytes, Parser]) -> Tuple[Dict[bytes, Any], int]:
+    """Decodes a dictionary starting at `pos`. Values of keys present in `parsers` are built by the corresponding
+    functions instead of decode_value(). Returns the dictionary and its end.
+
+    The end allows to find out the original bytes of the dictionary (e.g. to calculate the info hash) without
+    encoding it again.
+    """
+
+    if data[pos:pos + 1] != b'd':
+        raise DecodingError('Dictionary expected at {}'.format(pos))
+
+    result = {}
+    pos += 1
+    while data[pos:pos + 1] != b'e':
+        if data[pos:pos + 1] not in _DIGIT_BYTES:
+            raise DecodingError('Dictionary key is not a string at {}'.format(pos))
+        key_start, pos = _string_bounds(data, pos)
+        key = data[key_start:pos]
+        result[key], pos = parsers.get(key, decode_value)(data, pos)
+    return result, pos + 1
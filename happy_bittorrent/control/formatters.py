@@ -32,7 +32,7 @@ def format_content(torrent_info: TorrentInfo) -> List[str]:
     if download_info.single_file_mode:
         lines.append('Content: single file ({})\n'.format(total_size_repr))
     else:
-        lines.append('Content: {} files (total {})\n'.format(len(download_info.files), total_size_repr))
+        lines.append('Content: {} files (total {})\n'.format(download_info.file_count, total_size_repr))
         for file_info in download_info.files:
             lines.append(INDENT + '{} ({})\n'.format('/'.join(file_info.path), humanize_size(file_info.length)))
     return lines
@@ -49,14 +49,16 @@ def format_status(state: TorrentState, long_format: bool) -> List[str]:
             state.selected_file_count, state.total_file_count, state.selected_piece_count, state.total_piece_count))
         lines.append('Directory: {}\n'.format(state.download_dir))
 
-        if state.paused:
+        if state.checking_progress is not None:
+            general_status = 'Checking ({:.1f}%)\n'.format(floor_to(state.checking_progress * 100, 1))
+        elif state.paused:
             general_status = 'Paused\n'
         elif state.complete:
             general_status = 'Uploading\n'
         else:
             general_status = 'Downloading\t'
         lines.append('State: ' + general_status)
-        if not state.paused and not state.complete:
+        if not state.paused and not state.complete and state.checking_progress is None:
             eta_seconds = state.eta_seconds
             lines.append('ETA: {}\n'.format(humanize_time(eta_seconds) if eta_seconds is not None else 'unknown'))
 
@@ -1,13 +1,14 @@
 import asyncio
-import copy
 import logging
 import os
 import pickle
 from typing import Dict, List, Optional
 
 from happy_bittorrent.algorithms import TorrentManager
+from happy_bittorrent.algorithms.hash_checker import HashChecker
 from happy_bittorrent.models import generate_peer_id, TorrentInfo, TorrentState
 from happy_bittorrent.network import PeerTCPServer
+from happy_bittorrent.resume_journal import ResumeJournal
 from happy_bittorrent.utils import import_signals
 
 
@@ -18,6 +19,7 @@ __all__ = ['ControlManager']
 
 
 state_filename = '.tstate'
+resume_dirname = '.tresume'
 
 
 logger = logging.getLogger(__name__)
@@ -42,8 +44,12 @@ class ControlManager(QObject):
         self._server = PeerTCPServer(self._our_peer_id, self._torrent_managers)
 
         self._torrent_manager_executors = {}  # type: Dict[bytes, asyncio.Task]
+        self._hash_checker_executors = {}     # type: Dict[bytes, asyncio.Task]
         self._state_updating_executor = None  # type: Optional[asyncio.Task]
 
+        self._journals = {}  # type: Dict[bytes, ResumeJournal]
+        self._journals_enabled = False
+
         self.last_torrent_dir = None   # type: Optional[str]
         self.last_download_dir = None  # type: Optional[str]
 
@@ -56,27 +62,90 @@ class ControlManager(QObject):
     def _start_torrent_manager(self, torrent_info: TorrentInfo):
         info_hash = torrent_info.download_info.info_hash
 
-        manager = TorrentManager(torrent_info, self._our_peer_id, self._server.port)
+        manager = TorrentManager(torrent_info, self._our_peer_id, self._server.port,
+                                 resume_journal=self._journals.get(info_hash), utp_socket=self._server.utp_socket)
         if pyqtSignal:
             manager.state_changed.connect(lambda: self.torrent_changed.emit(TorrentState(torrent_info)))
         self._torrent_managers[info_hash] = manager
         self._torrent_manager_executors[info_hash] = asyncio.ensure_future(manager.run())
 
-    def add(self, torrent_info: TorrentInfo):
+    @staticmethod
+    def _get_journal_path(info_hash: bytes) -> str:
+        return os.path.join(resume_dirname, info_hash.hex() + '.journal')
+
+    def _open_journal(self, torrent_info: TorrentInfo):
+        download_info = torrent_info.download_info
+        journal = ResumeJournal(ControlManager._get_journal_path(download_info.info_hash),
+                                len(download_info.pieces))
+        os.makedirs(resume_dirname, exist_ok=True)
+        journal.start_compaction(download_info.get_downloaded_bitmap())
+        self._journals[download_info.info_hash] = journal
+
+    def add(self, torrent_info: TorrentInfo, *, recheck: bool=False):
         info_hash = torrent_info.download_info.info_hash
         if info_hash in self._torrents:
             raise ValueError('This torrent is already added')
 
-        if not torrent_info.paused:
-            self._start_torrent_manager(torrent_info)
         self._torrents[info_hash] = torrent_info
+        if self._journals_enabled:
+            self._open_journal(torrent_info)
+        if recheck:
+            self._start_hash_checker(torrent_info, not torrent_info.paused)
+        elif not torrent_info.paused:
+            self._start_torrent_manager(torrent_info)
 
         if pyqtSignal:
             self.torrent_added.emit(TorrentState(torrent_info))
 
+    def _check_not_checking(self, info_hash: bytes):
+        if info_hash in self._hash_checker_executors:
+            raise ValueError('The torrent is being checked')
+
+    async def _execute_hash_checker(self, torrent_info: TorrentInfo, resume: bool):
+        info_hash = torrent_info.download_info.info_hash
+        checker = HashChecker(torrent_info, logger)
+        if pyqtSignal:
+            checker.progress.connect(lambda: self.torrent_changed.emit(TorrentState(torrent_info)))
+
+        try:
+            await checker.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception('failed to check torrent %s: %r', info_hash.hex(), e)
+        finally:
+            del self._hash_checker_executors[info_hash]
+
+        journal = self._journals.get(info_hash)
+        if journal is not None:
+            journal.start_compaction(torrent_info.download_info.get_downloaded_bitmap())
+
+        if resume and info_hash in self._torrents:
+            self._start_torrent_manager(torrent_info)
+
+    def _start_hash_checker(self, torrent_info: TorrentInfo, resume: bool):
+        info_hash = torrent_info.download_info.info_hash
+        torrent_info.checking_progress = 0
+        self._hash_checker_executors[info_hash] = asyncio.ensure_future(
+            self._execute_hash_checker(torrent_info, resume))
+
+    async def recheck(self, info_hash: bytes):
+        if info_hash not in self._torrents:
+            raise ValueError('Torrent not found')
+        self._check_not_checking(info_hash)
+        torrent_info = self._torrents[info_hash]
+
+        if not torrent_info.paused:
+            await self._stop_torrent_manager(info_hash)
+        self._start_hash_checker(torrent_info, not torrent_info.paused)
+
+        if pyqtSignal:
+            self.torrent_changed.emit(TorrentState(torrent_info))
+
     def resume(self, info_hash: bytes):
         if info_hash not in self._torrents:
             raise ValueError('Torrent not found')
+        self._check_not_checking(info_hash)
         torrent_info = self._torrents[info_hash]
         if not torrent_info.paused:
             raise ValueError('The torrent is already running')
@@ -101,21 +170,36 @@ class ControlManager(QObject):
         del self._torrent_managers[info_hash]
         await manager.stop()
 
+    async def _stop_hash_checker(self, info_hash: bytes):
+        checker_executor = self._hash_checker_executors[info_hash]
+        checker_executor.cancel()
+        try:
+            await checker_executor
+        except asyncio.CancelledError:
+            pass
+
     async def remove(self, info_hash: bytes):
         if info_hash not in self._torrents:
             raise ValueError('Torrent not found')
         torrent_info = self._torrents[info_hash]
 
         del self._torrents[info_hash]
-        if not torrent_info.paused:
+        if info_hash in self._hash_checker_executors:
+            await self._stop_hash_checker(info_hash)
+        elif not torrent_info.paused:
             await self._stop_torrent_manager(info_hash)
 
+        journal = self._journals.pop(info_hash, None)
+        if journal is not None:
+            await journal.remove()
+
         if pyqtSignal:
             self.torrent_removed.emit(info_hash)
 
     async def pause(self, info_hash: bytes):
         if info_hash not in self._torrents:
             raise ValueError('Torrent not found')
+        self._check_not_checking(info_hash)
         torrent_info = self._torrents[info_hash]
         if torrent_info.paused:
             raise ValueError('The torrent is already paused')
@@ -128,16 +212,15 @@ class ControlManager(QObject):
             self.torrent_changed.emit(TorrentState(torrent_info))
 
     def _dump_state(self):
-        torrent_list = []
-        for manager, torrent_info in self._torrents.items():
-            torrent_info = copy.copy(torrent_info)
-            torrent_info.download_info = copy.copy(torrent_info.download_info)
-            torrent_info.download_info.reset_run_state()
-            torrent_list.append(torrent_info)
+        # Pieces downloaded since the last dump are recorded in the journals, so the dump itself may be rare.
+        # Run state of the torrents isn't pickled (see DownloadInfo.__getstate__), so copying them isn't required.
+        torrent_list = list(self._torrents.values())
 
+        temp_filename = state_filename + '.tmp'
         try:
-            with open(state_filename, 'wb') as f:
+            with open(temp_filename, 'wb') as f:
                 pickle.dump((self.last_torrent_dir, self.last_download_dir, torrent_list), f)
+            os.replace(temp_filename, state_filename)
             logger.info('state saved (%s torrents)', len(torrent_list))
         except Exception as err:
             logger.warning('Failed to save state: %r', err)
@@ -150,24 +233,49 @@ class ControlManager(QObject):
 
             self._dump_state()
 
+            for info_hash, journal in self._journals.items():
+                if journal.needs_compaction:
+                    download_info = self._torrents[info_hash].download_info
+                    journal.start_compaction(download_info.get_downloaded_bitmap())
+
     def invoke_state_dumps(self):
         self._state_updating_executor = asyncio.ensure_future(self._execute_state_updates())
 
+    @staticmethod
+    def _restore_from_journal(torrent_info: TorrentInfo):
+        download_info = torrent_info.download_info
+        journal = ResumeJournal(ControlManager._get_journal_path(download_info.info_hash),
+                                len(download_info.pieces))
+        downloaded = journal.load()
+        if downloaded is not None:
+            download_info.set_downloaded_pieces(downloaded)
+
     def load_state(self):
+        self._journals_enabled = True
         if not os.path.isfile(state_filename):
             return
 
-        with open(state_filename, 'rb') as f:
-            self.last_torrent_dir, self.last_download_dir, torrent_list = pickle.load(f)
+        try:
+            with open(state_filename, 'rb') as f:
+                self.last_torrent_dir, self.last_download_dir, torrent_list = pickle.load(f)
+        except Exception as err:
+            # The file is kept aside, otherwise the next dump would overwrite it
+            logger.error('Failed to load state, starting without torrents: %r', err)
+            try:
+                os.replace(state_filename, state_filename + '.bad')
+            except OSError:
+                pass
+            return
 
         for torrent_info in torrent_list:
+            ControlManager._restore_from_journal(torrent_info)
             self.add(torrent_info)
         logger.info('state recovered (%s torrents)', len(torrent_list))
 
     async def stop(self):
         await self._server.stop()
 
-        tasks = list(self._torrent_manager_executors.values())
+        tasks = list(self._torrent_manager_executors.values()) + list(self._hash_checker_executors.values())
         if self._state_updating_executor is not None:
             tasks.append(self._state_updating_executor)
 
@@ -179,5 +287,11 @@ class ControlManager(QObject):
         if self._torrent_managers:
             await asyncio.wait([manager.stop() for manager in self._torrent_managers.values()])
 
+        for journal in self._journals.values():
+            try:
+                await journal.close()
+            except Exception as err:
+                logger.warning('Failed to close resume journal: %r', err)
+
         if self._state_updating_executor is not None:  # Only if we have loaded starting state
             self._dump_state()
@@ -0,0 +1,333 @@
+import asyncio
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Any, Iterable
+
+from happy_bittorrent.models import AllocationPolicy
+
+
+__all__ = ['DiskIOEngine', 'FileDescriptorCache', 'read_at', 'write_at']
+
+
+def read_at(fd: int, buffer: memoryview, offset: int):
+    """Reads into the buffer from the given file position. The part of the buffer beyond the end of file
+    is left untouched."""
+
+    while buffer:
+        if hasattr(os, 'preadv'):
+            read_count = os.preadv(fd, [buffer], offset)
+        else:
+            data = os.pread(fd, len(buffer), offset)
+            read_count = len(data)
+            buffer[:read_count] = data
+        if not read_count:
+            return
+        buffer = buffer[read_count:]
+        offset += read_count
+
+
+def write_at(fd: int, data: memoryview, offset: int):
+    while data:
+        written_count = os.pwrite(fd, data, offset)
+        data = data[written_count:]
+        offset += written_count
+
+
+class DiskIOEngine:
+    """Process-wide thread pool for disk operations. Operations submitted during one event loop iteration are
+    dispatched to workers together. Each of them is taken by the next free worker, so a slow operation doesn't
+    delay the others. Completions that are ready by the time the loop is woken up are delivered together.
+    The operations use positional I/O, so they don't need to be serialized."""
+
+    WORKER_COUNT = 4
+
+    LATENCY_BUCKETS = (0.001, 0.005, 0.02, 0.1, 0.5, 2, float('inf'))  # In seconds
+
+    _instance = None  # type: Optional[DiskIOEngine]
+
+    def __init__(self, worker_count: int):
+        self._worker_count = worker_count
+        self._executor = ThreadPoolExecutor(worker_count)
+
+        self._pending = []  # type: List[Tuple[Callable[[], Any], asyncio.Future]]
+        self._completed_lock = threading.Lock()
+        self._completed = []  # type: List[Tuple[asyncio.Future, float, Any, Optional[Exception]]]
+        self._queue_depth = 0
+        self._latency_histogram = [0] * len(DiskIOEngine.LATENCY_BUCKETS)
+
+    @classmethod
+    def get_instance(cls) -> 'DiskIOEngine':
+        if cls._instance is None:
+            cls._instance = cls(cls.WORKER_COUNT)
+        return cls._instance
+
+    @classmethod
+    def set_worker_count(cls, worker_count: int):
+        if cls._instance is not None:
+            raise RuntimeError("Can't change worker count when the engine is already started")
+        cls.WORKER_COUNT = worker_count
+
+    @property
+    def worker_count(self) -> int:
+        return self._worker_count
+
+    @property
+    def queue_depth(self) -> int:
+        """Count of operations that are submitted but not completed yet."""
+
+        return self._queue_depth
+
+    @property
+    def latency_histogram(self) -> List[Tuple[float, int]]:
+        """Pairs of an upper bound of operation latency (in seconds) and count of operations within this bucket.
+        The latency is the time an operation takes in a worker, time spent in the queue isn't included
+        (see queue_depth)."""
+
+        return list(zip(DiskIOEngine.LATENCY_BUCKETS, self._latency_histogram))
+
+    def submit(self, func: Callable[..., Any], *args) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if not self._pending:
+            loop.call_soon(self._dispatch, loop)
+        self._pending.append((lambda: func(*args), future))
+        self._queue_depth += 1
+        return future
+
+    def _dispatch(self, loop: asyncio.AbstractEventLoop):
+        batch = self._pending
+        self._pending = []
+
+        for func, future in batch:
+            self._executor.submit(self._execute, loop, func, future)
+
+    def _execute(self, loop: asyncio.AbstractEventLoop, func: Callable[[], Any], future: asyncio.Future):
+        # Executed in a worker thread
+        start_time = time.monotonic()
+        try:
+            result, exc = func(), None
+        except Exception as e:
+            result, exc = None, e
+        item = (future, time.monotonic() - start_time, result, exc)
+
+        with self._completed_lock:
+            self._completed.append(item)
+            wake_loop = len(self._completed) == 1
+        if wake_loop:
+            loop.call_soon_threadsafe(self._complete)
+
+    def _complete(self):
+        with self._completed_lock:
+            results = self._completed
+            self._completed = []
+
+        for future, latency, result, exc in results:
+            self._queue_depth -= 1
+            for i, bound in enumerate(DiskIOEngine.LATENCY_BUCKETS):
+                if latency <= bound:
+                    self._latency_histogram[i] += 1
+                    break
+
+            if future.cancelled():
+                continue
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
+class _DescriptorEntry:
+    def __init__(self, fd: int, prepared: bool):
+        self.fd = fd
+        self.prepared = prepared
+        self.mapping = None  # type: Optional[mmap.mmap]
+        self.users = 0
+
+
+class FileDescriptorCache:
+    """Process-wide LRU of open file descriptors shared by all torrents. Files are opened on first access,
+    and the least recently used descriptors are closed when the limit is exceeded. Descriptors that
+    are being used by some operation are never closed.
+
+    Files are created and allocated according to the policy only when they're opened for writing.
+
+    Memory mappings of files are kept in the same LRU. A mapping holds a duplicate of the file descriptor,
+    so a mapped file counts as two descriptors against the limit. A mapping can't be closed while its data is
+    referenced, so such a mapping is kept (and counted) until a later eviction manages to close it."""
+
+    MAX_OPEN_FILES = 512
+
+    _instance = None  # type: Optional[FileDescriptorCache]
+
+    def __init__(self, max_open_files: int):
+        self._max_open_files = max_open_files
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # type: Dict[str, _DescriptorEntry]
+        self._mapping_count = 0
+        self._unclosed_mappings = []  # type: List[mmap.mmap]  # Mappings of closed files with referenced data
+
+    @classmethod
+    def get_instance(cls) -> 'FileDescriptorCache':
+        if cls._instance is None:
+            cls._instance = cls(cls.MAX_OPEN_FILES)
+        return cls._instance
+
+    @classmethod
+    def set_max_open_files(cls, max_open_files: int):
+        if cls._instance is not None:
+            raise RuntimeError("Can't change the limit when the cache is already used")
+        cls.MAX_OPEN_FILES = max_open_files
+
+    @property
+    def open_file_count(self) -> int:
+        return len(self._entries)
+
+    @property
+    def descriptor_count(self) -> int:
+        """Count of descriptors held by open files and their mappings."""
+
+        return len(self._entries) + self._mapping_count
+
+    @staticmethod
+    def _prepare_file(fd: int, length: int, allocation_policy: AllocationPolicy):
+        if allocation_policy == AllocationPolicy.none:
+            return
+
+        size = os.fstat(fd).st_size
+        if size > length or (size < length and
+                             (allocation_policy == AllocationPolicy.sparse or not hasattr(os, 'posix_fallocate'))):
+            os.ftruncate(fd, length)
+        elif size < length:
+            os.posix_fallocate(fd, 0, length)
+
+    def _close_entry(self, path: str):
+        entry = self._entries.pop(path)
+        if entry.mapping is not None:
+            try:
+                entry.mapping.close()
+                self._mapping_count -= 1
+            except BufferError:
+                # Some data is still referenced (e.g. by a transport buffer), the mapping keeps its descriptor
+                # until we manage to close it
+                self._unclosed_mappings.append(entry.mapping)
+        os.close(entry.fd)
+
+    def _close_unclosed_mappings(self):
+        remaining = []
+        for mapping in self._unclosed_mappings:
+            try:
+                mapping.close()
+                self._mapping_count -= 1
+            except BufferError:
+                remaining.append(mapping)
+        self._unclosed_mappings = remaining
+
+    def _close_unused(self, paths: Iterable[str]):
+        for path in paths:
+            if not self._entries[path].users:
+                self._close_entry(path)
+
+    def _evict(self):
+        excess = self.descriptor_count - self._max_open_files
+        if excess > 0 and self._unclosed_mappings:
+            self._close_unclosed_mappings()
+            excess = self.descriptor_count - self._max_open_files
+        if excess <= 0:
+            return
+        for path in [path for path, entry in self._entries.items() if not entry.users]:
+            excess -= 2 if self._entries[path].mapping is not None else 1
+            self._close_entry(path)
+            if excess <= 0:
+                break
+
+    def acquire(self, path: str, length: int, *, for_writing: bool,
+                allocation_policy: AllocationPolicy=AllocationPolicy.sparse) -> Optional[int]:
+        """Returns a descriptor of the file or None if the file doesn't exist and isn't needed for writing.
+        The descriptor must be released after the operation."""
+
+        with self._lock:
+            return self._acquire(path, length, for_writing, allocation_policy)
+
+    def _acquire(self, path: str, length: int, for_writing: bool,
+                 allocation_policy: AllocationPolicy) -> Optional[int]:
+        entry = self._entries.get(path)
+        if entry is None:
+            if for_writing:
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    os.makedirs(os.path.normpath(directory))
+                flags = os.O_RDWR | os.O_CREAT
+            else:
+                flags = os.O_RDWR
+            try:
+                fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o666)
+            except FileNotFoundError:
+                if for_writing:
+                    raise
+                return None
+
+            entry = _DescriptorEntry(fd, False)
+            entry.users += 1
+            self._entries[path] = entry
+            self._evict()
+        else:
+            entry.users += 1
+            self._entries.move_to_end(path)
+
+        if for_writing and not entry.prepared:
+            try:
+                FileDescriptorCache._prepare_file(entry.fd, length, allocation_policy)
+            except OSError:
+                entry.users -= 1
+                raise
+            entry.prepared = True
+        return entry.fd
+
+    def get_mapping(self, path: str) -> Optional[mmap.mmap]:
+        """Returns the mapping of the file if it's already created. It doesn't perform any system calls, so it can
+        be called from the event loop. The mapping must be released after the operation."""
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry.mapping is None:
+                return None
+            entry.users += 1
+            self._entries.move_to_end(path)
+            return entry.mapping
+
+    def acquire_mapping(self, path: str, length: int, *, for_writing: bool,
+                        allocation_policy: AllocationPolicy=AllocationPolicy.sparse) -> Optional[mmap.mmap]:
+        """Returns a mapping of the whole file or None if the file doesn't exist and isn't needed for writing.
+        The mapping must be released after the operation."""
+
+        # A mapping needs a file of the expected length, so the file is prepared as for writing
+        if allocation_policy == AllocationPolicy.none:
+            allocation_policy = AllocationPolicy.sparse
+        with self._lock:
+            if not for_writing and path not in self._entries and not os.path.isfile(path):
+                return None
+            fd = self._acquire(path, length, True, allocation_policy)
+            entry = self._entries[path]
+            if entry.mapping is None:
+                try:
+                    entry.mapping = mmap.mmap(fd, length)
+                except OSError:
+                    entry.users -= 1
+                    raise
+                self._mapping_count += 1
+                self._evict()
+            return entry.mapping
+
+    def release(self, path: str):
+        with self._lock:
+            self._entries[path].users -= 1
+            self._evict()
+
+    def close_files(self, paths: Iterable[str]):
+        with self._lock:
+            self._close_unused([path for path in paths if path in self._entries])
@@ -1,64 +1,257 @@
 import asyncio
 import functools
+import hashlib
+import mmap
 import os
 from bisect import bisect_right
-from typing import Iterable, BinaryIO, Tuple
+from collections import OrderedDict, deque
+from typing import Iterable, Tuple, List, Optional, Union, Dict
 
-from happy_bittorrent.models import DownloadInfo
+from happy_bittorrent.disk_io import DiskIOEngine, FileDescriptorCache, read_at, write_at
+from happy_bittorrent.models import AllocationPolicy, DownloadInfo
 
 
 def delegate_to_executor(func):
     @functools.wraps(func)
-    async def wrapper(self: 'FileStructure', *args, acquire_lock=True, **kwargs):
-        if acquire_lock:
-            await self.lock.acquire()
-        try:
-            return await self._loop.run_in_executor(None, functools.partial(func, self, *args, **kwargs))
-        finally:
-            if acquire_lock:
-                self.lock.release()
+    async def wrapper(self: 'FileStructure', offset: int, length_or_data, acquire_lock=True):
+        length = length_or_data if isinstance(length_or_data, int) else len(length_or_data)
+        pieces = self._get_piece_range(offset, length) if acquire_lock else range(0)
+        async with self._piece_locks.lock(pieces):
+            return await self._io_engine.submit(func, self, offset, length_or_data)
 
     return wrapper
 
 
+class PieceLocks:
+    """Locks for pieces which are being accessed. Pieces of a range are always locked in the ascending order,
+    so coroutines locking overlapping ranges can't deadlock."""
+
+    def __init__(self):
+        self._waiters = {}  # type: Dict[int, Deque[asyncio.Future]]  # Contains only locked pieces
+
+    def try_acquire(self, index: int) -> bool:
+        if index in self._waiters:
+            return False
+        self._waiters[index] = deque()
+        return True
+
+    async def _acquire_piece(self, index: int):
+        if self.try_acquire(index):
+            return
+
+        waiter = asyncio.Future()
+        self._waiters[index].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The lock was handed over to us right before the cancellation
+                self._release_piece(index)
+            raise
+
+    def _release_piece(self, index: int):
+        waiters = self._waiters[index]
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # Hand the lock over to the next coroutine
+                return
+        del self._waiters[index]
+
+    async def acquire(self, indexes: range):
+        acquired = []
+        try:
+            for index in indexes:
+                await self._acquire_piece(index)
+                acquired.append(index)
+        except BaseException:
+            self.release(acquired)
+            raise
+
+    def release(self, indexes: Iterable[int]):
+        for index in indexes:
+            self._release_piece(index)
+
+    def lock(self, indexes: range) -> 'LockedPieces':
+        return LockedPieces(self, indexes)
+
+
+class LockedPieces:
+    def __init__(self, piece_locks: PieceLocks, indexes: range):
+        self._piece_locks = piece_locks
+        self._indexes = indexes
+
+    async def __aenter__(self):
+        await self._piece_locks.acquire(self._indexes)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._piece_locks.release(self._indexes)
+
+
+class PieceHasher:
+    """Calculates SHA1 of a piece buffer while blocks arrive. Data following the hashed prefix is hashed immediately,
+    while out-of-order blocks are remembered as views of the buffer until the gap before them is filled."""
+
+    def __init__(self, buffer: bytearray):
+        self._buffer = buffer
+        self._hash = hashlib.sha1()
+        self._hashed_length = 0
+        self._tails = {}  # type: Dict[int, int]
+
+    @property
+    def hashed_length(self) -> int:
+        return self._hashed_length
+
+    def _consume(self, end: int):
+        if end > self._hashed_length:
+            self._hash.update(memoryview(self._buffer)[self._hashed_length:end])
+            self._hashed_length = end
+
+    def update(self, begin: int, end: int):
+        if end <= self._hashed_length:
+            return
+        if begin > self._hashed_length:
+            self._tails[begin] = max(self._tails.get(begin, 0), end)
+            return
+
+        self._consume(end)
+        while self._tails:
+            tail_begin = min(self._tails)
+            if tail_begin > self._hashed_length:
+                break
+            self._consume(self._tails.pop(tail_begin))
+
+    def received_ranges(self) -> Iterable[Tuple[int, int]]:
+        if self._hashed_length:
+            yield 0, self._hashed_length
+        yield from self._tails.items()
+
+    def digest(self) -> Optional[bytes]:
+        if self._hashed_length < len(self._buffer):
+            return None
+        return self._hash.digest()
+
+
+class FileRegions:
+    """Locations of data in files: tuples (a descriptor or None if the data isn't stored, position in the file,
+    length of data). The descriptors are kept open until release() is called."""
+
+    __slots__ = ('regions', '_descriptor_cache', '_paths')
+
+    def __init__(self, descriptor_cache: FileDescriptorCache, paths: List[str],
+                 regions: List[Tuple[Optional[int], int, int]]):
+        self.regions = regions
+        self._descriptor_cache = descriptor_cache
+        self._paths = paths
+
+    def release(self):
+        for path in self._paths:
+            self._descriptor_cache.release(path)
+        self._paths = []
+
+
 class FileStructure:
-    def __init__(self, download_dir: str, download_info: DownloadInfo):
+    ASSEMBLY_MEMORY_LIMIT = 256 * 2 ** 20
+    _assembly_memory_used = 0  # Shared between all torrents
+
+    READ_CACHE_SIZE = 32 * 2 ** 20
+
+    def __init__(self, download_dir: str, download_info: DownloadInfo, *, use_mmap: bool=False,
+                 allocation_policy: AllocationPolicy=AllocationPolicy.sparse):
         self._download_info = download_info
+        self._allocation_policy = allocation_policy
 
         self._loop = asyncio.get_event_loop()
-        self._lock = asyncio.Lock()
-        self._descriptors = []
+        self._io_engine = DiskIOEngine.get_instance()
+        self._descriptor_cache = FileDescriptorCache.get_instance()
+        self._piece_locks = PieceLocks()
+
+        self._piece_buffers = OrderedDict()  # type: Dict[int, bytearray]
+        self._piece_hashers = {}             # type: Dict[int, PieceHasher]
+        self._spilled_pieces = set()         # type: Set[int]
+
+        self._read_cache = OrderedDict()  # type: Dict[int, Union[bytearray, memoryview]]
+        self._read_cache_size = 0
+        self._pending_piece_reads = {}    # type: Dict[int, asyncio.Task]
+
+        # Files are opened (and created if needed) on first access
+        self._paths = []
+        self._lengths = []
         self._offsets = []
         offset = 0
+        for file in download_info.files:
+            self._paths.append(os.path.join(download_dir, download_info.suggested_name, *file.path))
+            self._lengths.append(file.length)
+            self._offsets.append(offset)
+            offset += file.length
+        self._offsets.append(offset)  # Fake entry for convenience
 
-        try:
-            for file in download_info.files:
-                path = os.path.join(download_dir, download_info.suggested_name, *file.path)
-                directory = os.path.dirname(path)
-                if not os.path.isdir(directory):
-                    os.makedirs(os.path.normpath(directory))
-                if not os.path.isfile(path):
-                    f = open(path, 'w')
-                    f.close()
-
-                f = open(path, 'r+b')
-                f.truncate(file.length)
-
-                self._descriptors.append(f)
-                self._offsets.append(offset)
-                offset += file.length
-        except (OSError, IOError):
-            for f in self._descriptors:
-                f.close()
-            raise
+        # Unselected files aren't created. If a piece overlaps them, the corresponding part of the piece is stored
+        # in a separate "parts" file, which contains a slot of the piece length for every such piece. The selection
+        # may change later, so data is routed according to the selection at the moment of creation, and slots are
+        # reserved for all pieces that may become selected.
+        self._stored_in_files = [file.selected for file in download_info.files]
+        self._part_slots = {}  # type: Dict[int, int]
+        piece_length = download_info.piece_length
+        for file in download_info.files:
+            if file.selected or not file.length:
+                continue
+            for piece_index in self._get_piece_range(file.offset, file.length):
+                piece_offset = piece_index * piece_length
+                if piece_offset < file.offset or \
+                        piece_offset + download_info.get_real_piece_length(piece_index) > file.offset + file.length:
+                    self._part_slots[piece_index] = None
+        self._parts_index = None  # type: Optional[int]
+        if self._part_slots:
+            for slot, piece_index in enumerate(sorted(self._part_slots)):
+                self._part_slots[piece_index] = slot
+            self._parts_index = len(self._paths)
+            self._paths.append(os.path.join(download_dir, '.{}.parts'.format(download_info.info_hash.hex())))
+            self._lengths.append(len(self._part_slots) * piece_length)
 
-        self._offsets.append(offset)  # Fake entry for convenience
+        self._use_mmap = use_mmap
+
+    def _get_piece_range(self, offset: int, length: int) -> range:
+        piece_length = self._download_info.piece_length
+        return range(offset // piece_length, (offset + max(length, 1) - 1) // piece_length + 1)
+
+    def lock_piece(self, piece_index: int) -> LockedPieces:
+        """Returns an asynchronous context manager. While it's entered, no I/O operations involving this piece
+        are performed by other coroutines."""
+
+        return self._piece_locks.lock(range(piece_index, piece_index + 1))
 
     @property
-    def lock(self) -> asyncio.Lock:
-        return self._lock
+    def memory_mapped(self) -> bool:
+        return self._use_mmap
+
+    def _iter_parts(self, index: int, offset: int, data_length: int) -> Iterable[Tuple[Optional[int], int, int]]:
+        """Yields locations of data of a file that wasn't selected when the structure was created."""
+
+        piece_length = self._download_info.piece_length
+        file_start_offset = self._offsets[index]
+        while data_length != 0:
+            piece_index = offset // piece_length
+            piece_pos = offset - piece_index * piece_length
+            bytes_to_operate = min(piece_length - piece_pos, data_length)
+
+            slot = self._part_slots.get(piece_index)
+            if slot is not None:
+                yield self._parts_index, slot * piece_length + piece_pos, bytes_to_operate
+            elif self._download_info.files[index].selected:
+                # The piece lies only in this file, which was selected later, so the file is created
+                yield index, offset - file_start_offset, bytes_to_operate
+            else:
+                # Pieces lying only in unselected files are never downloaded, so their data isn't stored
+                yield None, 0, bytes_to_operate
+
+            offset += bytes_to_operate
+            data_length -= bytes_to_operate
+
+    def _iter_files(self, offset: int, data_length: int) -> Iterable[Tuple[Optional[int], int, int]]:
+        """Yields tuples (index of a file, position in the file, length of data). The index is None
+        if the data isn't stored anywhere."""
 
-    def _iter_files(self, offset: int, data_length: int) -> Iterable[Tuple[BinaryIO, int, int]]:
         if offset < 0 or offset + data_length > self._download_info.total_size:
             raise IndexError('Data position out of range')
 
@@ -71,34 +264,343 @@ class FileStructure:
             file_pos = offset - file_start_offset
             bytes_to_operate = min(file_end_offset - offset, data_length)
 
-            descriptor = self._descriptors[index]
-            yield descriptor, file_pos, bytes_to_operate
+            if bytes_to_operate:
+                if self._stored_in_files[index]:
+                    yield index, file_pos, bytes_to_operate
+                else:
+                    yield from self._iter_parts(index, offset, bytes_to_operate)
 
             offset += bytes_to_operate
             data_length -= bytes_to_operate
             index += 1
 
-    @delegate_to_executor
-    def read(self, offset: int, length: int):
-        result = []
-        for f, file_pos, bytes_to_operate in self._iter_files(offset, length):
-            f.seek(file_pos)
-            result.append(f.read(bytes_to_operate))
-        return b''.join(result)
+    # Positional I/O doesn't change file positions, so independent pieces can be accessed concurrently
 
     @delegate_to_executor
-    def write(self, offset: int, data: memoryview):
-        for f, file_pos, bytes_to_operate in self._iter_files(offset, len(data)):
-            f.seek(file_pos)
-            f.write(data[:bytes_to_operate])
+    def _read_files(self, offset: int, length: int) -> bytearray:
+        result = bytearray(length)
+        view = memoryview(result)
+        for index, file_pos, bytes_to_operate in self._iter_files(offset, length):
+            if index is not None:
+                path = self._paths[index]
+                fd = self._descriptor_cache.acquire(path, self._lengths[index], for_writing=False)
+                if fd is not None:  # Otherwise the file isn't created yet, so the data is considered zero
+                    try:
+                        read_at(fd, view[:bytes_to_operate], file_pos)
+                    finally:
+                        self._descriptor_cache.release(path)
+            view = view[bytes_to_operate:]
+        return result
 
+    @delegate_to_executor
+    def _write_files(self, offset: int, data: memoryview):
+        data = memoryview(data)
+        for index, file_pos, bytes_to_operate in self._iter_files(offset, len(data)):
+            if index is not None:
+                path = self._paths[index]
+                fd = self._descriptor_cache.acquire(path, self._lengths[index], for_writing=True,
+                                                    allocation_policy=self._allocation_policy)
+                try:
+                    write_at(fd, data[:bytes_to_operate], file_pos)
+                finally:
+                    self._descriptor_cache.release(path)
             data = data[bytes_to_operate:]
 
+    async def _acquire_mappings(self, offset: int, length: int, for_writing: bool) -> Dict[int, mmap.mmap]:
+        """Returns mappings of the files (by their indexes) containing the data. Files that don't exist when
+        reading are skipped. The mappings must be released with _release_mappings()."""
+
+        mappings = {}
+        try:
+            for index, _, _ in self._iter_files(offset, length):
+                if index is None or index in mappings:
+                    continue
+                path = self._paths[index]
+                mapping = self._descriptor_cache.get_mapping(path)
+                if mapping is None:
+                    # Opening, creating and allocating the file are blocking calls, so they're made by the I/O engine
+                    mapping = await self._io_engine.submit(functools.partial(
+                        self._descriptor_cache.acquire_mapping, path, self._lengths[index],
+                        for_writing=for_writing, allocation_policy=self._allocation_policy))
+                    if mapping is None:
+                        continue
+                mappings[index] = mapping
+        except BaseException:
+            self._release_mappings(mappings)
+            raise
+        return mappings
+
+    def _release_mappings(self, mappings: Dict[int, mmap.mmap]):
+        for index in mappings:
+            self._descriptor_cache.release(self._paths[index])
+
+    async def _read_mappings(self, offset: int, length: int) -> Union[bytes, memoryview]:
+        mappings = await self._acquire_mappings(offset, length, False)
+        try:
+            views = []
+            for index, file_pos, bytes_to_operate in self._iter_files(offset, length):
+                mapping = mappings.get(index)
+                if mapping is not None:
+                    views.append(memoryview(mapping)[file_pos:file_pos + bytes_to_operate])
+                else:
+                    views.append(bytes(bytes_to_operate))
+        finally:
+            self._release_mappings(mappings)
+        if len(views) == 1:
+            return views[0]  # Zero-copy result, can be passed to a transport as is
+        return b''.join(views)
+
+    async def _write_mappings(self, offset: int, data: memoryview):
+        mappings = await self._acquire_mappings(offset, len(data), True)
+        try:
+            for index, file_pos, bytes_to_operate in self._iter_files(offset, len(data)):
+                if index is not None:
+                    mappings[index][file_pos:file_pos + bytes_to_operate] = data[:bytes_to_operate]
+
+                data = data[bytes_to_operate:]
+        finally:
+            self._release_mappings(mappings)
+
+    async def read(self, offset: int, length: int, *, acquire_lock: bool=True) -> Union[bytearray, memoryview]:
+        if self._use_mmap:
+            # Copying from a mapping can't be interrupted by other coroutines, so we don't need a lock here
+            return await self._read_mappings(offset, length)
+        return await self._read_files(offset, length, acquire_lock=acquire_lock)
+
+    async def write(self, offset: int, data: memoryview, *, acquire_lock: bool=True):
+        if self._use_mmap:
+            await self._write_mappings(offset, data)
+            return
+        await self._write_files(offset, data, acquire_lock=acquire_lock)
+
     @delegate_to_executor
-    def flush(self, offset: int, length: int):
-        for f, _, _ in self._iter_files(offset, length):
-            f.flush()
+    def _flush_mappings(self, offset: int, length: int):
+        for index, _, _ in self._iter_files(offset, length):
+            if index is None:
+                continue
+            path = self._paths[index]
+            mapping = self._descriptor_cache.get_mapping(path)
+            if mapping is not None:  # Otherwise the mapping was closed, so its data was flushed
+                try:
+                    mapping.flush()
+                finally:
+                    self._descriptor_cache.release(path)
+
+    async def flush(self, offset: int, length: int, *, acquire_lock: bool=True):
+        # Data written to descriptors is already passed to the OS, only mappings need to be flushed
+        if self._use_mmap:
+            await self._flush_mappings(offset, length, acquire_lock=acquire_lock)
+
+    def _get_piece_position(self, piece_index: int) -> Tuple[int, int]:
+        return piece_index * self._download_info.piece_length, self._download_info.get_real_piece_length(piece_index)
+
+    def _release_piece_buffer(self, piece_index: int) -> Optional[bytearray]:
+        self._piece_hashers.pop(piece_index, None)
+        buffer = self._piece_buffers.pop(piece_index, None)
+        if buffer is not None:
+            FileStructure._assembly_memory_used -= len(buffer)
+        return buffer
+
+    async def _spill_piece_buffer(self, piece_index: int):
+        # The caller must hold the lock of the piece
+        hasher = self._piece_hashers[piece_index]
+        buffer = self._release_piece_buffer(piece_index)
+        self._spilled_pieces.add(piece_index)
+
+        # Only received data is written, so we don't overwrite blocks written to disk after the spilling
+        piece_offset, _ = self._get_piece_position(piece_index)
+        for begin, end in hasher.received_ranges():
+            await self.write(piece_offset + begin, memoryview(buffer)[begin:end], acquire_lock=False)
+
+    async def _allocate_piece_buffer(self, piece_index: int) -> Optional[bytearray]:
+        if self._download_info.pieces[piece_index].are_any_blocks_downloaded():
+            # Some blocks were written to disk in the previous session, so the rest of the piece is written there too
+            self._spilled_pieces.add(piece_index)
+            return None
+
+        _, piece_length = self._get_piece_position(piece_index)
+        while FileStructure._assembly_memory_used + piece_length > FileStructure.ASSEMBLY_MEMORY_LIMIT:
+            # We don't wait for locks of other pieces here, since we already hold the lock of this piece
+            victim = next((index for index in self._piece_buffers if self._piece_locks.try_acquire(index)), None)
+            if victim is None:
+                break
+            try:
+                await self._spill_piece_buffer(victim)
+            finally:
+                self._piece_locks.release([victim])
+        if FileStructure._assembly_memory_used + piece_length > FileStructure.ASSEMBLY_MEMORY_LIMIT:
+            # Other pieces use all the memory, so blocks of this piece will be written to disk immediately
+            self._spilled_pieces.add(piece_index)
+            return None
+
+        buffer = bytearray(piece_length)
+        self._piece_buffers[piece_index] = buffer
+        self._piece_hashers[piece_index] = PieceHasher(buffer)
+        FileStructure._assembly_memory_used += piece_length
+        return buffer
+
+    async def write_block(self, piece_index: int, block_begin: int, data: memoryview, *, acquire_lock: bool=True):
+        """Blocks are collected in a memory buffer until the piece is committed or discarded. If the memory limit is
+        reached, buffers of the least recently updated pieces are spilled to disk."""
+
+        pieces = range(piece_index, piece_index + 1) if acquire_lock else range(0)
+        async with self._piece_locks.lock(pieces):
+            buffer = self._piece_buffers.get(piece_index)
+            if buffer is None and piece_index not in self._spilled_pieces:
+                buffer = await self._allocate_piece_buffer(piece_index)
+            if buffer is not None:
+                block_end = block_begin + len(data)
+                if block_end > len(buffer):
+                    raise IndexError('Data position out of range')
+
+                # The hashed prefix must stay the same, otherwise we'll commit data that differs from the verified one
+                hasher = self._piece_hashers[piece_index]
+                if block_begin < hasher.hashed_length:
+                    data = data[hasher.hashed_length - block_begin:]
+                    block_begin = hasher.hashed_length
+                if block_begin < block_end:
+                    buffer[block_begin:block_end] = data
+                    hasher.update(block_begin, block_end)
+                self._piece_buffers.move_to_end(piece_index)
+                return
+
+            piece_offset, _ = self._get_piece_position(piece_index)
+            await self.write(piece_offset + block_begin, data, acquire_lock=False)
+
+    async def read_piece(self, piece_index: int) -> Union[bytes, bytearray, memoryview]:
+        if piece_index in self._piece_buffers:
+            return self._piece_buffers[piece_index]
+        return await self.read(*self._get_piece_position(piece_index))
+
+    def _evict_cached_piece(self, piece_index: int):
+        data = self._read_cache.pop(piece_index, None)
+        if data is not None:
+            self._read_cache_size -= len(data)
+
+    async def _load_piece_to_cache(self, piece_index: int) -> Union[bytearray, memoryview]:
+        try:
+            data = await self.read(*self._get_piece_position(piece_index))
+        finally:
+            del self._pending_piece_reads[piece_index]
+
+        statistics = self._download_info.session_statistics
+        while self._read_cache and self._read_cache_size + len(data) > FileStructure.READ_CACHE_SIZE:
+            self._evict_cached_piece(next(iter(self._read_cache)))
+            statistics.read_cache_evictions += 1
+        if len(data) <= FileStructure.READ_CACHE_SIZE:
+            self._read_cache[piece_index] = data
+            self._read_cache_size += len(data)
+        return data
+
+    async def _read_piece_to_cache(self, piece_index: int) -> Union[bytearray, memoryview]:
+        statistics = self._download_info.session_statistics
+        task = self._pending_piece_reads.get(piece_index)
+        if task is not None:
+            # Another peer has already requested a block of this piece
+            statistics.read_cache_hits += 1
+        else:
+            statistics.read_cache_misses += 1
+            # The reading is performed in a separate task, so cancellation of the peer that initiated it
+            # doesn't affect other peers waiting for the same piece
+            task = asyncio.ensure_future(self._load_piece_to_cache(piece_index))
+            self._pending_piece_reads[piece_index] = task
+        return await asyncio.shield(task)
+
+    async def read_block(self, piece_index: int, block_begin: int, length: int) -> Union[bytes, memoryview]:
+        """Peers usually request all blocks of a piece in a row, so we read the whole piece on the first request
+        and serve the following ones from the cache."""
+
+        piece_offset, piece_length = self._get_piece_position(piece_index)
+        if block_begin < 0 or block_begin + length > piece_length:
+            raise IndexError('Data position out of range')
+        if self._use_mmap:
+            return await self._read_mappings(piece_offset + block_begin, length)
+
+        data = self._read_cache.get(piece_index)
+        if data is not None:
+            self._read_cache.move_to_end(piece_index)
+            self._download_info.session_statistics.read_cache_hits += 1
+        else:
+            data = await self._read_piece_to_cache(piece_index)
+        return memoryview(data)[block_begin:block_begin + length]
+
+    def _open_regions(self, offset: int, length: int) -> FileRegions:
+        regions = []
+        paths = []
+        try:
+            for index, file_pos, bytes_to_operate in self._iter_files(offset, length):
+                fd = None
+                if index is not None:
+                    path = self._paths[index]
+                    # If the file isn't created yet, the data is considered zero
+                    fd = self._descriptor_cache.acquire(path, self._lengths[index], for_writing=False)
+                    if fd is not None:
+                        paths.append(path)
+                regions.append((fd, file_pos, bytes_to_operate))
+        except BaseException:
+            for path in paths:
+                self._descriptor_cache.release(path)
+            raise
+        return FileRegions(self._descriptor_cache, paths, regions)
+
+    async def open_block(self, piece_index: int, block_begin: int, length: int) -> FileRegions:
+        """Returns locations of a block in files, so it can be sent with sendfile() without reading. The piece
+        must be already committed to disk."""
+
+        piece_offset, piece_length = self._get_piece_position(piece_index)
+        if block_begin < 0 or block_begin + length > piece_length:
+            raise IndexError('Data position out of range')
+
+        # Opening a file is a blocking call, so it's made by the I/O engine
+        future = self._io_engine.submit(self._open_regions, piece_offset + block_begin, length)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            def release_regions(fut: asyncio.Future):
+                if not fut.cancelled() and fut.exception() is None:
+                    fut.result().release()
+
+            # Nobody will use the descriptors, so they're released as soon as the worker opens them
+            future.add_done_callback(release_regions)
+            raise
+
+    async def hash_piece(self, piece_index: int) -> bytes:
+        hasher = self._piece_hashers.get(piece_index)
+        if hasher is not None:
+            digest = hasher.digest()
+            if digest is not None:
+                return digest
+
+        data = await self.read_piece(piece_index)
+        # hashlib releases the GIL, so hashing of a large piece doesn't block the event loop
+        return await self._loop.run_in_executor(None, lambda: hashlib.sha1(data).digest())
+
+    async def commit_piece(self, piece_index: int):
+        """Writes the verified piece to disk with a single write and flushes it."""
+
+        buffer = self._release_piece_buffer(piece_index)
+        self._spilled_pieces.discard(piece_index)
+        self._evict_cached_piece(piece_index)
+
+        piece_offset, piece_length = self._get_piece_position(piece_index)
+        if buffer is not None:
+            await self.write(piece_offset, memoryview(buffer))
+        await self.flush(piece_offset, piece_length)
+
+    def discard_piece(self, piece_index: int):
+        self._release_piece_buffer(piece_index)
+        self._spilled_pieces.discard(piece_index)
+
+    async def spill_piece_buffers(self):
+        for piece_index in list(self._piece_buffers.keys()):
+            async with self.lock_piece(piece_index):
+                if piece_index in self._piece_buffers:
+                    await self._spill_piece_buffer(piece_index)
 
     def close(self):
-        for f in self._descriptors:
-            f.close()
+        for piece_index in list(self._piece_buffers.keys()):
+            self._release_piece_buffer(piece_index)
+        self._read_cache.clear()
+        self._read_cache_size = 0
+
+        self._descriptor_cache.close_files(self._paths)
@@ -1,18 +1,18 @@
-import asyncio
-import copy
 import hashlib
 import random
 import socket
 import struct
 import time
+from array import array
 from collections import OrderedDict
+from enum import Enum
 from math import ceil
-from typing import List, Set, cast, Optional, Dict, Union, Any, Iterator
+from typing import List, Set, Optional, Dict, Union, Any, Iterator, Iterable, Callable, Sequence, Tuple
 
-import bencodepy
 from bitarray import bitarray
 
-from happy_bittorrent.utils import grouper
+from happy_bittorrent import bencode
+from happy_bittorrent.rate_meter import RateMeter
 
 
 def generate_peer_id():
@@ -49,12 +49,22 @@ class Peer:
     def from_dict(cls, dictionary: OrderedDict):
         return cls(dictionary[b'ip'].decode(), dictionary[b'port'], dictionary.get(b'peer id'))
 
+    COMPACT_FORM_LENGTHS = {6: socket.AF_INET, 18: socket.AF_INET6}
+
     @classmethod
     def from_compact_form(cls, data: bytes):
-        ip, port = struct.unpack('!4sH', data)
-        host = socket.inet_ntoa(ip)
+        """Parses an IPv4 (6 bytes) or IPv6 (18 bytes) address followed by a port."""
+        family = Peer.COMPACT_FORM_LENGTHS.get(len(data))
+        if family is None:
+            raise ValueError('Invalid length of a compact representation of a peer')
+        host = socket.inet_ntop(family, data[:-2])
+        (port,) = struct.unpack('!H', data[-2:])
         return cls(host, port)
 
+    def to_compact_form(self) -> bytes:
+        family = socket.AF_INET6 if ':' in self._host else socket.AF_INET
+        return socket.inet_pton(family, self._host) + struct.pack('!H', self._port)
+
     def __repr__(self):
         return '{}:{}'.format(self._host, self._port)
 
@@ -69,6 +79,8 @@ def get_utf8(dictionary: OrderedDict, key: bytes):
 
 
 class FileInfo:
+    __slots__ = ('_length', '_path', '_md5sum', 'offset', 'selected', 'priority')
+
     def __init__(self, length: int, path: List[str], *, md5sum: str=None):
         self._length = length
         self._path = path
@@ -76,6 +88,16 @@ class FileInfo:
 
         self.offset = None
         self.selected = True
+        self.priority = 0  # Pieces of files with higher priority are downloaded first
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in FileInfo.__slots__}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        # State files of older versions contain objects without some of the fields
+        self.priority = 0
+        for name, value in state.items():
+            setattr(self, name, value)
 
     @property
     def length(self) -> int:
@@ -99,7 +121,61 @@ class FileInfo:
         return cls(dictionary[b'length'], path, md5sum=dictionary.get(b'md5sum'))
 
 
+class RawFileList:
+    """File list of a multi-file torrent kept in the bencoded form until it's needed.
+
+    Only the file count and the total size are found out in advance, so a torrent with lots of files can be
+    added (or restored from the state file) without creating FileInfo objects.
+    """
+
+    _LENGTH_PARSERS = {
+        b'path': bencode.skip_value,
+        b'path.utf-8': bencode.skip_value,
+    }
+
+    def __init__(self, data: bytes, begin: int, end: int, count: int, total_size: int):
+        self._data = data
+        self._begin = begin
+        self._end = end
+        self._count = count
+        self._total_size = total_size
+
+    @staticmethod
+    def _parse_length(data: bytes, pos: int) -> Tuple[int, int]:
+        dictionary, end = bencode.decode_dict(data, pos, RawFileList._LENGTH_PARSERS)
+        length = dictionary.get(b'length')
+        if not isinstance(length, int) or length < 0:
+            raise ValueError('Invalid file length')
+        return length, end
+
+    @classmethod
+    def parse(cls, data: bytes, pos: int) -> Tuple['RawFileList', int]:
+        lengths, end = bencode.decode_list(data, pos, RawFileList._parse_length)
+        return cls(data, pos, end, len(lengths), sum(lengths)), end
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = self._data[self._begin:self._end]
+        state['_begin'] = 0
+        state['_end'] = self._end - self._begin
+        return state
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def total_size(self) -> int:
+        return self._total_size
+
+    def decode(self) -> List[FileInfo]:
+        dictionaries, _ = bencode.decode_value(self._data, self._begin)
+        return list(map(FileInfo.from_dict, dictionaries))
+
+
 class BlockRequest:
+    __slots__ = ('piece_index', 'block_begin', 'block_length')
+
     def __init__(self, piece_index: int, block_begin: int, block_length: int):
         self.piece_index = piece_index
         self.block_begin = block_begin
@@ -108,131 +184,577 @@ class BlockRequest:
     def __eq__(self, other):
         if not isinstance(other, BlockRequest):
             return False
-        return self.__dict__ == other.__dict__
+        return (self.piece_index, self.block_begin, self.block_length) == \
+            (other.piece_index, other.block_begin, other.block_length)
 
     def __hash__(self):
         return hash((self.piece_index, self.block_begin, self.block_length))
 
 
-class BlockRequestFuture(asyncio.Future, BlockRequest):
+class PendingBlockRequest(BlockRequest):
+    """A block we expect to receive. Unlike a future, it doesn't have callbacks: when the block arrives
+    (or the performer rejects the request), the `waiter` (shared by all requests processed by the same downloading
+    task) is woken up."""
+
+    __slots__ = ('performer', 'prev_performers', 'source', 'rejected', 'waiter')
+
     def __init__(self, piece_index: int, block_begin: int, block_length: int):
-        asyncio.Future.__init__(self)
-        BlockRequest.__init__(self, piece_index, block_begin, block_length)
+        super().__init__(piece_index, block_begin, block_length)
+
+        self.performer = None        # type: Optional[Peer]
+        self.prev_performers = None  # type: Optional[Set[Peer]]  # Allocated only on retries
+        self.source = None           # type: Optional[Peer]
+        self.rejected = False
+        self.waiter = None           # type: Optional[asyncio.Future]
 
-        self.prev_performers = set()
-        self.performer = None
+    def done(self) -> bool:
+        return self.source is not None
 
-    __eq__ = asyncio.Future.__eq__
-    __hash__ = asyncio.Future.__hash__
+    def _wake_waiter(self):
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def set_done(self, source: Peer):
+        self.source = source
+        self._wake_waiter()
+
+    def set_rejected(self, performer: Peer):
+        if self.performer != performer or self.done():
+            return  # The request was already passed to another peer
+        self.rejected = True
+        self._wake_waiter()
+
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
 
 
 SHA1_DIGEST_LEN = 20
 
 
-class PieceInfo:
-    def __init__(self, piece_hash: bytes, length: int):
-        self._piece_hash = piece_hash
-        self._length = length
+class PieceProgress:
+    """Run state of a piece that is being downloaded. It's allocated only for such pieces."""
 
-        self.selected = True
-        self.owners = set()  # type: Set[Peer]
+    __slots__ = ('sources', 'block_downloaded', 'blocks_expected')
 
-        self.validating = False
+    def __init__(self):
+        self.sources = set()          # type: Set[Peer]
+        self.block_downloaded = None  # type: Optional[bitarray]
+        self.blocks_expected = {}     # type: Dict[int, PendingBlockRequest]  # Indexed by block_begin
 
-        self._downloaded = None
-        self._sources = None
-        self._block_downloaded = None  # type: Optional[bitarray]
-        self._blocks_expected = None
-        self.reset_content()
 
-    def reset_content(self):
-        self._downloaded = False
-        self._sources = set()
+class PieceAvailability:
+    """Index of pieces owned by connected peers.
+
+    Stores a bitfield of every peer and an array with owner counts of every piece. Counts are updated
+    with the bits that actually changed. Seeds aren't included into the array, they are counted separately,
+    so connecting or disconnecting a seed takes O(1) instead of O(piece count).
+    """
+
+    _ONE = bitarray('1')
+
+    def __init__(self, piece_count: int):
+        self._piece_count = piece_count
+        self._bitfields = {}  # type: Dict[Peer, bitarray]
+        self._seeds = set()   # type: Set[Peer]
+        self._counts = array('I', bytes(array('I').itemsize * piece_count))
+
+        self._listeners = []  # type: List[Callable[[Sequence[int], int], None]]
+
+    @property
+    def counts(self) -> array:
+        """Owner counts of the pieces excluding seeds. The array mustn't be modified directly."""
+        return self._counts
+
+    def add_listener(self, listener: Callable[[Sequence[int], int], None]):
+        """The listener is called with indexes of pieces whose counts were changed by the same delta."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[Sequence[int], int], None]):
+        self._listeners.remove(listener)
+
+    def _notify_listeners(self, indexes: Sequence[int], delta: int):
+        for listener in self._listeners:
+            listener(indexes, delta)
+
+    def add_peer(self, peer: Peer) -> bitarray:
+        """Returns the peer bitfield. It's updated in place and mustn't be modified directly."""
+
+        if peer in self._bitfields:
+            raise ValueError('The peer is already added')
+        bitfield = bitarray(self._piece_count, endian='big')
+        bitfield.setall(False)
+        self._bitfields[peer] = bitfield
+        return bitfield
+
+    def _change_counts(self, pieces: bitarray, delta: int):
+        counts = self._counts
+        indexes = list(pieces.search(PieceAvailability._ONE))
+        for index in indexes:
+            counts[index] += delta
+        if indexes:
+            self._notify_listeners(indexes, delta)
+
+    def add_all_pieces(self, peer: Peer):
+        """Marks the peer as a seed without processing its bitfield (e.g. on the `have_all` message)."""
+
+        if peer in self._seeds:
+            return
+        bitfield = self._bitfields[peer]
+        if bitfield.any():
+            self._change_counts(bitfield, -1)
+        bitfield.setall(True)
+        self._seeds.add(peer)
+
+    def _check_seed(self, peer: Peer):
+        bitfield = self._bitfields[peer]
+        if bitfield.all():
+            self._change_counts(bitfield, -1)
+            self._seeds.add(peer)
+
+    def remove_peer(self, peer: Peer):
+        bitfield = self._bitfields.pop(peer, None)
+        if bitfield is None:
+            return
+        if peer in self._seeds:
+            self._seeds.remove(peer)
+        else:
+            self._change_counts(bitfield, -1)
+
+    def add_pieces(self, peer: Peer, pieces: bitarray):
+        bitfield = self._bitfields[peer]
+        if peer in self._seeds:
+            return
+
+        if bitfield.any():
+            added = pieces & ~bitfield
+            bitfield |= added
+        else:
+            added = pieces
+            bitfield |= pieces
+        if added.all():
+            self._seeds.add(peer)  # Counts weren't changed yet
+        else:
+            self._change_counts(added, 1)
+            self._check_seed(peer)
+
+    def add_piece(self, peer: Peer, index: int) -> bool:
+        """Returns True if the piece wasn't known to be owned by the peer before."""
+
+        bitfield = self._bitfields[peer]
+        if bitfield[index]:
+            return False
+        bitfield[index] = True
+        self._counts[index] += 1
+        self._notify_listeners((index,), 1)
+        self._check_seed(peer)
+        return True
+
+    def get_bitfield(self, peer: Peer) -> bitarray:
+        return self._bitfields[peer]
+
+    def has_piece(self, peer: Peer, index: int) -> bool:
+        bitfield = self._bitfields.get(peer)
+        return bitfield is not None and bool(bitfield[index])
+
+    def has_any(self, peer: Peer, pieces: bitarray) -> bool:
+        if peer in self._seeds:
+            return pieces.any()
+        return (self._bitfields[peer] & pieces).any()
+
+    def is_seed(self, peer: Peer) -> bool:
+        return peer in self._seeds
+
+    def get_count(self, index: int) -> int:
+        return self._counts[index] + len(self._seeds)
+
+    def get_owners(self, index: int) -> Set[Peer]:
+        return {peer for peer, bitfield in self._bitfields.items() if bitfield[index]}
+
+    def get_union(self, peers: Iterable[Peer]) -> bitarray:
+        """Returns a bitmap of pieces owned by at least one of the peers."""
+
+        result = bitarray(self._piece_count, endian='big')
+        result.setall(False)
+        for peer in peers:
+            if peer in self._seeds:
+                result.setall(True)
+                break
+            result |= self._bitfields[peer]
+        return result
+
+
+class PieceTable:
+    """Columnar table of piece states.
+
+    Flags are stored in bitarrays (with the same bit order as in the `bitfield` message), hashes are stored
+    in a single contiguous buffer. PieceInfo objects returned by indexing the table are lightweight views.
+    """
+
+    def __init__(self, piece_hashes: bytes, piece_length: int, last_piece_length: int):
+        self._piece_hashes = piece_hashes
+        self._piece_count = len(piece_hashes) // SHA1_DIGEST_LEN
+        self._piece_length = piece_length
+        self._last_piece_length = last_piece_length
+
+        self._selected = PieceTable._create_bitmap(self._piece_count, True)
+        self._downloaded = PieceTable._create_bitmap(self._piece_count, False)
+        self._selected_count = self._piece_count
+        self._downloaded_count = 0
 
-        self._block_downloaded = None
-        self._blocks_expected = set()
+        self._needed = None          # type: bitarray
+        self._bitfield_cache = None  # type: Optional[bytes]
+        self._update_needed()
+
+        self._validating = None    # type: bitarray
+        self._availability = None  # type: PieceAvailability
+        self._progress = None      # type: Dict[int, PieceProgress]
+        self.reset_run_state()
+
+    @classmethod
+    def from_legacy_pieces(cls, pieces: List['PieceInfo'], piece_length: int) -> 'PieceTable':
+        """Creates a table from PieceInfo objects restored from a state file of an older version."""
+
+        states = [info.legacy_state for info in pieces]
+        result = cls(b''.join(state['_piece_hash'] for state in states), piece_length, states[-1]['_length'])
+        for index, state in enumerate(states):
+            result._selected[index] = state['selected']
+            if state['_downloaded']:
+                result._downloaded[index] = True
+            elif state['_block_downloaded'] is not None and state['_block_downloaded'].any():
+                progress = result._progress[index] = PieceProgress()
+                progress.block_downloaded = state['_block_downloaded']
+        result._selected_count = result._selected.count()
+        result._downloaded_count = result._downloaded.count()
+        result._update_needed()
+        return result
+
+    @staticmethod
+    def _create_bitmap(length: int, value: bool) -> bitarray:
+        result = bitarray(length, endian='big')
+        result.setall(value)
+        return result
 
     def reset_run_state(self):
-        self.owners = set()
+        self._validating = PieceTable._create_bitmap(self._piece_count, False)
+        self._availability = PieceAvailability(self._piece_count)
+
+        progress = {}
+        for index, item in (self._progress or {}).items():
+            if item.block_downloaded is not None and item.block_downloaded.any():
+                item.blocks_expected = {}
+                progress[index] = item
+        self._progress = progress
+
+    def _update_needed(self):
+        self._needed = self._selected & ~self._downloaded
+        self._bitfield_cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_piece_hashes'] = bytes(self._piece_hashes)
+        del state['_needed']
+        del state['_bitfield_cache']
+        del state['_validating']
+        del state['_availability']
+
+        # Only the blocks already downloaded are kept, so the rest of these pieces can be downloaded after a restart
+        del state['_progress']
+        state['_block_downloaded'] = {index: item.block_downloaded for index, item in self._progress.items()
+                                      if item.block_downloaded is not None and item.block_downloaded.any()}
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        block_downloaded = state.pop('_block_downloaded', {})
+        self.__dict__.update(state)
+        self._update_needed()
+
+        self._progress = {}
+        for index, arr in block_downloaded.items():
+            item = self._progress[index] = PieceProgress()
+            item.block_downloaded = arr
+        self.reset_run_state()
+
+    def __len__(self) -> int:
+        return self._piece_count
+
+    def __getitem__(self, index: int) -> 'PieceInfo':
+        if index < 0:
+            index += self._piece_count
+        if not 0 <= index < self._piece_count:
+            raise IndexError('Piece index out of range')
+        return PieceInfo(self, index)
+
+    def __iter__(self) -> Iterator['PieceInfo']:
+        return (PieceInfo(self, index) for index in range(self._piece_count))
+
+    def get_piece_hash(self, index: int) -> bytes:
+        return bytes(self._piece_hashes[index * SHA1_DIGEST_LEN:(index + 1) * SHA1_DIGEST_LEN])
+
+    def get_piece_length(self, index: int) -> int:
+        return self._last_piece_length if index == self._piece_count - 1 else self._piece_length
+
+    @property
+    def piece_hashes(self) -> Union[bytes, memoryview]:
+        return self._piece_hashes
+
+    @property
+    def selected_count(self) -> int:
+        return self._selected_count
+
+    @property
+    def downloaded_count(self) -> int:
+        return self._downloaded_count
+
+    @property
+    def selected_bitmap(self) -> bitarray:
+        """The bitmap mustn't be modified directly."""
+        return self._selected
+
+    @property
+    def downloaded_bitmap(self) -> bitarray:
+        """The bitmap mustn't be modified directly."""
+        return self._downloaded
+
+    def _get_size(self, piece_count: int, bitmap: bitarray) -> int:
+        result = piece_count * self._piece_length
+        if bitmap[-1]:
+            result += self._last_piece_length - self._piece_length
+        return result
+
+    @property
+    def selected_size(self) -> int:
+        return self._get_size(self._selected_count, self._selected)
+
+    @property
+    def downloaded_size(self) -> int:
+        return self._get_size(self._downloaded_count, self._downloaded)
+
+    @property
+    def needed_bitmap(self) -> bitarray:
+        """Bitmap of selected pieces that aren't downloaded yet. The bitmap mustn't be modified directly."""
+        return self._needed
+
+    def get_non_finished_bitmap(self) -> bitarray:
+        return bitarray(self._needed, endian='big')
+
+    def get_bitfield_payload(self) -> bytes:
+        """Returns the payload of the `bitfield` message. It's cached until the set of downloaded pieces changes."""
+
+        if self._bitfield_cache is None:
+            self._bitfield_cache = self._downloaded.tobytes()
+        return self._bitfield_cache
+
+    def set_selected(self, index: int, value: bool):
+        if self._selected[index] != value:
+            self._selected[index] = value
+            self._selected_count += 1 if value else -1
+            self._needed[index] = value and not self._downloaded[index]
+
+    def set_all_selected(self, value: bool):
+        self._selected.setall(value)
+        self._selected_count = self._piece_count if value else 0
+        self._update_needed()
+
+    def set_downloaded_pieces(self, bitmap: bitarray):
+        self._downloaded = bitarray(bitmap, endian='big')
+        self._downloaded_count = self._downloaded.count()
+        self._update_needed()
+        for index in [index for index in self._progress if self._downloaded[index]]:
+            del self._progress[index]
+
+    def is_validating(self, index: int) -> bool:
+        return bool(self._validating[index])
+
+    def set_validating(self, index: int, value: bool):
+        self._validating[index] = value
+
+    @property
+    def availability(self) -> PieceAvailability:
+        return self._availability
+
+    def get_progress(self, index: int, create: bool) -> Optional[PieceProgress]:
+        result = self._progress.get(index)
+        if result is None and create:
+            result = self._progress[index] = PieceProgress()
+        return result
+
+    def mark_as_downloaded(self, index: int):
+        if self._downloaded[index]:
+            raise ValueError('The piece is already downloaded')
+
+        self._downloaded[index] = True
+        self._downloaded_count += 1
+        self._needed[index] = False
+        self._bitfield_cache = None
+
+        # Delete data structures for this piece to save memory
+        self._progress.pop(index, None)
+
+    def reset_content(self, index: int):
+        if self._downloaded[index]:
+            self._downloaded[index] = False
+            self._downloaded_count -= 1
+            self._needed[index] = self._selected[index]
+            self._bitfield_cache = None
+        self._progress.pop(index, None)
 
-        self.validating = False
 
-        self._blocks_expected = set()
+class PieceInfo:
+    """A view of a piece in PieceTable."""
+
+    __slots__ = ('_table', '_index', '_legacy_state')
+
+    def __init__(self, table: PieceTable, index: int):
+        self._table = table
+        self._index = index
+
+    def __setstate__(self, state: Dict[str, Any]):
+        # Views aren't pickled, so the state comes from a state file of an older version, where every piece was
+        # a separate object. DownloadInfo.__setstate__ moves such pieces into a PieceTable.
+        self._legacy_state = state
+
+    @property
+    def legacy_state(self) -> Dict[str, Any]:
+        return self._legacy_state
+
+    @property
+    def index(self) -> int:
+        return self._index
 
     @property
     def piece_hash(self) -> bytes:
-        return self._piece_hash
+        return self._table.get_piece_hash(self._index)
 
     @property
     def length(self) -> int:
-        return self._length
+        return self._table.get_piece_length(self._index)
+
+    @property
+    def selected(self) -> bool:
+        return bool(self._table.selected_bitmap[self._index])
+
+    @selected.setter
+    def selected(self, value: bool):
+        self._table.set_selected(self._index, value)
+
+    @property
+    def validating(self) -> bool:
+        return self._table.is_validating(self._index)
+
+    @validating.setter
+    def validating(self, value: bool):
+        self._table.set_validating(self._index, value)
+
+    @property
+    def owners(self) -> Set[Peer]:
+        return self._table.availability.get_owners(self._index)
+
+    def reset_content(self):
+        self._table.reset_content(self._index)
 
     @property
     def downloaded(self) -> bool:
-        return self._downloaded
+        return bool(self._table.downloaded_bitmap[self._index])
 
     @property
-    def sources(self) -> Set[Peer]:
-        return self._sources
+    def sources(self) -> Optional[Set[Peer]]:
+        if self.downloaded:
+            return None
+        progress = self._table.get_progress(self._index, False)
+        return progress.sources if progress is not None else set()
 
     @property
-    def blocks_expected(self) -> Optional[Set[BlockRequestFuture]]:
-        return self._blocks_expected
+    def blocks_expected(self) -> Optional[Dict[int, PendingBlockRequest]]:
+        if self.downloaded:
+            return None
+        return self._table.get_progress(self._index, True).blocks_expected
+
+    def mark_rejected_block(self, performer: Peer, request: BlockRequest):
+        if self.downloaded:
+            return
+        progress = self._table.get_progress(self._index, False)
+        if progress is None:
+            return
+        expected = progress.blocks_expected.get(request.block_begin)
+        if expected is not None and expected.block_length == request.block_length:
+            expected.set_rejected(performer)
 
     def mark_downloaded_blocks(self, source: Peer, request: BlockRequest):
-        if self._downloaded:
+        if self.downloaded:
             raise ValueError('The whole piece is already downloaded')
 
-        self._sources.add(source)
+        progress = self._table.get_progress(self._index, True)
+        progress.sources.add(source)
 
-        arr = self._block_downloaded
+        length = self.length
+        arr = progress.block_downloaded
         if arr is None:
-            arr = bitarray(ceil(self._length / DownloadInfo.MARKED_BLOCK_SIZE))
+            arr = bitarray(ceil(length / DownloadInfo.MARKED_BLOCK_SIZE))
             arr.setall(False)
-            self._block_downloaded = arr
+            progress.block_downloaded = arr
 
         mark_begin = ceil(request.block_begin / DownloadInfo.MARKED_BLOCK_SIZE)
-        if request.block_begin + request.block_length == self._length:
+        if request.block_begin + request.block_length == length:
             mark_end = len(arr)
         else:
             mark_end = (request.block_begin + request.block_length) // DownloadInfo.MARKED_BLOCK_SIZE
         arr[mark_begin:mark_end] = True
 
-        blocks_expected = cast(Set[BlockRequestFuture], self._blocks_expected)
+        blocks_expected = progress.blocks_expected
+        expected = blocks_expected.get(request.block_begin)
+        if expected is not None and expected.block_length == request.block_length:
+            # Usual case: the block matches our request exactly
+            del blocks_expected[request.block_begin]
+            expected.set_done(source)
+            return
+
+        # The block has an unusual position or length, so it may complete (or partially cover) several requests
         downloaded_blocks = []
-        for fut in blocks_expected:
-            query_begin = fut.block_begin // DownloadInfo.MARKED_BLOCK_SIZE
-            query_end = ceil((fut.block_begin + fut.block_length) / DownloadInfo.MARKED_BLOCK_SIZE)
+        for expected in blocks_expected.values():
+            query_begin = expected.block_begin // DownloadInfo.MARKED_BLOCK_SIZE
+            query_end = ceil((expected.block_begin + expected.block_length) / DownloadInfo.MARKED_BLOCK_SIZE)
             if arr[query_begin:query_end].all():
-                downloaded_blocks.append(fut)
-                fut.set_result(source)
-        for fut in downloaded_blocks:
-            blocks_expected.remove(fut)
+                downloaded_blocks.append(expected)
+        for expected in downloaded_blocks:
+            del blocks_expected[expected.block_begin]
+            expected.set_done(source)
 
-    def are_all_blocks_downloaded(self) -> bool:
-        return self._downloaded or (self._block_downloaded is not None and self._block_downloaded.all())
+    def _get_block_downloaded(self) -> Optional[bitarray]:
+        progress = self._table.get_progress(self._index, False)
+        return progress.block_downloaded if progress is not None else None
 
-    def mark_as_downloaded(self):
-        if self._downloaded:
-            raise ValueError('The piece is already downloaded')
+    def are_any_blocks_downloaded(self) -> bool:
+        if self.downloaded:
+            return True
+        arr = self._get_block_downloaded()
+        return arr is not None and arr.any()
 
-        self._downloaded = True
+    def are_all_blocks_downloaded(self) -> bool:
+        if self.downloaded:
+            return True
+        arr = self._get_block_downloaded()
+        return arr is not None and arr.all()
 
-        # Delete data structures for this piece to save memory
-        self._sources = None
-        self._block_downloaded = None
-        self._blocks_expected = None
+    def mark_as_downloaded(self):
+        self._table.mark_as_downloaded(self._index)
 
 
 class SessionStatistics:
     def __init__(self, prev_session_stats: Optional['SessionStatistics']):
         self.peer_count = 0
-        self._peer_last_download = {}
-        self._peer_last_upload = {}
         self._downloaded_per_session = 0
         self._uploaded_per_session = 0
-        self.download_speed = None  # type: Optional[float]
-        self.upload_speed = None    # type: Optional[float]
+
+        self._download_meter = RateMeter()
+        self._upload_meter = RateMeter()
+        self._peer_download_meters = {}  # type: Dict[Peer, RateMeter]
+        self._peer_upload_meters = {}    # type: Dict[Peer, RateMeter]
+        self._last_update = None  # type: Optional[float]
+
+        self.read_cache_hits = 0
+        self.read_cache_misses = 0
+        self.read_cache_evictions = 0
 
         if prev_session_stats is not None:
             self._total_downloaded = prev_session_stats.total_downloaded
@@ -241,14 +763,6 @@ class SessionStatistics:
             self._total_downloaded = 0
             self._total_uploaded = 0
 
-    @property
-    def peer_last_download(self) -> Dict[Peer, float]:
-        return self._peer_last_download
-
-    @property
-    def peer_last_upload(self) -> Dict[Peer, float]:
-        return self._peer_last_upload
-
     @property
     def downloaded_per_session(self) -> int:
         return self._downloaded_per_session
@@ -257,20 +771,52 @@ class SessionStatistics:
     def uploaded_per_session(self) -> int:
         return self._uploaded_per_session
 
-    PEER_CONSIDERATION_TIME = 10
+    def update_rates(self):
+        """Recalculates average rates of the torrent and its peers. Should be called periodically."""
+
+        now = time.monotonic()
+        self._download_meter.update(now)
+        self._upload_meter.update(now)
+        for meter in self._peer_download_meters.values():
+            meter.update(now)
+        for meter in self._peer_upload_meters.values():
+            meter.update(now)
+        self._last_update = now
+
+    @property
+    def download_speed(self) -> Optional[float]:
+        return self._download_meter.rate if self._download_meter.measured else None
+
+    @property
+    def upload_speed(self) -> Optional[float]:
+        return self._upload_meter.rate if self._upload_meter.measured else None
 
     @staticmethod
-    def _get_actual_peer_count(time_dict: Dict[Peer, float]) -> int:
-        cur_time = time.time()
-        return sum(1 for t in time_dict.values() if cur_time - t <= SessionStatistics.PEER_CONSIDERATION_TIME)
+    def _get_peer_rate(meters: Dict[Peer, RateMeter], peer: Peer) -> float:
+        meter = meters.get(peer)
+        return meter.rate if meter is not None else 0.0
+
+    def get_peer_download_rate(self, peer: Peer) -> float:
+        return SessionStatistics._get_peer_rate(self._peer_download_meters, peer)
+
+    def get_peer_upload_rate(self, peer: Peer) -> float:
+        return SessionStatistics._get_peer_rate(self._peer_upload_meters, peer)
+
+    PEER_CONSIDERATION_TIME = 10
+
+    def _get_actual_peer_count(self, meters: Dict[Peer, RateMeter]) -> int:
+        if self._last_update is None:
+            return 0
+        return sum(1 for meter in meters.values()
+                   if meter.is_active(self._last_update, SessionStatistics.PEER_CONSIDERATION_TIME))
 
     @property
     def downloading_peer_count(self) -> int:
-        return SessionStatistics._get_actual_peer_count(self._peer_last_download)
+        return self._get_actual_peer_count(self._peer_download_meters)
 
     @property
     def uploading_peer_count(self) -> int:
-        return SessionStatistics._get_actual_peer_count(self._peer_last_upload)
+        return self._get_actual_peer_count(self._peer_upload_meters)
 
     @property
     def total_downloaded(self) -> int:
@@ -280,16 +826,34 @@ class SessionStatistics:
     def total_uploaded(self) -> int:
         return self._total_uploaded
 
+    def _create_peer_meter(self, meters: Dict[Peer, RateMeter], peer: Peer) -> RateMeter:
+        # The data is accounted since the last update, otherwise the first interval may be too short
+        meter = RateMeter(now=self._last_update)
+        meters[peer] = meter
+        return meter
+
     def add_downloaded(self, peer: Peer, size: int):
-        self._peer_last_download[peer] = time.time()
+        meter = self._peer_download_meters.get(peer)
+        if meter is None:
+            meter = self._create_peer_meter(self._peer_download_meters, peer)
+        meter.add(size)
+        self._download_meter.add(size)
         self._downloaded_per_session += size
         self._total_downloaded += size
 
     def add_uploaded(self, peer: Peer, size: int):
-        self._peer_last_upload[peer] = time.time()
+        meter = self._peer_upload_meters.get(peer)
+        if meter is None:
+            meter = self._create_peer_meter(self._peer_upload_meters, peer)
+        meter.add(size)
+        self._upload_meter.add(size)
         self._uploaded_per_session += size
         self._total_uploaded += size
 
+    def remove_peer(self, peer: Peer):
+        self._peer_download_meters.pop(peer, None)
+        self._peer_upload_meters.pop(peer, None)
+
 
 FileTreeNode = Union[FileInfo, Dict[str, Any]]
 
@@ -298,45 +862,104 @@ class DownloadInfo:
     MARKED_BLOCK_SIZE = 2 ** 10
 
     def __init__(self, info_hash: bytes,
-                 piece_length: int, piece_hashes: List[bytes], suggested_name: str, files: List[FileInfo], *,
+                 piece_length: int, piece_hashes: Union[bytes, memoryview], suggested_name: str,
+                 files: Union[List[FileInfo], RawFileList], *,
                  private: bool=False):
         self.info_hash = info_hash
         self.piece_length = piece_length
         self.suggested_name = suggested_name
 
-        self.files = files
-        self._file_tree = {}
-        self._create_file_tree()
+        # The file list and the file tree are built on the first access
+        self._files = None  # type: Optional[List[FileInfo]]
+        self._raw_files = None  # type: Optional[RawFileList]
+        if isinstance(files, RawFileList):
+            self._raw_files = files
+            self._file_count = files.count
+            self._total_size = files.total_size
+            self._single_file_mode = False
+        else:
+            self._set_files(files)
+            self._file_count = len(files)
+            self._total_size = sum(file.length for file in files)
+            self._single_file_mode = len(files) == 1 and not files[0].path
+        self._file_tree = None  # type: Optional[FileTreeNode]
+        self._selected_file_count = self._file_count
 
         self.private = private
 
-        assert piece_hashes
-        self._pieces = [PieceInfo(item, piece_length) for item in piece_hashes[:-1]]
-        last_piece_length = self.total_size - (len(piece_hashes) - 1) * self.piece_length
-        self._pieces.append(PieceInfo(piece_hashes[-1], last_piece_length))
-
-        piece_count = len(piece_hashes)
+        if not piece_hashes or len(piece_hashes) % SHA1_DIGEST_LEN != 0:
+            raise ValueError('Invalid length of "pieces" string')
+        piece_count = len(piece_hashes) // SHA1_DIGEST_LEN
         if ceil(self.total_size / piece_length) != piece_count:
             raise ValueError('Invalid count of piece hashes')
 
+        last_piece_length = self.total_size - (piece_count - 1) * piece_length
+        self._pieces = PieceTable(piece_hashes, piece_length, last_piece_length)
+
         self._interesting_pieces = None
-        self.downloaded_piece_count = 0
         self._complete = False
 
         self._host_distrust_rates = {}
 
         self._session_statistics = SessionStatistics(None)
 
+        self._selection_listeners = []  # type: List[Callable[[], None]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_interesting_pieces'] = None
+        state['_file_tree'] = None
+        del state['_selection_listeners']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._selection_listeners = []
+        if isinstance(self._pieces, list):
+            self._convert_legacy_state()
+
+    def _convert_legacy_state(self):
+        """Converts the state restored from a state file of an older version."""
+
+        files = self.__dict__.pop('files')
+        del self.__dict__['downloaded_piece_count']
+        self._raw_files = None
+        self._set_files(files)
+        self._file_count = len(files)
+        self._total_size = sum(file.length for file in files)
+        self._single_file_mode = len(files) == 1 and not files[0].path
+        self._file_tree = None
+        self._selected_file_count = sum(1 for info in files if info.selected)
+
+        self._pieces = PieceTable.from_legacy_pieces(self._pieces, self.piece_length)
+        self._interesting_pieces = None
+        self._session_statistics = SessionStatistics(self._session_statistics)
+
     @property
     def single_file_mode(self) -> bool:
-        return len(self.files) == 1 and not self.files[0].path
+        return self._single_file_mode
 
-    def _create_file_tree(self):
+    def _set_files(self, files: List[FileInfo]):
         offset = 0
-        for item in self.files:
+        for item in files:
             item.offset = offset
             offset += item.length
+        self._files = files
+
+    @property
+    def files(self) -> List[FileInfo]:
+        if self._files is None:
+            self._set_files(self._raw_files.decode())
+            self._raw_files = None
+        return self._files
 
+    @property
+    def file_count(self) -> int:
+        return self._file_count
+
+    def _create_file_tree(self):
+        self._file_tree = {}
+        for item in self.files:
             if not item.path:
                 self._file_tree = item
             else:
@@ -347,10 +970,12 @@ class DownloadInfo:
 
     @property
     def file_tree(self) -> FileTreeNode:
+        if self._file_tree is None:
+            self._create_file_tree()
         return self._file_tree
 
     def _get_file_tree_node(self, path: List[str]) -> FileTreeNode:
-        result = self._file_tree
+        result = self.file_tree
         try:
             for elem in path:
                 result = result[elem]
@@ -371,8 +996,7 @@ class DownloadInfo:
             raise ValueError('Invalid mode "{}"'.format(mode))
         include_paths = (mode == 'whitelist')
 
-        for info in self.pieces:
-            info.selected = not include_paths
+        self._pieces.set_all_selected(not include_paths)
         for info in self.files:
             info.selected = not include_paths
 
@@ -381,7 +1005,7 @@ class DownloadInfo:
             for node in DownloadInfo._traverse_nodes(self._get_file_tree_node(path)):
                 node.selected = include_paths
                 segments.append((node.offset, node.length))
-        if (include_paths and not segments) or (not include_paths and len(segments) == len(self.files)):
+        if (include_paths and not segments) or (not include_paths and len(segments) == self._file_count):
             raise ValueError("Can't exclude all files from the torrent")
 
         segments.sort()
@@ -405,63 +1029,140 @@ class DownloadInfo:
             for index in range(piece_begin, piece_end):
                 self.pieces[index].selected = include_paths
 
+        self._selected_file_count = sum(1 for info in self.files if info.selected)
+        self._notify_selection_listeners()
+
+    def set_file_priority(self, paths: List[List[str]], priority: int):
+        for path in paths:
+            for node in DownloadInfo._traverse_nodes(self._get_file_tree_node(path)):
+                node.priority = priority
+        self._notify_selection_listeners()
+
+    def add_selection_listener(self, listener: Callable[[], None]):
+        """The listener is called when selected files or file priorities are changed."""
+        self._selection_listeners.append(listener)
+
+    def remove_selection_listener(self, listener: Callable[[], None]):
+        self._selection_listeners.remove(listener)
+
+    def _notify_selection_listeners(self):
+        for listener in self._selection_listeners:
+            listener()
+
+    def get_piece_priorities(self) -> List[Tuple[int, bitarray]]:
+        """Returns bitmaps of pieces for each used file priority (starting from the highest one).
+        A piece gets the highest priority among the files it overlaps."""
+
+        result = []
+        assigned = bitarray(self.piece_count, endian='big')
+        assigned.setall(False)
+        for priority in sorted({info.priority for info in self.files}, reverse=True):
+            bitmap = bitarray(self.piece_count, endian='big')
+            bitmap.setall(False)
+            for info in self.files:
+                if info.priority == priority and info.length:
+                    piece_begin = info.offset // self.piece_length
+                    piece_end = ceil((info.offset + info.length) / self.piece_length)
+                    bitmap[piece_begin:piece_end] = True
+            bitmap &= ~assigned
+            assigned |= bitmap
+            result.append((priority, bitmap))
+        return result
+
     def reset_run_state(self):
-        self._pieces = [copy.copy(info) for info in self._pieces]
-        for info in self._pieces:
-            info.reset_run_state()
+        self._pieces.reset_run_state()
+
+        self._interesting_pieces = bitarray(self.piece_count, endian='big')
+        self._interesting_pieces.setall(False)
+
+    def get_downloaded_bitmap(self) -> bitarray:
+        return bitarray(self._pieces.downloaded_bitmap, endian='big')
 
-        self._interesting_pieces = set()
+    def set_downloaded_pieces(self, bitmap: bitarray):
+        self._pieces.set_downloaded_pieces(bitmap)
+        self._complete = self.all_selected_downloaded()
+
+    def all_selected_downloaded(self) -> bool:
+        return not self._pieces.needed_bitmap.any()
 
     def reset_stats(self):
         self._session_statistics = SessionStatistics(self._session_statistics)
 
+    _INFO_PARSERS = {
+        b'pieces': bencode.decode_string_view,
+        b'files': RawFileList.parse,
+    }
+
     @classmethod
-    def from_dict(cls, dictionary: OrderedDict):
-        info_hash = hashlib.sha1(bencodepy.encode(dictionary)).digest()
+    def parse(cls, data: bytes, pos: int) -> Tuple['DownloadInfo', int]:
+        """Creates an object from the bencoded `info` dictionary starting at `pos`.
 
-        if len(dictionary[b'pieces']) % SHA1_DIGEST_LEN != 0:
-            raise ValueError('Invalid length of "pieces" string')
-        piece_hashes = grouper(dictionary[b'pieces'], SHA1_DIGEST_LEN)
+        The info hash is calculated over the original bytes, piece hashes are kept as a view of `data`,
+        the file list is decoded on demand.
+        """
+
+        dictionary, end = bencode.decode_dict(data, pos, DownloadInfo._INFO_PARSERS)
+        info_hash = hashlib.sha1(memoryview(data)[pos:end]).digest()
 
         if b'files' in dictionary:
-            files = list(map(FileInfo.from_dict, dictionary[b'files']))
+            files = dictionary[b'files']
         else:
             files = [FileInfo.from_dict(dictionary)]
 
-        return cls(info_hash,
-                   dictionary[b'piece length'], piece_hashes, get_utf8(dictionary, b'name').decode(), files,
-                   private=dictionary.get('private', False))
+        download_info = cls(info_hash,
+                            dictionary[b'piece length'], dictionary[b'pieces'],
+                            get_utf8(dictionary, b'name').decode(), files,
+                            private=bool(dictionary.get(b'private', False)))
+        return download_info, end
 
     @property
-    def pieces(self) -> List[PieceInfo]:
+    def pieces(self) -> PieceTable:
         return self._pieces
 
     @property
     def piece_count(self) -> int:
         return len(self._pieces)
 
+    @property
+    def selected_piece_count(self) -> int:
+        return self._pieces.selected_count
+
+    @property
+    def downloaded_piece_count(self) -> int:
+        return self._pieces.downloaded_count
+
     def get_real_piece_length(self, index: int) -> int:
-        if index == self.piece_count - 1:
-            return self.total_size - self.piece_length * (self.piece_count - 1)
-        else:
-            return self.piece_length
+        return self._pieces.get_piece_length(index)
 
     @property
     def total_size(self) -> int:
-        return sum(file.length for file in self.files)
+        return self._total_size
+
+    @property
+    def selected_file_count(self) -> int:
+        return self._selected_file_count
+
+    @property
+    def selected_size(self) -> int:
+        return self._pieces.selected_size
+
+    @property
+    def downloaded_size(self) -> int:
+        return self._pieces.downloaded_size
 
     @property
     def bytes_left(self) -> int:
-        result = (self.piece_count - self.downloaded_piece_count) * self.piece_length
-        last_piece_index = self.piece_count - 1
-        if not self._pieces[last_piece_index].downloaded:
-            result += self._pieces[last_piece_index].length - self.piece_length
-        return result
+        return self._total_size - self._pieces.downloaded_size
 
     @property
-    def interesting_pieces(self) -> Set[int]:
+    def interesting_pieces(self) -> bitarray:
+        """Bitmap of pieces being downloaded now."""
         return self._interesting_pieces
 
+    @property
+    def availability(self) -> PieceAvailability:
+        return self._pieces.availability
+
     @property
     def complete(self) -> bool:
         return self._complete
@@ -469,7 +1170,7 @@ class DownloadInfo:
     @complete.setter
     def complete(self, value: bool):
         if value:
-            assert all(info.downloaded or not info.selected for info in self._pieces)
+            assert self.all_selected_downloaded()
         self._complete = value
 
     DISTRUST_RATE_TO_BAN = 5
@@ -486,21 +1187,36 @@ class DownloadInfo:
         return self._session_statistics
 
 
+class AllocationPolicy(Enum):
+    sparse = 'sparse'  # Files are truncated to their length, disk space is allocated on writing
+    full = 'full'      # Disk space is reserved in advance to avoid fragmentation
+    none = 'none'      # Files grow while data is written
+
+
 class TorrentInfo:
-    def __init__(self, download_info: DownloadInfo, announce_list: List[List[str]], *, download_dir: str):
+    def __init__(self, download_info: DownloadInfo, announce_list: List[List[str]], *, download_dir: str,
+                 allocation_policy: AllocationPolicy=AllocationPolicy.sparse):
         # TODO: maybe implement optional fields
 
         self.download_info = download_info
         self._announce_list = announce_list
 
         self.download_dir = download_dir
+        self.allocation_policy = allocation_policy
 
         self.paused = False
+        self.checking_progress = None  # type: Optional[float]
+
+    _PARSERS = {
+        b'info': DownloadInfo.parse,
+    }
 
     @classmethod
     def from_file(cls, filename: str, **kwargs):
-        dictionary = cast(OrderedDict, bencodepy.decode_from_file(filename))
-        download_info = DownloadInfo.from_dict(dictionary[b'info'])
+        with open(filename, 'rb') as f:
+            data = f.read()
+        dictionary, _ = bencode.decode_dict(data, 0, TorrentInfo._PARSERS)
+        download_info = dictionary[b'info']
 
         if b'announce-list' in dictionary:
             announce_list = [[url.decode() for url in tier]
@@ -514,6 +1230,17 @@ class TorrentInfo:
     def announce_list(self) -> List[List[str]]:
         return self._announce_list
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['checking_progress'] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        # State files of older versions contain objects without some of the fields
+        self.allocation_policy = AllocationPolicy.sparse
+        self.checking_progress = None
+        self.__dict__.update(state)
+
 
 class TorrentState:
     """This class represents crucial parameters of torrent state. Unlike TorrentInfo and DownloadInfo,
@@ -529,24 +1256,20 @@ class TorrentState:
         self.info_hash = download_info.info_hash
         self.single_file_mode = download_info.single_file_mode
 
-        self.total_piece_count = len(download_info.pieces)
-        self.selected_piece_count = sum(1 for info in download_info.pieces if info.selected)
-
-        last_piece_info = download_info.pieces[-1]
-        self.selected_size = self.selected_piece_count * download_info.piece_length
-        if last_piece_info.selected:
-            self.selected_size += last_piece_info.length - download_info.piece_length
-        self.downloaded_size = download_info.downloaded_piece_count * download_info.piece_length
-        if last_piece_info.downloaded:
-            self.downloaded_size += last_piece_info.length - download_info.piece_length
+        # All the values are maintained by DownloadInfo incrementally, so making a snapshot takes O(1)
+        self.total_piece_count = download_info.piece_count
+        self.selected_piece_count = download_info.selected_piece_count
+        self.selected_size = download_info.selected_size
+        self.downloaded_size = download_info.downloaded_size
 
-        self.total_file_count = len(download_info.files)
-        self.selected_file_count = sum(1 for info in download_info.files if info.selected)
+        self.total_file_count = download_info.file_count
+        self.selected_file_count = download_info.selected_file_count
 
         self.download_dir = torrent_info.download_dir
 
         self.paused = torrent_info.paused
         self.complete = download_info.complete
+        self.checking_progress = torrent_info.checking_progress
 
         self.total_peer_count = statistics.peer_count
         self.downloading_peer_count = statistics.downloading_peer_count
@@ -1,4 +1,5 @@
 from happy_bittorrent.network.peer_tcp_client import *
+from happy_bittorrent.network.utp import *
 from happy_bittorrent.network.peer_tcp_server import *
 from happy_bittorrent.network.tracker_clients import *
 
@@ -1,14 +1,21 @@
 import asyncio
+import hashlib
+import ipaddress
+import itertools
 import logging
 import struct
+from collections import OrderedDict
 from enum import Enum
 from math import ceil
-from typing import Optional, Tuple, List, cast, Sequence
+from typing import Optional, Tuple, List, cast, Sequence, Dict, Callable, Any
 
 from bitarray import bitarray
 
+from happy_bittorrent import __version__, bencode
 from happy_bittorrent.file_structure import FileStructure
 from happy_bittorrent.models import SHA1_DIGEST_LEN, DownloadInfo, Peer, BlockRequest
+from happy_bittorrent.network.peer_wire_protocol import PeerWireProtocol
+from happy_bittorrent.network.utp import UTPSocket
 
 
 __all__ = ['PeerTCPClient']
@@ -26,6 +33,19 @@ class MessageType(Enum):
     cancel = 8
     port = 9
 
+    # Fast Extension (BEP 6)
+    suggest_piece = 0x0D
+    have_all = 0x0E
+    have_none = 0x0F
+    reject_request = 0x10
+    allowed_fast = 0x11
+
+    # Extension Protocol (BEP 10)
+    extended = 20
+
+
+_message_types = {item.value: item for item in MessageType}
+
 
 class SeedError(Exception):
     pass
@@ -34,9 +54,12 @@ class SeedError(Exception):
 class PeerTCPClient:
     LOGGER_LEVEL = logging.INFO
 
-    def __init__(self, our_peer_id: bytes, peer: Peer):
+    def __init__(self, our_peer_id: bytes, peer: Peer, our_port: Optional[int]=None,
+                 utp_socket: Optional[UTPSocket]=None):
         self._our_peer_id = our_peer_id
         self._peer = peer
+        self._our_port = our_port
+        self._utp_socket = utp_socket
 
         self._logger = logging.getLogger('[{}]'.format(peer))
         self._logger.setLevel(PeerTCPClient.LOGGER_LEVEL)
@@ -53,40 +76,62 @@ class PeerTCPClient:
         self._downloaded = 0
         self._uploaded = 0
 
-        self._reader = None               # type: asyncio.StreamReader
-        self._writer = None               # type: asyncio.StreamWriter
+        self._protocol = None  # type: PeerWireProtocol
         self._connected = False
+        self._send_files = False
+
+        self._fast_extension = False
+        self._allowed_fast_pieces = None     # type: Optional[bitarray]  # Pieces the peer allows to request from it
+        self._suggested_pieces = None        # type: Optional[bitarray]
+        self._granted_allowed_fast = set()   # type: Set[int]  # Pieces we allow the peer to request from us
+
+        self._extension_protocol = False
+        self._peer_extensions = {}           # type: Dict[bytes, int]  # Extension names to the peer's message IDs
+        self._listen_port = None             # type: Optional[int]
+        self._peer_exchange_handler = None   # type: Optional[Callable[[List[Peer]], None]]
+
+        # Requests of the peer in the order of arrival. Values are tasks reading the blocks in advance.
+        self._upload_queue = OrderedDict()  # type: Dict[BlockRequest, Optional[asyncio.Future]]
+        self._upload_waiter = None          # type: Optional[asyncio.Future]
 
     _handshake_message = b'BitTorrent protocol'
     HANDSHAKE_DATA = bytes([len(_handshake_message)]) + _handshake_message
-    RESERVED_BYTES = b'\0' * 8
+    EXTENSION_PROTOCOL_BYTE = 5
+    EXTENSION_PROTOCOL_FLAG = 0x10
+    FAST_EXTENSION_BYTE = 7
+    FAST_EXTENSION_FLAG = 0x04
+    RESERVED_BYTES = bytes(EXTENSION_PROTOCOL_BYTE) + bytes([EXTENSION_PROTOCOL_FLAG, 0, FAST_EXTENSION_FLAG])
 
     CONNECT_TIMEOUT = 5
-    READ_TIMEOUT = 5
-    MAX_SILENCE_DURATION = 3 * 60
+    UTP_CONNECT_TIMEOUT = 2
     WRITE_TIMEOUT = 5
 
     def _send_protocol_data(self):
-        self._writer.write(PeerTCPClient.HANDSHAKE_DATA + PeerTCPClient.RESERVED_BYTES)
+        self._protocol.write(PeerTCPClient.HANDSHAKE_DATA + PeerTCPClient.RESERVED_BYTES)
 
     async def _receive_protocol_data(self):
         data_len = len(PeerTCPClient.HANDSHAKE_DATA) + len(PeerTCPClient.RESERVED_BYTES)
-        response = await asyncio.wait_for(self._reader.readexactly(data_len), PeerTCPClient.READ_TIMEOUT)
+        response = await self._protocol.receive_exactly(data_len)
 
         if response[:len(PeerTCPClient.HANDSHAKE_DATA)] != PeerTCPClient.HANDSHAKE_DATA:
             raise ValueError('Unknown protocol')
+        reserved = response[len(PeerTCPClient.HANDSHAKE_DATA):]
+        self._fast_extension = bool(reserved[PeerTCPClient.FAST_EXTENSION_BYTE] & PeerTCPClient.FAST_EXTENSION_FLAG)
+        self._extension_protocol = bool(reserved[PeerTCPClient.EXTENSION_PROTOCOL_BYTE] &
+                                        PeerTCPClient.EXTENSION_PROTOCOL_FLAG)
 
     def _populate_info(self, download_info: DownloadInfo, file_structure: FileStructure):
         self._download_info = download_info
         self._file_structure = file_structure
-        self._piece_owned = bitarray(download_info.piece_count)
-        self._piece_owned.setall(False)
+        self._piece_owned = download_info.availability.add_peer(self._peer)
+        self._send_files = (PeerTCPClient.USE_SENDFILE and self._protocol.files_sendable and
+                            not file_structure.memory_mapped)
 
-        self._writer.write(self._download_info.info_hash + self._our_peer_id)
+        self._protocol.write(self._download_info.info_hash + self._our_peer_id)
 
     async def _receive_info(self) -> bytes:
         data_len = SHA1_DIGEST_LEN + len(self._our_peer_id)
-        response = await asyncio.wait_for(self._reader.readexactly(data_len), PeerTCPClient.READ_TIMEOUT)
+        response = await self._protocol.receive_exactly(data_len)
 
         actual_info_hash = response[:SHA1_DIGEST_LEN]
         actual_peer_id = response[SHA1_DIGEST_LEN:]
@@ -98,9 +143,31 @@ class PeerTCPClient:
 
         return actual_info_hash
 
+    async def _open_connection(self):
+        # uTP is tried first since its congestion control yields to other traffic. The uTP socket is bound
+        # to an IPv4 address. Peers that didn't accept a uTP connection recently are connected via TCP at once.
+        host, port = self._peer.host, self._peer.port
+        utp_socket = self._utp_socket
+        if utp_socket is not None and ':' not in host and utp_socket.is_supported(host, port):
+            try:
+                _, self._protocol = await asyncio.wait_for(
+                    utp_socket.create_connection(PeerWireProtocol, host, port), PeerTCPClient.UTP_CONNECT_TIMEOUT)
+                return
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.TimeoutError) as e:
+                self._logger.debug('uTP connection failed (%r), falling back to TCP', e)
+                utp_socket.mark_unsupported(host, port)
+
+        loop = asyncio.get_event_loop()
+        _, self._protocol = await asyncio.wait_for(
+            loop.create_connection(PeerWireProtocol, self._peer.host, self._peer.port),
+            PeerTCPClient.CONNECT_TIMEOUT)
+
     async def connect(self, download_info: DownloadInfo, file_structure: FileStructure):
-        self._reader, self._writer = await asyncio.wait_for(
-            asyncio.open_connection(self._peer.host, self._peer.port), PeerTCPClient.CONNECT_TIMEOUT)
+        await self._open_connection()
+
+        self._listen_port = self._peer.port
 
         self._send_protocol_data()
         self._populate_info(download_info, file_structure)
@@ -110,11 +177,12 @@ class PeerTCPClient:
             raise ValueError("info_hashes don't match")
 
         self._send_bitfield()
+        self._send_extension_handshake()
+        self._protocol.start_framing()
         self._connected = True
 
-    async def accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bytes:
-        self._reader = reader
-        self._writer = writer
+    async def accept(self, protocol: PeerWireProtocol) -> bytes:
+        self._protocol = protocol
 
         self._send_protocol_data()
 
@@ -125,43 +193,36 @@ class PeerTCPClient:
         self._populate_info(download_info, file_structure)
 
         self._send_bitfield()
+        self._send_extension_handshake()
+        self._protocol.start_framing()
         self._connected = True
 
-    MAX_MESSAGE_LENGTH = 2 ** 18
-
     async def _receive_message(self) -> Optional[Tuple[MessageType, memoryview]]:
-        data = await asyncio.wait_for(self._reader.readexactly(4), PeerTCPClient.MAX_SILENCE_DURATION)
-        (length,) = struct.unpack('!I', data)
-        if length == 0:  # keep-alive
-            return None
-        if length > PeerTCPClient.MAX_MESSAGE_LENGTH:
-            raise ValueError('Message length is too big')
-
-        data = await asyncio.wait_for(self._reader.readexactly(length), PeerTCPClient.READ_TIMEOUT)
-        try:
-            message_id = MessageType(data[0])
-        except ValueError:
-            self._logger.debug('Unknown message type %s', data[0])
+        # Keep-alives and timeouts are handled by the protocol. The payload is a view of the receive buffer,
+        # so it's valid only until the next message is received.
+        raw_message_id, payload = await self._protocol.receive_message()
+        message_id = _message_types.get(raw_message_id)
+        if message_id is None:
+            self._logger.debug('Unknown message type %s', raw_message_id)
             return None
-        payload = memoryview(data)[1:]
 
-        # self._logger.debug('incoming message %s length=%s', message_id.name, length)
+        # self._logger.debug('incoming message %s length=%s', message_id.name, len(payload) + 1)
 
         return message_id, payload
 
     _KEEP_ALIVE_MESSAGE = b'\0' * 4
 
     def _send_message(self, message_id: MessageType=None, *payload: List[bytes]):
+        # Messages are coalesced by the protocol and written at the end of the event loop iteration
         if message_id is None:  # keep-alive
-            self._writer.write(PeerTCPClient._KEEP_ALIVE_MESSAGE)
+            self._protocol.send((PeerTCPClient._KEEP_ALIVE_MESSAGE,))
             return
 
         length = sum(len(portion) for portion in payload) + 1
         # self._logger.debug('outcoming message %s length=%s', message_id.name, length)
 
-        self._writer.write(struct.pack('!IB', length, message_id.value))
-        for portion in payload:
-            self._writer.write(portion)
+        self._protocol.send((struct.pack('!IB', length, message_id.value),) + payload,
+                            bulk=message_id == MessageType.piece)
 
     @property
     def am_choking(self):
@@ -181,6 +242,8 @@ class PeerTCPClient:
         if self._am_choking != value:
             self._am_choking = value
             self._send_message(MessageType.choke if value else MessageType.unchoke)
+            if value:
+                self._discard_upload_requests()
 
     @am_interested.setter
     def am_interested(self, value: bool):
@@ -201,6 +264,39 @@ class PeerTCPClient:
     def piece_owned(self) -> Sequence[bool]:
         return self._piece_owned
 
+    @property
+    def fast_extension(self) -> bool:
+        return self._fast_extension
+
+    @property
+    def allowed_fast_pieces(self) -> Optional[bitarray]:
+        """Pieces that can be requested from the peer while it chokes us (or None if there are no such pieces).
+        Some of them may be not owned by the peer."""
+        return self._allowed_fast_pieces
+
+    @property
+    def suggested_pieces(self) -> Optional[bitarray]:
+        return self._suggested_pieces
+
+    def is_allowed_fast(self, piece_index: int) -> bool:
+        return self._allowed_fast_pieces is not None and bool(self._allowed_fast_pieces[piece_index])
+
+    @property
+    def supports_peer_exchange(self) -> bool:
+        # Peer exchange is disabled for private torrents (BEP 27)
+        return bool(self._peer_extensions.get(b'ut_pex')) and not self._download_info.private
+
+    @property
+    def listen_address(self) -> Optional[Peer]:
+        """Address the peer accepts connections on. For incoming connections, it's known only if the peer
+        reported its port in the extension handshake."""
+        if self._listen_port is None:
+            return None
+        return Peer(self._peer.host, self._listen_port)
+
+    def set_peer_exchange_handler(self, handler: Callable[[List[Peer]], None]):
+        self._peer_exchange_handler = handler
+
     # def is_seed(self) -> bool:
     #     return self._piece_owned & self._download_info.piece_selected == self._download_info.piece_selected
 
@@ -230,32 +326,166 @@ class PeerTCPClient:
         elif message_id == MessageType.not_interested:
             self._peer_interested = False
 
-    def _mark_as_owner(self, piece_index: int):
-        self._piece_owned[piece_index] = True
-        self._download_info.pieces[piece_index].owners.add(self._peer)
-        if piece_index in self._download_info.interesting_pieces:
-            self.am_interested = True
+    def _parse_piece_index(self, message_id: MessageType, payload: memoryview) -> int:
+        PeerTCPClient._check_payload_len(message_id, payload, 4)
+        (index,) = struct.unpack('!I', cast(bytes, payload))
+        if index >= self._download_info.piece_count:
+            raise IndexError('Piece index out of range')
+        return index
+
+    def _check_fast_extension(self, message_id: MessageType):
+        if not self._fast_extension:
+            raise ValueError('Message {} requires the Fast Extension'.format(message_id.name))
+
+    ALLOWED_FAST_SET_SIZE = 10
 
     def _handle_haves(self, message_id: MessageType, payload: memoryview):
+        download_info = self._download_info
         if message_id == MessageType.have:
-            (index,) = struct.unpack('!I', cast(bytes, payload))
-            self._mark_as_owner(index)
-        elif message_id == MessageType.bitfield:
-            piece_count = self._download_info.piece_count
+            index = self._parse_piece_index(message_id, payload)
+            download_info.availability.add_piece(self._peer, index)
+            if download_info.pieces.needed_bitmap[index]:
+                self.am_interested = True
+            return
+
+        if message_id == MessageType.bitfield:
+            piece_count = download_info.piece_count
             PeerTCPClient._check_payload_len(message_id, payload, int(ceil(piece_count / 8)))
 
             arr = bitarray(endian='big')
             arr.frombytes(payload.tobytes())
-            for i in range(piece_count):
-                if arr[i]:
-                    self._mark_as_owner(i)
-            for i in range(piece_count, len(arr)):
-                if arr[i]:
-                    raise ValueError('Spare bits in "bitfield" message must be zero')
+            if arr[piece_count:].any():
+                raise ValueError('Spare bits in "bitfield" message must be zero')
+            del arr[piece_count:]
+
+            download_info.availability.add_pieces(self._peer, arr)
+        elif message_id == MessageType.have_all:
+            self._check_fast_extension(message_id)
+            PeerTCPClient._check_payload_len(message_id, payload, 0)
+            # The peer is a seed, so its bitfield isn't built piece by piece
+            download_info.availability.add_all_pieces(self._peer)
+        elif message_id == MessageType.have_none:
+            self._check_fast_extension(message_id)
+            PeerTCPClient._check_payload_len(message_id, payload, 0)
+
+        if download_info.availability.has_any(self._peer, download_info.pieces.needed_bitmap):
+            self.am_interested = True
+
+        if (self._fast_extension and not self._granted_allowed_fast and
+                message_id != MessageType.have_all and self._piece_owned.count() < PeerTCPClient.ALLOWED_FAST_SET_SIZE):
+            # Let a peer that has almost nothing download a few pieces while it's choked
+            self._grant_allowed_fast()
 
         # if self._download_info.complete and self.is_seed():
         #     raise SeedError('A seed is disconnected because a download is complete')
 
+    def _handle_fast_hints(self, message_id: MessageType, payload: memoryview):
+        self._check_fast_extension(message_id)
+        index = self._parse_piece_index(message_id, payload)
+
+        if message_id == MessageType.allowed_fast:
+            if self._allowed_fast_pieces is None:
+                self._allowed_fast_pieces = PeerTCPClient._create_piece_bitmap(self._download_info.piece_count)
+            self._allowed_fast_pieces[index] = True
+        elif message_id == MessageType.suggest_piece:
+            if self._suggested_pieces is None:
+                self._suggested_pieces = PeerTCPClient._create_piece_bitmap(self._download_info.piece_count)
+            self._suggested_pieces[index] = True
+
+    @staticmethod
+    def _create_piece_bitmap(piece_count: int) -> bitarray:
+        result = bitarray(piece_count, endian='big')
+        result.setall(False)
+        return result
+
+    @staticmethod
+    def generate_allowed_fast_set(host: str, info_hash: bytes, piece_count: int, set_size: int) -> List[int]:
+        """Canonical allowed fast set from BEP 6. It's defined only for IPv4 addresses."""
+
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return []
+        if address.version != 4:
+            return []
+
+        set_size = min(set_size, piece_count)
+        result = []
+        x = (int(address) & 0xFFFFFF00).to_bytes(4, 'big') + info_hash
+        while len(result) < set_size:
+            x = hashlib.sha1(x).digest()
+            for i in range(0, len(x), 4):
+                if len(result) == set_size:
+                    break
+                (y,) = struct.unpack_from('!I', x, i)
+                index = y % piece_count
+                if index not in result:
+                    result.append(index)
+        return result
+
+    def _grant_allowed_fast(self):
+        download_info = self._download_info
+        pieces = PeerTCPClient.generate_allowed_fast_set(self._peer.host, download_info.info_hash,
+                                                         download_info.piece_count,
+                                                         PeerTCPClient.ALLOWED_FAST_SET_SIZE)
+        self._granted_allowed_fast = set(pieces)
+        for index in pieces:
+            if download_info.pieces[index].downloaded:
+                self._send_message(MessageType.allowed_fast, struct.pack('!I', index))
+
+    EXTENSION_HANDSHAKE_ID = 0
+    # IDs of extension messages sent to us (we choose them, the peer chooses IDs of messages sent to it)
+    EXTENSION_MESSAGE_IDS = {b'ut_pex': 1}
+    MAX_EXCHANGED_PEERS = 50
+
+    def _handle_extended(self, payload: memoryview):
+        if not self._extension_protocol:
+            raise ValueError('Message {} requires the Extension Protocol'.format(MessageType.extended.name))
+        if not payload:
+            raise ValueError('Empty extended message')
+        extension_id = payload[0]
+        message = bencode.decode(payload[1:].tobytes())
+        if not isinstance(message, dict):
+            raise ValueError('Extended message is not a dictionary')
+
+        if extension_id == PeerTCPClient.EXTENSION_HANDSHAKE_ID:
+            self._handle_extension_handshake(message)
+        elif (extension_id == PeerTCPClient.EXTENSION_MESSAGE_IDS[b'ut_pex'] and
+                not self._download_info.private):
+            self._handle_peer_exchange(message)
+        else:
+            self._logger.debug('Unknown extended message %s', extension_id)
+
+    def _handle_extension_handshake(self, message: Dict[bytes, Any]):
+        # Later handshakes may update the dictionary, zero IDs disable extensions
+        extensions = message.get(b'm', {})
+        if isinstance(extensions, dict):
+            for name, extension_id in extensions.items():
+                if not isinstance(extension_id, int):
+                    continue
+                if extension_id:
+                    self._peer_extensions[name] = extension_id
+                else:
+                    self._peer_extensions.pop(name, None)
+
+        port = message.get(b'p')
+        if self._listen_port is None and isinstance(port, int) and 0 < port < 2 ** 16:
+            self._listen_port = port
+
+    def _handle_peer_exchange(self, message: Dict[bytes, Any]):
+        # Dropped peers are ignored: a peer disconnected from someone else may be still useful for us
+        peers = []
+        for key, entry_len in ((b'added', 6), (b'added6', 18)):
+            data = message.get(key, b'')
+            if not isinstance(data, bytes) or len(data) % entry_len != 0:
+                raise ValueError('Invalid "{}" list in peer exchange message'.format(key.decode()))
+            data = data[:PeerTCPClient.MAX_EXCHANGED_PEERS * entry_len]
+            peers += [Peer.from_compact_form(data[i:i + entry_len]) for i in range(0, len(data), entry_len)]
+
+        peers = [peer for peer in peers if peer.port]
+        if peers and self._peer_exchange_handler is not None:
+            self._peer_exchange_handler(peers)
+
     MAX_REQUEST_LENGTH = 2 ** 17
 
     def _check_position_range(self, request: BlockRequest):
@@ -267,7 +497,10 @@ class PeerTCPClient:
                 end_offset > self._download_info.total_size):
             raise IndexError('Position in piece out of range')
 
-    async def _handle_requests(self, message_id: MessageType, payload: memoryview):
+    MAX_UPLOAD_QUEUE_SIZE = 256
+
+    def _handle_requests(self, message_id: MessageType, payload: memoryview):
+        PeerTCPClient._check_payload_len(message_id, payload, 12)
         piece_index, begin, length = struct.unpack('!3I', cast(bytes, payload))
         request = BlockRequest(piece_index, begin, length)
         self._check_position_range(request)
@@ -276,20 +509,52 @@ class PeerTCPClient:
             if length > PeerTCPClient.MAX_REQUEST_LENGTH:
                 raise ValueError('Requested {} bytes, but the current policy allows to accept requests '
                                  'of not more than {} bytes'.format(length, PeerTCPClient.MAX_REQUEST_LENGTH))
-            if (self._am_choking or not self._peer_interested or
+            if ((self._am_choking and piece_index not in self._granted_allowed_fast) or not self._peer_interested or
                     not self._download_info.pieces[piece_index].downloaded):
                 # If peer isn't interested but requesting, their peer_interested flag wasn't considered
                 # when selecting who to unchoke, so we may be not ready to upload to them.
                 # If requested piece is not downloaded yet, we shouldn't disconnect because our piece_downloaded flag
                 # could be removed because of file corruption.
+                self._reject_request(request)
+                return
+            if request in self._upload_queue:
+                return
+            if len(self._upload_queue) >= PeerTCPClient.MAX_UPLOAD_QUEUE_SIZE:
+                self._logger.debug('upload queue is full, request is ignored')
+                self._reject_request(request)
                 return
 
-            await self._send_block(request)
-            await self.drain()
+            self._upload_queue[request] = None
+            if self._upload_waiter is not None and not self._upload_waiter.done():
+                self._upload_waiter.set_result(None)
         elif message_id == MessageType.cancel:
-            # Now we answer to a request immediately or reject and forget it,
-            # so there's no need to handle cancel messages
-            pass
+            if request in self._upload_queue:
+                read_task = self._upload_queue.pop(request)
+                if read_task is not None:
+                    read_task.cancel()
+                # With the Fast Extension, a cancel is always answered with the block or a reject
+                self._reject_request(request)
+        elif message_id == MessageType.reject_request:
+            self._check_fast_extension(message_id)
+            # The downloader can request the block again immediately instead of waiting for a timeout
+            self._download_info.pieces[piece_index].mark_rejected_block(self._peer, request)
+
+    def _reject_request(self, request: BlockRequest):
+        if self._fast_extension:
+            self._send_message(MessageType.reject_request,
+                               struct.pack('!3I', request.piece_index, request.block_begin, request.block_length))
+
+    def _discard_upload_requests(self):
+        # Without the Fast Extension, the peer considers its requests discarded when it's choked. Otherwise, we
+        # reject them explicitly, except ones for allowed fast pieces.
+        queue = self._upload_queue
+        for request in list(queue):
+            if self._fast_extension and request.piece_index in self._granted_allowed_fast:
+                continue
+            read_task = queue.pop(request)
+            if read_task is not None:
+                read_task.cancel()
+            self._reject_request(request)
 
     async def _handle_block(self, payload: memoryview):
         if not self._am_interested:
@@ -306,7 +571,7 @@ class PeerTCPClient:
         if not block_length:
             return
 
-        async with self._file_structure.lock:
+        async with self._file_structure.lock_piece(piece_index):
             # Manual lock acquiring guarantees that piece validation will not be performed between
             # condition checking and piece writing
             piece_info = self._download_info.pieces[piece_index]
@@ -316,38 +581,151 @@ class PeerTCPClient:
             self._downloaded += block_length
             self._download_info.session_statistics.add_downloaded(self._peer, block_length)
 
-            await self._file_structure.write(piece_index * self._download_info.piece_length + block_begin, block_data,
-                                             acquire_lock=False)
+            await self._file_structure.write_block(piece_index, block_begin, block_data, acquire_lock=False)
 
             piece_info.mark_downloaded_blocks(self._peer, request)
 
     async def run(self):
-        while True:
-            message = await self._receive_message()
-            if message is None:
-                continue
-            message_id, payload = message
-
-            if message_id in (MessageType.choke, MessageType.unchoke,
-                              MessageType.interested, MessageType.not_interested):
-                self._handle_setting_states(message_id, payload)
-            elif message_id in (MessageType.have, MessageType.bitfield):
-                self._handle_haves(message_id, payload)
-            elif message_id in (MessageType.request, MessageType.cancel):
-                await self._handle_requests(message_id, payload)
-            elif message_id == MessageType.piece:
-                await self._handle_block(payload)
-            elif message_id == MessageType.port:
-                PeerTCPClient._check_payload_len(message_id, payload, 2)
-                # TODO: Ignore or implement DHT
+        # Blocks are uploaded by a separate task, so a slow disk read or a full socket buffer doesn't stop
+        # receiving messages (including blocks we download from the peer)
+        upload_task = asyncio.ensure_future(self._execute_uploading())
+        try:
+            while True:
+                message = await self._receive_message()
+                if message is None:
+                    continue
+                message_id, payload = message
+
+                if message_id in (MessageType.choke, MessageType.unchoke,
+                                  MessageType.interested, MessageType.not_interested):
+                    self._handle_setting_states(message_id, payload)
+                elif message_id in (MessageType.have, MessageType.bitfield,
+                                    MessageType.have_all, MessageType.have_none):
+                    self._handle_haves(message_id, payload)
+                elif message_id in (MessageType.request, MessageType.cancel, MessageType.reject_request):
+                    self._handle_requests(message_id, payload)
+                elif message_id in (MessageType.allowed_fast, MessageType.suggest_piece):
+                    self._handle_fast_hints(message_id, payload)
+                elif message_id == MessageType.piece:
+                    await self._handle_block(payload)
+                elif message_id == MessageType.extended:
+                    self._handle_extended(payload)
+                elif message_id == MessageType.port:
+                    PeerTCPClient._check_payload_len(message_id, payload, 2)
+                    # TODO: Ignore or implement DHT
+        finally:
+            upload_task.cancel()
+            self._clear_upload_queue()
+
+    UPLOAD_PREFETCH_COUNT = 4
+
+    def _prefetch_blocks(self):
+        # Blocks are read through the piece cache, so reading of the following blocks of the same piece
+        # joins the read that is already in progress
+        queue = self._upload_queue
+        for request in list(itertools.islice(queue, PeerTCPClient.UPLOAD_PREFETCH_COUNT)):
+            if queue[request] is None:
+                queue[request] = asyncio.ensure_future(self._file_structure.read_block(
+                    request.piece_index, request.block_begin, request.block_length))
+
+    def _clear_upload_queue(self):
+        for read_task in self._upload_queue.values():
+            if read_task is not None:
+                read_task.cancel()
+        self._upload_queue.clear()
+
+    async def _execute_uploading(self):
+        try:
+            queue = self._upload_queue
+            while True:
+                if not queue:
+                    self._upload_waiter = asyncio.get_event_loop().create_future()
+                    await self._upload_waiter
+                    continue
+
+                request, read_task = queue.popitem(last=False)
+                if self._send_files:
+                    # The data is sent from the page cache, so there's nothing to prefetch
+                    if not await self._send_block_file(request):
+                        continue
+                else:
+                    if read_task is None:
+                        read_task = asyncio.ensure_future(self._file_structure.read_block(
+                            request.piece_index, request.block_begin, request.block_length))
+                    self._prefetch_blocks()
+                    block = await read_task
+                    if self._am_choking and request.piece_index not in self._granted_allowed_fast:
+                        # The peer was choked during the reading
+                        self._reject_request(request)
+                        continue
+                    # `block` is a memoryview of a cached piece or a memory mapping, so it's passed to the transport
+                    # without copying
+                    self._send_message(MessageType.piece,
+                                       struct.pack('!2I', request.piece_index, request.block_begin), block)
+
+                self._uploaded += request.block_length
+                self._download_info.session_statistics.add_uploaded(self._peer, request.block_length)
+
+                await self.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The error is raised from run()
+            self._protocol.abort(e)
 
     def send_keep_alive(self):
         self._send_message(None)
 
     def _send_bitfield(self):
-        if self._download_info.downloaded_piece_count:
-            arr = bitarray([info.downloaded for info in self._download_info.pieces], endian='big')
-            self._send_message(MessageType.bitfield, arr.tobytes())
+        download_info = self._download_info
+        if self._fast_extension:
+            if download_info.downloaded_piece_count == download_info.piece_count:
+                self._send_message(MessageType.have_all)
+                return
+            if not download_info.downloaded_piece_count:
+                self._send_message(MessageType.have_none)
+                return
+        if download_info.downloaded_piece_count:
+            self._send_message(MessageType.bitfield, download_info.pieces.get_bitfield_payload())
+
+    CLIENT_VERSION = 'happy-bittorrent {}'.format(__version__)
+
+    def _send_extension_handshake(self):
+        if not self._extension_protocol:
+            return
+
+        extensions = {}
+        if not self._download_info.private:
+            extensions = dict(PeerTCPClient.EXTENSION_MESSAGE_IDS)
+        message = {b'm': extensions, b'v': PeerTCPClient.CLIENT_VERSION, b'reqq': PeerTCPClient.MAX_UPLOAD_QUEUE_SIZE}
+        if self._our_port is not None:
+            message[b'p'] = self._our_port
+        self._send_message(MessageType.extended, bytes([PeerTCPClient.EXTENSION_HANDSHAKE_ID]), bencode.encode(message))
+
+    PEER_EXCHANGE_SEED_FLAG = 0x02
+
+    def send_peer_exchange(self, added: Sequence[Tuple[Peer, int]], dropped: Sequence[Peer]):
+        """Sends a ut_pex message. `added` contains peers with their flags (e.g. PEER_EXCHANGE_SEED_FLAG)."""
+
+        lists = {b'added': [], b'added.f': [], b'added6': [], b'added6.f': [],
+                 b'dropped': [], b'dropped6': []}  # type: Dict[bytes, List[bytes]]
+        for peer, flags in added:
+            try:
+                data = peer.to_compact_form()
+            except (OSError, ValueError):  # The host is not an IP address
+                continue
+            suffix = b'6' if len(data) == 18 else b''
+            lists[b'added' + suffix].append(data)
+            lists[b'added' + suffix + b'.f'].append(bytes([flags]))
+        for peer in dropped:
+            try:
+                data = peer.to_compact_form()
+            except (OSError, ValueError):
+                continue
+            lists[b'dropped6' if len(data) == 18 else b'dropped'].append(data)
+
+        message = {key: b''.join(items) for key, items in lists.items()}
+        self._send_message(MessageType.extended, bytes([self._peer_extensions[b'ut_pex']]), bencode.encode(message))
 
     def send_have(self, piece_index: int):
         self._send_message(MessageType.have, struct.pack('!I', piece_index))
@@ -355,26 +733,33 @@ class PeerTCPClient:
     def send_request(self, request: BlockRequest, cancel: bool=False):
         self._check_position_range(request)
         if not cancel:
-            assert self._peer in self._download_info.pieces[request.piece_index].owners
+            assert self._download_info.availability.has_piece(self._peer, request.piece_index)
 
         self._send_message(MessageType.request if not cancel else MessageType.cancel,
                            struct.pack('!3I', request.piece_index, request.block_begin, request.block_length))
 
-    async def _send_block(self, request: BlockRequest):
-        block = await self._file_structure.read(
-            request.piece_index * self._download_info.piece_length + request.block_begin, request.block_length)
-        # TODO: Maybe can handle cancels here
+    USE_SENDFILE = True  # Used if the platform and the transport support it
 
-        self._send_message(MessageType.piece, struct.pack('!2I', request.piece_index, request.block_begin), block)
+    async def _send_block_file(self, request: BlockRequest) -> bool:
+        # The block goes from the page cache to the socket without being copied to userspace
+        file_regions = await self._file_structure.open_block(request.piece_index, request.block_begin,
+                                                             request.block_length)
+        if self._am_choking and request.piece_index not in self._granted_allowed_fast:
+            # The peer was choked during the opening
+            file_regions.release()
+            self._reject_request(request)
+            return False
 
-        self._uploaded += request.block_length
-        self._download_info.session_statistics.add_uploaded(self._peer, request.block_length)
+        header = struct.pack('!IB2I', request.block_length + 9, MessageType.piece.value,
+                             request.piece_index, request.block_begin)
+        self._protocol.send_file(header, file_regions)
+        return True
 
     async def drain(self):
-        await asyncio.wait_for(self._writer.drain(), PeerTCPClient.WRITE_TIMEOUT)
+        await asyncio.wait_for(self._protocol.drain(), PeerTCPClient.WRITE_TIMEOUT)
 
     def close(self):
-        if self._writer is not None:
-            self._writer.close()
+        if self._protocol is not None:
+            self._protocol.close()
 
         self._connected = False
@@ -1,10 +1,12 @@
 import asyncio
 import logging
-from typing import Dict
+from typing import Dict, Optional
 
 from happy_bittorrent import algorithms
 from happy_bittorrent.models import Peer
 from happy_bittorrent.network.peer_tcp_client import PeerTCPClient
+from happy_bittorrent.network.peer_wire_protocol import PeerWireProtocol
+from happy_bittorrent.network.utp import UTPSocket
 
 
 __all__= ['PeerTCPServer']
@@ -21,15 +23,19 @@ class PeerTCPServer:
 
         self._server = None
         self._port = None
+        self._utp_socket = None  # type: Optional[UTPSocket]
 
-    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        addr = writer.get_extra_info('peername')
+    def _create_protocol(self) -> PeerWireProtocol:
+        return PeerWireProtocol(lambda protocol: asyncio.ensure_future(self._accept(protocol)))
+
+    async def _accept(self, protocol: PeerWireProtocol):
+        addr = protocol.get_extra_info('peername')
         peer = Peer(addr[0], addr[1])
 
-        client = PeerTCPClient(self._our_peer_id, peer)
+        client = PeerTCPClient(self._our_peer_id, peer, self._port)
 
         try:
-            info_hash = await client.accept(reader, writer)
+            info_hash = await client.accept(protocol)
             if info_hash not in self._torrent_managers:
                 raise ValueError('Unknown info_hash')
         except Exception as e:
@@ -43,11 +49,12 @@ class PeerTCPServer:
             self._torrent_managers[info_hash].accept_client(peer, client)
 
     PORT_RANGE = range(6881, 6889 + 1)
+    USE_UTP = True
 
     async def start(self):
         for port in PeerTCPServer.PORT_RANGE:
             try:
-                self._server = await asyncio.start_server(self._accept, port=port)
+                self._server = await asyncio.get_event_loop().create_server(self._create_protocol, port=port)
             except asyncio.CancelledError:
                 raise
             except Exception as e:
@@ -55,15 +62,32 @@ class PeerTCPServer:
             else:
                 self._port = port
                 logger.info('server started on port %s', port)
+                if PeerTCPServer.USE_UTP:
+                    await self._start_utp()
                 return
         else:
             logger.warning('failed to start a server')
 
+    async def _start_utp(self):
+        # uTP connections are accepted and initiated on the UDP port with the same number
+        try:
+            self._utp_socket = await UTPSocket.create(self._port, self._create_protocol)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('failed to start uTP on port %s: %r', self._port, e)
+
     @property
     def port(self):
         return self._port
 
+    @property
+    def utp_socket(self) -> Optional[UTPSocket]:
+        return self._utp_socket
+
     async def stop(self):
+        if self._utp_socket is not None:
+            self._utp_socket.close()
         if self._server is not None:
             self._server.close()
             await self._server.wait_closed()
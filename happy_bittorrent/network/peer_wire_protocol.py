@@ -0,0 +1,499 @@
+import asyncio
+import os
+import struct
+from collections import deque
+from typing import Callable, Optional, Sequence, Tuple
+
+from happy_bittorrent.disk_io import DiskIOEngine, read_at
+from happy_bittorrent.file_structure import FileRegions
+
+
+__all__ = ['PeerWireProtocol']
+
+
+class _Chunk:
+    """Receive buffer. It's returned to the pool when all messages referring to it are released."""
+
+    __slots__ = ('data', 'view', 'pins', 'retired')
+
+    def __init__(self, size: int):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.pins = 0
+        self.retired = False
+
+
+class _ChunkPool:
+    def __init__(self, chunk_size: int, max_free_count: int):
+        self._chunk_size = chunk_size
+        self._max_free_count = max_free_count
+        self._free = []  # type: List[_Chunk]
+
+    def acquire(self, min_size: int) -> _Chunk:
+        if min_size > self._chunk_size:
+            return _Chunk(min_size)
+        if self._free:
+            chunk = self._free.pop()
+            chunk.retired = False
+            return chunk
+        return _Chunk(self._chunk_size)
+
+    def release(self, chunk: _Chunk):
+        if len(chunk.data) == self._chunk_size and len(self._free) < self._max_free_count:
+            self._free.append(chunk)
+
+
+Message = Tuple[int, memoryview]
+
+_length_struct = struct.Struct('!I')
+
+BulkMessage = Tuple[Sequence[bytes], int, Optional[FileRegions]]
+
+
+def _read_region(fd: int, file_pos: int, length: int) -> bytearray:
+    result = bytearray(length)
+    read_at(fd, memoryview(result), file_pos)
+    return result
+
+
+class PeerWireProtocol(asyncio.BufferedProtocol):
+    """Receives data of a peer wire connection into pooled buffers and splits it into messages.
+
+    Data is received directly into reusable buffers, all complete messages are extracted after each `recv`.
+    Messages are returned as memoryviews of these buffers, so `piece` payloads reach the storage without copying.
+    A returned message stays valid until the next receive_message() call: buffer regions are not reused while
+    they are referred by returned or queued messages.
+    """
+
+    CHUNK_SIZE = 2 ** 16
+    MIN_FREE_SPACE = 2 ** 12
+    MAX_FREE_CHUNKS = 64
+
+    MAX_MESSAGE_LENGTH = 2 ** 18
+    MAX_QUEUED_SIZE = 2 ** 20  # Reading is paused if unprocessed messages take more memory
+
+    READ_TIMEOUT = 5
+    MAX_SILENCE_DURATION = 3 * 60
+
+    _pool = _ChunkPool(CHUNK_SIZE, MAX_FREE_CHUNKS)
+
+    def __init__(self, connection_made_callback: Callable[['PeerWireProtocol'], None]=None):
+        self._connection_made_callback = connection_made_callback
+        self._loop = asyncio.get_event_loop()
+        self._transport = None  # type: asyncio.Transport
+
+        self._chunk = PeerWireProtocol._pool.acquire(0)
+        self._start = 0
+        self._end = 0
+
+        self._framing = False
+        self._messages = deque()  # type: Deque[Tuple[int, memoryview, _Chunk]]
+        self._queued_size = 0
+        self._returned_chunk = None  # type: Optional[_Chunk]
+        self._waiter = None          # type: Optional[asyncio.Future]
+        self._exception = None       # type: Optional[Exception]
+        self._reading_paused = False
+
+        self._last_received = self._loop.time()
+        self._timeout_handle = None  # type: Optional[asyncio.Handle]
+
+        self._control_queue = []    # type: List[bytes]
+        self._bulk_queue = deque()  # type: Deque[BulkMessage]
+        self._bulk_queued_size = 0
+        self._flush_scheduled = False
+        self._writing_paused = False
+        self._drain_waiter = None  # type: Optional[asyncio.Future]
+        self._files_sendable = False
+        self._send_files_task = None  # type: Optional[asyncio.Task]
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+        self._files_sendable = (hasattr(os, 'sendfile') and transport.get_extra_info('socket') is not None and
+                                transport.get_extra_info('sslcontext') is None)
+        self._schedule_timeout_check(PeerWireProtocol.READ_TIMEOUT)
+        if self._connection_made_callback is not None:
+            self._connection_made_callback(self)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if exc is None:
+            exc = ConnectionResetError('Connection closed by peer')
+        self._set_exception(exc)
+
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_exception(exc)
+        self._cancel_sending_files()
+        self._clear_send_queues()
+
+        if self._framing:
+            # Otherwise the handshake may still be read from the buffer
+            self._retire_chunk(self._chunk)
+
+    def eof_received(self) -> bool:
+        self._set_exception(ConnectionResetError('Connection closed by peer'))
+        return False
+
+    def get_extra_info(self, name: str):
+        return self._transport.get_extra_info(name)
+
+    def _set_exception(self, exc: Exception):
+        if self._exception is None:
+            self._exception = exc
+        self._wake_waiter()
+
+    def _wake_waiter(self):
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    # Timeouts
+
+    def _schedule_timeout_check(self, delay: float):
+        self._timeout_handle = self._loop.call_at(self._last_received + delay, self._check_timeout)
+
+    def _check_timeout(self):
+        self._timeout_handle = None
+        if self._exception is not None:
+            return
+
+        if self._messages or self._waiter is None and self._framing:
+            # We're not waiting for the peer now
+            self._last_received = self._loop.time()
+            delay = PeerWireProtocol.MAX_SILENCE_DURATION
+        elif self._end > self._start or not self._framing:
+            delay = PeerWireProtocol.READ_TIMEOUT  # A message (or the handshake) is partially received
+        else:
+            delay = PeerWireProtocol.MAX_SILENCE_DURATION
+
+        if self._loop.time() >= self._last_received + delay:
+            self.abort(asyncio.TimeoutError())
+        else:
+            self._schedule_timeout_check(delay)
+
+    # Receiving
+
+    def _retire_chunk(self, chunk: _Chunk):
+        chunk.retired = True
+        if not chunk.pins:
+            PeerWireProtocol._pool.release(chunk)
+
+    def _replace_chunk(self, min_size: int):
+        chunk = self._chunk
+        pending_len = self._end - self._start
+        if not chunk.pins and min_size <= len(chunk.data):
+            # Only a part of a message is moved, so the copy is small
+            chunk.data[:pending_len] = bytes(chunk.view[self._start:self._end])
+        else:
+            new_chunk = PeerWireProtocol._pool.acquire(min_size)
+            new_chunk.data[:pending_len] = chunk.view[self._start:self._end]
+            self._retire_chunk(chunk)
+            self._chunk = new_chunk
+        self._start = 0
+        self._end = pending_len
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        chunk = self._chunk
+        if self._framing and self._end - self._start >= 4:
+            required_size = 4 + _length_struct.unpack_from(chunk.data, self._start)[0]
+            if required_size <= PeerWireProtocol.MAX_MESSAGE_LENGTH + 4 and \
+                    self._start + required_size > len(chunk.data):
+                # Make the rest of the message fit the buffer
+                self._replace_chunk(max(required_size, PeerWireProtocol.CHUNK_SIZE))
+        elif len(chunk.data) - self._end < PeerWireProtocol.MIN_FREE_SPACE:
+            required_size = self._end - self._start + PeerWireProtocol.MIN_FREE_SPACE
+            self._replace_chunk(max(required_size, PeerWireProtocol.CHUNK_SIZE))
+        return self._chunk.view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        self._last_received = self._loop.time()
+
+        if self._framing:
+            self._extract_messages()
+        else:
+            self._wake_waiter()
+            if self._end - self._start > PeerWireProtocol.MAX_QUEUED_SIZE and not self._reading_paused:
+                self._reading_paused = True
+                self._transport.pause_reading()
+
+    def _extract_messages(self):
+        chunk = self._chunk
+        data = chunk.data
+        start = self._start
+        end = self._end
+        messages = self._messages
+        queued_size = self._queued_size
+        max_message_length = PeerWireProtocol.MAX_MESSAGE_LENGTH
+
+        while end - start >= 4:
+            (length,) = _length_struct.unpack_from(data, start)
+            if not length:  # keep-alive
+                start += 4
+                continue
+            if length > max_message_length:
+                self._start = start
+                self.abort(ValueError('Message length is too big'))
+                return
+            message_end = start + 4 + length
+            if message_end > end:
+                break
+
+            messages.append((data[start + 4], chunk.view[start + 5:message_end], chunk))
+            chunk.pins += 1
+            queued_size += length
+            start = message_end
+
+        if start == end and not chunk.pins:
+            start = end = 0
+        self._start = start
+        self._end = end
+        self._queued_size = queued_size
+
+        if messages:
+            self._wake_waiter()
+            if queued_size > PeerWireProtocol.MAX_QUEUED_SIZE and not self._reading_paused:
+                self._reading_paused = True
+                self._transport.pause_reading()
+
+    def _release_returned_chunk(self):
+        chunk = self._returned_chunk
+        if chunk is not None:
+            self._returned_chunk = None
+            chunk.pins -= 1
+            if not chunk.pins and chunk.retired:
+                PeerWireProtocol._pool.release(chunk)
+
+    async def receive_exactly(self, length: int) -> bytes:
+        """Receives raw data before messages (i.e. the handshake)."""
+
+        assert not self._framing
+        while self._end - self._start < length:
+            if self._exception is not None:
+                raise self._exception
+            self._waiter = self._loop.create_future()
+            await self._waiter
+
+        result = bytes(self._chunk.view[self._start:self._start + length])
+        self._start += length
+        return result
+
+    def start_framing(self):
+        self._framing = True
+        self._extract_messages()
+        self._resume_reading_if_needed()
+
+    async def receive_message(self) -> Message:
+        """Returns a message ID and a payload. The payload is valid until the next call."""
+
+        self._release_returned_chunk()
+
+        messages = self._messages
+        while not messages:
+            if self._exception is not None:
+                raise self._exception
+            self._waiter = self._loop.create_future()
+            await self._waiter
+
+        message_id, payload, chunk = messages.popleft()
+        self._returned_chunk = chunk
+        self._queued_size -= len(payload) + 1
+        self._resume_reading_if_needed()
+        return message_id, payload
+
+    def _resume_reading_if_needed(self):
+        if self._reading_paused and self._queued_size <= PeerWireProtocol.MAX_QUEUED_SIZE // 2:
+            self._reading_paused = False
+            self._transport.resume_reading()
+
+    # Sending
+
+    BULK_WRITE_SIZE = 2 ** 16
+    MAX_BULK_QUEUED_SIZE = 2 ** 18
+
+    def write(self, data: bytes):
+        """Writes raw data (i.e. the handshake) immediately."""
+        self._transport.write(data)
+
+    def send(self, portions: Sequence[bytes], *, bulk: bool=False):
+        """Queues a message consisting of `portions`.
+
+        Messages queued during one event loop iteration are written with a single writelines() call. Control
+        messages are written first. Bulk messages (i.e. `piece`) are passed to the transport only while its buffer
+        isn't full, so control messages queued later don't have to wait until all the bulk data is sent.
+        """
+
+        if bulk:
+            length = sum(len(portion) for portion in portions)
+            self._bulk_queue.append((portions, length, None))
+            self._bulk_queued_size += length
+        else:
+            self._control_queue.extend(portions)
+        self._schedule_flush()
+
+    @property
+    def files_sendable(self) -> bool:
+        return self._files_sendable
+
+    def send_file(self, header: bytes, file_regions: FileRegions):
+        """Queues a bulk message consisting of `header` and data located in files. The data is sent with
+        loop.sendfile() from the page cache to the socket without copying. The protocol releases `file_regions`
+        when the data is sent.
+
+        The transport buffer must be empty while sendfile() writes to the socket, so control messages queued
+        in the meantime are written between the file messages.
+        """
+
+        if not self._files_sendable:
+            raise RuntimeError('Transport does not support sendfile()')
+        if self._transport.is_closing():
+            file_regions.release()
+            return
+
+        length = len(header) + sum(length for _, _, length in file_regions.regions)
+        self._bulk_queue.append(((header,), length, file_regions))
+        self._bulk_queued_size += length
+        self._schedule_flush()
+
+    def _clear_send_queues(self):
+        self._control_queue.clear()
+        for _, _, file_regions in self._bulk_queue:
+            if file_regions is not None:
+                file_regions.release()
+        self._bulk_queue.clear()
+        self._bulk_queued_size = 0
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        transport = self._transport
+        if transport.is_closing():
+            self._clear_send_queues()
+            return
+        if self._send_files_task is not None:
+            return  # _send_files() writes other messages between the file messages
+
+        data = self._control_queue
+        self._control_queue = []
+        bulk_queue = self._bulk_queue
+        while True:
+            size = 0
+            while (bulk_queue and bulk_queue[0][2] is None and not self._writing_paused and
+                   size < PeerWireProtocol.BULK_WRITE_SIZE):
+                portions, length, _ = bulk_queue.popleft()
+                data.extend(portions)
+                size += length
+            self._bulk_queued_size -= size
+            if data:
+                transport.writelines(data)  # May call pause_writing()
+            if not bulk_queue or self._writing_paused:
+                break
+            if bulk_queue[0][2] is not None:
+                self._send_files_task = asyncio.ensure_future(self._send_files())
+                break
+            data = []
+
+        if self._is_drained():
+            self._wake_drain_waiter()
+
+    async def _send_region(self, fd: Optional[int], file_pos: int, length: int):
+        transport = self._transport
+        if fd is None:
+            transport.write(bytes(length))  # The file isn't created yet, so the data is zero
+            return
+
+        # The descriptor belongs to the descriptor cache, so the file object doesn't close it
+        with open(fd, 'rb', buffering=0, closefd=False) as file:
+            try:
+                # Waits until the transport buffer is flushed
+                await self._loop.sendfile(transport, file, file_pos, length, fallback=False)
+                return
+            except asyncio.SendfileNotAvailableError:  # The file doesn't support sendfile()
+                pass
+        # Reading of data that isn't in the page cache mustn't block the event loop
+        transport.write(await DiskIOEngine.get_instance().submit(_read_region, fd, file_pos, length))
+
+    def _cancel_sending_files(self):
+        # The task must be cancelled before the transport is closed, so loop.sendfile() finishes first
+        if self._send_files_task is not None:
+            self._send_files_task.cancel()
+
+    async def _send_files(self):
+        """Sends messages with payloads stored in files while they're at the head of the bulk queue."""
+
+        transport = self._transport
+        bulk_queue = self._bulk_queue
+        try:
+            while bulk_queue and bulk_queue[0][2] is not None and not transport.is_closing():
+                if self._control_queue:
+                    transport.writelines(self._control_queue)
+                    self._control_queue = []
+
+                portions, length, file_regions = bulk_queue.popleft()
+                self._bulk_queued_size -= length
+                try:
+                    transport.writelines(portions)
+                    for fd, file_pos, region_length in file_regions.regions:
+                        await self._send_region(fd, file_pos, region_length)
+                finally:
+                    file_regions.release()
+
+                if self._is_drained():
+                    self._wake_drain_waiter()
+        except Exception as e:
+            self.abort(e)
+            return
+        finally:
+            self._send_files_task = None
+        self._flush()
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._bulk_queue:
+            self._schedule_flush()
+        else:
+            self._wake_drain_waiter()
+
+    def _is_drained(self) -> bool:
+        return not self._writing_paused and self._bulk_queued_size <= PeerWireProtocol.MAX_BULK_QUEUED_SIZE
+
+    def _wake_drain_waiter(self):
+        waiter = self._drain_waiter
+        if waiter is not None:
+            self._drain_waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def drain(self):
+        """Waits until the size of queued bulk messages is within the limit and the transport buffer isn't full."""
+
+        if self._transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        if self._is_drained():
+            return
+        if self._drain_waiter is None:
+            self._drain_waiter = self._loop.create_future()
+        await asyncio.shield(self._drain_waiter)
+
+    def close(self):
+        if self._transport is not None:
+            self._cancel_sending_files()
+            self._transport.close()
+
+    def abort(self, exc: Exception):
+        """Closes the connection without sending queued data. `exc` is raised by the following receive calls."""
+
+        self._set_exception(exc)
+        self._cancel_sending_files()
+        self._transport.abort()
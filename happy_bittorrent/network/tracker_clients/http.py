@@ -4,8 +4,8 @@ from collections import OrderedDict
 from typing import Optional, cast
 
 import aiohttp
-import bencodepy
 
+from happy_bittorrent import bencode
 from happy_bittorrent.utils import get_auth_key
 from happy_bittorrent.models import Peer, DownloadInfo
 from happy_bittorrent.network.tracker_clients.base import BaseTrackerClient, TrackerError, parse_compact_peers_list, \
@@ -79,8 +79,8 @@ class HTTPTrackerClient(BaseTrackerClient):
                 response = await conn.read()
 
         try:
-            response = bencodepy.decode(response)
-        except bencodepy.DecodingError as e:
+            response = bencode.decode(response)
+        except bencode.DecodingError:
             if isinstance(response, bytes):
                 response = response.decode()
             raise TrackerError(response)
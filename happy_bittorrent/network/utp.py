@@ -0,0 +1,869 @@
+"""uTP (BEP 29): reliable streams over UDP with LEDBAT congestion control.
+
+uTP connections are asyncio transports, so PeerWireProtocol works over them as over TCP. Unlike TCP, LEDBAT
+reacts to growth of the one-way delay instead of packet loss: the sender keeps queueing delay on the path near
+TARGET_DELAY, so seeding doesn't fill router queues shared with latency-sensitive traffic.
+"""
+
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+from collections import deque, OrderedDict
+from enum import Enum
+from typing import Callable, Optional, Tuple
+
+
+__all__ = ['UTPSocket', 'UTPConnection']
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class PacketType(Enum):
+    data = 0
+    fin = 1
+    state = 2
+    reset = 3
+    syn = 4
+
+
+_packet_types = {item.value: item for item in PacketType}
+
+UTP_VERSION = 1
+
+# type/version, extension, connection_id, timestamp_microseconds, timestamp_difference_microseconds, wnd_size,
+# seq_nr, ack_nr
+_header_struct = struct.Struct('!BBHIIIHH')
+HEADER_SIZE = _header_struct.size
+
+SELECTIVE_ACK_EXTENSION = 1
+
+_SEQ_MASK = 0xFFFF
+_TIMESTAMP_MASK = 0xFFFFFFFF
+
+Address = Tuple[str, int]
+
+
+def _seq_diff(a: int, b: int) -> int:
+    """Signed difference of 16-bit sequence numbers that may wrap around."""
+    return ((a - b + 0x8000) & _SEQ_MASK) - 0x8000
+
+
+def _timestamp_less(a: int, b: int) -> bool:
+    return a != b and ((b - a) & _TIMESTAMP_MASK) < 2 ** 31
+
+
+def _get_timestamp() -> int:
+    return int(time.monotonic() * 10 ** 6) & _TIMESTAMP_MASK
+
+
+class _DelayHistory:
+    """Tracks the base delay, i.e. the minimum of one-way delay samples over the last BASE_HISTORY intervals.
+
+    Samples include an unknown offset between the clocks of the hosts (modulo 2 ** 32). It cancels out when
+    the base is subtracted, so the result is the queueing delay.
+    """
+
+    INTERVAL = 60
+    BASE_HISTORY = 2
+
+    def __init__(self):
+        self._bases = deque()  # type: Deque[int]
+        self._interval_start = None  # type: Optional[float]
+
+    def add_sample(self, sample: int, now: float) -> int:
+        """Returns the queueing delay corresponding to the sample (in microseconds)."""
+
+        if self._interval_start is None or now - self._interval_start >= _DelayHistory.INTERVAL:
+            self._interval_start = now
+            self._bases.append(sample)
+            if len(self._bases) > _DelayHistory.BASE_HISTORY:
+                self._bases.popleft()
+        elif _timestamp_less(sample, self._bases[-1]):
+            self._bases[-1] = sample
+
+        base = self._bases[0]
+        for item in self._bases:
+            if _timestamp_less(item, base):
+                base = item
+        return (sample - base) & _TIMESTAMP_MASK
+
+
+class _OutgoingPacket:
+    __slots__ = ('type', 'payload', 'sent_time', 'transmissions', 'need_resend')
+
+    def __init__(self, packet_type: PacketType, payload: bytes):
+        self.type = packet_type
+        self.payload = payload
+        self.sent_time = None  # type: Optional[float]
+        self.transmissions = 0
+        self.need_resend = False
+
+
+class ConnectionState(Enum):
+    syn_sent = 0
+    syn_received = 1
+    connected = 2
+    closed = 3
+
+
+class UTPConnection(asyncio.Transport):
+    PACKET_SIZE = 1400  # Payload size that fits into Ethernet MTU with IP and UDP headers
+
+    TARGET_DELAY = 100000  # In microseconds
+    MAX_WINDOW_INCREASE_PER_RTT = 3000
+    MIN_WINDOW = PACKET_SIZE
+    MAX_WINDOW = 2 ** 20
+    RECEIVE_WINDOW = 2 ** 20
+
+    INITIAL_TIMEOUT = 1
+    MIN_TIMEOUT = 0.5
+    MAX_TIMEOUT = 8
+    MAX_TRANSMISSIONS = 6
+    DUPLICATE_ACKS_BEFORE_RESEND = 3
+    MAX_REORDERED_PACKETS = 1024
+
+    WRITE_BUFFER_HIGH_WATER = 2 ** 16
+    WRITE_BUFFER_LOW_WATER = 2 ** 14
+
+    def __init__(self, utp_socket: 'UTPSocket', address: Address, receive_id: int, send_id: int,
+                 state: ConnectionState):
+        super().__init__(extra={'peername': address, 'sockname': utp_socket.get_extra_info('sockname')})
+        self._socket = utp_socket
+        self._loop = asyncio.get_event_loop()
+        self._address = address
+        self._receive_id = receive_id
+        self._send_id = send_id
+        self._state = state
+        self._protocol = None  # type: Optional[asyncio.BaseProtocol]
+        self._connect_waiter = None  # type: Optional[asyncio.Future]
+
+        self._seq_nr = 1 if state == ConnectionState.syn_sent else random.randrange(2 ** 16)
+        self._ack_nr = 0
+        self._reply_micro = 0  # Delay sample for the peer's direction, echoed in our packets
+
+        self._send_buffer = bytearray()
+        self._send_buffer_pos = 0
+        self._in_flight = OrderedDict()  # type: Dict[int, _OutgoingPacket]
+        self._cur_window = 0
+        self._max_window = UTPConnection.MIN_WINDOW * 2
+        self._peer_window = UTPConnection.RECEIVE_WINDOW
+        self._delay_history = _DelayHistory()
+        self._last_delay = None  # type: Optional[int]
+        self._resend_count = 0
+        self._duplicate_acks = 0
+        self._last_loss_time = None  # type: Optional[float]
+        self._slow_start = True
+        self._recovery_seq = None  # type: Optional[int]  # The last packet sent before a loss was detected
+        self._last_sacked_sent_time = None  # type: Optional[float]
+
+        self._rtt = None  # type: Optional[float]
+        self._rtt_var = 0.0
+        self._timeout = UTPConnection.INITIAL_TIMEOUT
+        self._timer = None  # type: Optional[asyncio.TimerHandle]
+
+        self._reordered = {}  # type: Dict[int, Tuple[PacketType, bytes]]
+        self._pending_data = deque()  # type: Deque[bytes]  # Received while reading is paused
+        self._pending_size = 0
+        self._reading_paused = False
+        self._ack_needed = False
+
+        self._closing = False
+        self._fin_sent = False
+        self._high_water = UTPConnection.WRITE_BUFFER_HIGH_WATER
+        self._low_water = UTPConnection.WRITE_BUFFER_LOW_WATER
+        self._writing_paused = False
+
+    @property
+    def receive_id(self) -> int:
+        return self._receive_id
+
+    @property
+    def send_id(self) -> int:
+        return self._send_id
+
+    @property
+    def queueing_delay(self) -> Optional[float]:
+        """The last measured queueing delay on the way to the peer (in seconds)."""
+        return self._last_delay / 10 ** 6 if self._last_delay is not None else None
+
+    # Connection setup
+
+    async def connect(self):
+        self._connect_waiter = self._loop.create_future()
+        self._send_new_packet(PacketType.syn, b'')
+        await self._connect_waiter
+
+    def accept(self, syn_seq_nr: int, timestamp: int):
+        self._ack_nr = syn_seq_nr
+        self._reply_micro = (_get_timestamp() - timestamp) & _TIMESTAMP_MASK
+        self._send_state()
+
+    def set_protocol(self, protocol: asyncio.BaseProtocol):
+        self._protocol = protocol
+
+    def get_protocol(self) -> asyncio.BaseProtocol:
+        return self._protocol
+
+    # Sending
+
+    MAX_SELECTIVE_ACK_SIZE = 64
+
+    def _build_selective_ack(self) -> bytes:
+        mask = bytearray(UTPConnection.MAX_SELECTIVE_ACK_SIZE)
+        last_index = 0
+        for seq_nr in self._reordered:
+            index = _seq_diff(seq_nr, self._ack_nr) - 2
+            if 0 <= index < len(mask) * 8:
+                mask[index >> 3] |= 1 << (index & 7)
+                last_index = max(last_index, index)
+        # The size must be a multiple of 4
+        return bytes(mask[:(last_index // 32 + 1) * 4])
+
+    def _send_packet(self, packet_type: PacketType, seq_nr: int, payload: bytes):
+        window = max(UTPConnection.RECEIVE_WINDOW - self._pending_size - self._get_reordered_size(), 0)
+        # The SYN carries our receive ID, the peer derives its IDs from it
+        connection_id = self._receive_id if packet_type == PacketType.syn else self._send_id
+        extension = 0
+        if self._reordered:
+            extension = SELECTIVE_ACK_EXTENSION
+            selective_ack = self._build_selective_ack()
+            payload = bytes([0, len(selective_ack)]) + selective_ack + payload
+        header = _header_struct.pack((packet_type.value << 4) | UTP_VERSION, extension, connection_id,
+                                     _get_timestamp(), self._reply_micro, window, seq_nr, self._ack_nr)
+        self._socket.send_datagram(header + payload, self._address)
+        self._ack_needed = False
+
+    def _send_state(self):
+        # State packets don't consume sequence numbers
+        self._send_packet(PacketType.state, self._seq_nr, b'')
+
+    def _schedule_ack(self):
+        if not self._ack_needed:
+            self._ack_needed = True
+            # Packets received during one iteration of the event loop are acknowledged together
+            self._loop.call_soon(self._send_delayed_ack)
+
+    def _send_delayed_ack(self):
+        if self._ack_needed and self._state != ConnectionState.closed:
+            self._send_state()
+
+    def _transmit(self, seq_nr: int, packet: _OutgoingPacket):
+        packet.sent_time = self._loop.time()
+        packet.transmissions += 1
+        if packet.need_resend:
+            packet.need_resend = False
+            self._resend_count -= 1
+        self._cur_window += len(packet.payload)
+        self._send_packet(packet.type, seq_nr, packet.payload)
+        if self._timer is None:
+            self._schedule_timer()
+
+    def _send_new_packet(self, packet_type: PacketType, payload: bytes):
+        seq_nr = self._seq_nr
+        self._seq_nr = (seq_nr + 1) & _SEQ_MASK
+        packet = _OutgoingPacket(packet_type, payload)
+        self._in_flight[seq_nr] = packet
+        self._transmit(seq_nr, packet)
+
+    def _get_buffered_size(self) -> int:
+        return len(self._send_buffer) - self._send_buffer_pos
+
+    def _flush(self, probe: bool=False):
+        if self._state != ConnectionState.connected:
+            return
+
+        window = min(self._max_window, self._peer_window)
+        if self._resend_count:
+            for seq_nr, packet in self._in_flight.items():
+                if packet.need_resend:
+                    if self._cur_window + len(packet.payload) > window and not probe:
+                        return
+                    self._transmit(seq_nr, packet)
+                    probe = False
+
+        buf = self._send_buffer
+        while self._send_buffer_pos < len(buf):
+            size = min(UTPConnection.PACKET_SIZE, len(buf) - self._send_buffer_pos)
+            if self._cur_window + size > window and not probe:
+                break
+            payload = bytes(buf[self._send_buffer_pos:self._send_buffer_pos + size])
+            self._send_buffer_pos += size
+            self._send_new_packet(PacketType.data, payload)
+            probe = False
+
+        if self._send_buffer_pos == len(buf):
+            buf.clear()
+            self._send_buffer_pos = 0
+        elif self._send_buffer_pos >= UTPConnection.WRITE_BUFFER_HIGH_WATER:
+            # Compact the buffer occasionally, so taking packets from it doesn't move the rest each time
+            del buf[:self._send_buffer_pos]
+            self._send_buffer_pos = 0
+
+        if self._writing_paused and self._get_buffered_size() <= self._low_water:
+            self._writing_paused = False
+            self._protocol.resume_writing()
+
+        if self._closing and not self._fin_sent and not self._get_buffered_size():
+            self._fin_sent = True
+            self._send_new_packet(PacketType.fin, b'')
+        elif self._get_buffered_size() and self._timer is None:
+            self._schedule_timer()  # The peer's window is closed, it will be probed
+
+    def write(self, data: bytes):
+        if self._closing or self._state == ConnectionState.closed:
+            return
+        if not data:
+            return
+        self._send_buffer += data
+        self._flush()
+
+        if not self._writing_paused and self._get_buffered_size() > self._high_water:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def get_write_buffer_size(self) -> int:
+        return self._get_buffered_size()
+
+    def get_write_buffer_limits(self) -> Tuple[int, int]:
+        return self._low_water, self._high_water
+
+    def set_write_buffer_limits(self, high: int=None, low: int=None):
+        if high is None:
+            high = UTPConnection.WRITE_BUFFER_HIGH_WATER if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self._high_water = high
+        self._low_water = low
+
+    # Acknowledgements and congestion control
+
+    def _update_rtt(self, sample: float):
+        if self._rtt is None:
+            self._rtt = sample
+            self._rtt_var = sample / 2
+        else:
+            self._rtt_var += (abs(self._rtt - sample) - self._rtt_var) / 4
+            self._rtt += (sample - self._rtt) / 8
+        self._timeout = min(max(self._rtt + 4 * self._rtt_var, UTPConnection.MIN_TIMEOUT), UTPConnection.MAX_TIMEOUT)
+
+    def _update_window(self, acked_bytes: int, delay_sample: int, window_limited: bool):
+        if delay_sample:
+            self._last_delay = self._delay_history.add_sample(delay_sample, self._loop.time())
+        if self._last_delay is None:
+            return
+
+        # LEDBAT: the window grows proportionally to how far the delay is below the target and shrinks
+        # when the delay exceeds it
+        off_target = (UTPConnection.TARGET_DELAY - self._last_delay) / UTPConnection.TARGET_DELAY
+        if off_target > 0 and not window_limited:
+            return  # The sender doesn't use the whole window, so there's no evidence it can be larger
+        if self._slow_start:
+            if off_target > 0.5:
+                # Until queues start to grow, the window doubles every RTT like in TCP slow start
+                self._max_window = min(self._max_window + acked_bytes, UTPConnection.MAX_WINDOW)
+                return
+            self._slow_start = False
+        window_factor = min(acked_bytes, self._max_window) / max(self._max_window, acked_bytes)
+        gain = UTPConnection.MAX_WINDOW_INCREASE_PER_RTT * off_target * window_factor
+        self._max_window = min(max(self._max_window + gain, UTPConnection.MIN_WINDOW), UTPConnection.MAX_WINDOW)
+
+    def _resend_first(self):
+        seq_nr = next(iter(self._in_flight))
+        packet = self._in_flight[seq_nr]
+        if packet.transmissions > 1 and not packet.need_resend:
+            return  # The packet was already resent, a timeout will detect if it's lost again
+        if not packet.need_resend:
+            packet.need_resend = True
+            self._resend_count += 1
+            self._cur_window -= len(packet.payload)
+        self._transmit(seq_nr, packet)
+
+    def _on_loss(self):
+        # Like TCP, the window is halved on a loss, but not more often than once per RTT
+        self._recovery_seq = (self._seq_nr - 1) & _SEQ_MASK
+        now = self._loop.time()
+        if self._last_loss_time is None or now - self._last_loss_time >= (self._rtt or 0):
+            self._last_loss_time = now
+            self._slow_start = False
+            self._max_window = max(self._max_window / 2, UTPConnection.MIN_WINDOW)
+
+    def _acknowledge(self, seq_nr: int, now: float) -> _OutgoingPacket:
+        packet = self._in_flight.pop(seq_nr)
+        if packet.need_resend:
+            self._resend_count -= 1
+        else:
+            self._cur_window -= len(packet.payload)
+        if packet.transmissions == 1:  # Karn's algorithm
+            self._update_rtt(now - packet.sent_time)
+        return packet
+
+    def _process_selective_ack(self, ack_nr: int, selective_ack: bytes, now: float) -> int:
+        # Bit i of the mask (starting from the least significant bit of the first byte) is set if the packet
+        # ack_nr + 2 + i was received. The packet ack_nr + 1 is missing, otherwise it would be acknowledged.
+        in_flight = self._in_flight
+        acked_bytes = 0
+        received_after = 0
+        lost = False
+        # Packets are processed from the end, so the count of received packets following a hole is known
+        for i in range(len(selective_ack) * 8 - 1, -2, -1):
+            seq_nr = (ack_nr + 2 + i) & _SEQ_MASK
+            packet = in_flight.get(seq_nr)
+            if i >= 0 and selective_ack[i >> 3] & (1 << (i & 7)):
+                received_after += 1
+                if packet is not None:
+                    if self._last_sacked_sent_time is None or packet.sent_time > self._last_sacked_sent_time:
+                        self._last_sacked_sent_time = packet.sent_time
+                    self._acknowledge(seq_nr, now)
+                    acked_bytes += len(packet.payload)
+            elif (packet is not None and not packet.need_resend and
+                    received_after >= UTPConnection.DUPLICATE_ACKS_BEFORE_RESEND and
+                    self._last_sacked_sent_time is not None and packet.sent_time < self._last_sacked_sent_time):
+                # Packets sent later were received, so this one is lost (unless it was already resent after them)
+                packet.need_resend = True
+                self._resend_count += 1
+                self._cur_window -= len(packet.payload)
+                lost = True
+        if lost:
+            self._on_loss()
+        return acked_bytes
+
+    def _process_ack(self, packet_type: PacketType, ack_nr: int, delay_sample: int,
+                     selective_ack: Optional[bytes]):
+        in_flight = self._in_flight
+        window_limited = self._cur_window + UTPConnection.PACKET_SIZE > self._max_window
+
+        acked_bytes = 0
+        now = self._loop.time()
+        while in_flight:
+            seq_nr = next(iter(in_flight))
+            if _seq_diff(ack_nr, seq_nr) < 0:
+                break
+            packet = self._acknowledge(seq_nr, now)
+            acked_bytes += len(packet.payload)
+        advanced = bool(acked_bytes)
+        if selective_ack is not None and in_flight:
+            acked_bytes += self._process_selective_ack(ack_nr, selective_ack, now)
+
+        if acked_bytes:
+            self._update_window(acked_bytes, delay_sample, window_limited)
+        if advanced:
+            self._duplicate_acks = 0
+            if self._recovery_seq is not None:
+                if not in_flight or _seq_diff(self._recovery_seq, ack_nr) <= 0:
+                    self._recovery_seq = None
+                elif selective_ack is None:
+                    # A partial acknowledgement: several packets sent before the loss was detected are lost,
+                    # the next one is resent without waiting for a timeout (like in TCP NewReno)
+                    self._resend_first()
+        elif (selective_ack is None and packet_type == PacketType.state and in_flight and
+                _seq_diff(next(iter(in_flight)), ack_nr) == 1):
+            self._duplicate_acks += 1
+            if self._duplicate_acks == UTPConnection.DUPLICATE_ACKS_BEFORE_RESEND and self._recovery_seq is None:
+                # The packet following the acknowledged one is probably lost
+                self._resend_first()
+                self._on_loss()
+
+        if self._fin_sent and not in_flight:
+            # The FIN is the last packet, it could be acknowledged selectively before the packets preceding it
+            self._finish(None)
+
+    # Timeouts
+
+    def _schedule_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._state == ConnectionState.closed:
+            return
+
+        if self._in_flight:
+            oldest = next(iter(self._in_flight.values()))
+            if oldest.sent_time is not None:
+                self._timer = self._loop.call_at(oldest.sent_time + self._timeout, self._on_timer)
+                return
+        if self._get_buffered_size():
+            self._timer = self._loop.call_later(self._timeout, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        if self._state == ConnectionState.closed:
+            return
+
+        if not self._in_flight:
+            self._flush(probe=True)
+            self._schedule_timer()
+            return
+
+        oldest = next(iter(self._in_flight.values()))
+        if oldest.sent_time is not None and self._loop.time() < oldest.sent_time + self._timeout:
+            self._schedule_timer()
+            return
+        if oldest.transmissions >= UTPConnection.MAX_TRANSMISSIONS:
+            self._fail(asyncio.TimeoutError('uTP connection timed out'))
+            return
+
+        # Everything in flight is considered lost, sending starts again with a minimal window
+        self._timeout = min(self._timeout * 2, UTPConnection.MAX_TIMEOUT)
+        self._max_window = UTPConnection.MIN_WINDOW
+        self._slow_start = False
+        self._recovery_seq = None
+        for packet in self._in_flight.values():
+            if not packet.need_resend:
+                packet.need_resend = True
+                self._resend_count += 1
+                self._cur_window -= len(packet.payload)
+
+        if self._state == ConnectionState.syn_sent:
+            seq_nr = next(iter(self._in_flight))
+            self._transmit(seq_nr, self._in_flight[seq_nr])
+        else:
+            self._flush(probe=True)
+        self._schedule_timer()
+
+    # Receiving
+
+    def _get_reordered_size(self) -> int:
+        return len(self._reordered) * UTPConnection.PACKET_SIZE
+
+    def packet_received(self, packet_type: PacketType, seq_nr: int, ack_nr: int, timestamp: int,
+                        timestamp_difference: int, wnd_size: int, selective_ack: Optional[bytes], payload: bytes):
+        if self._state == ConnectionState.closed:
+            return
+        self._reply_micro = (_get_timestamp() - timestamp) & _TIMESTAMP_MASK
+        self._peer_window = wnd_size
+
+        if packet_type == PacketType.reset:
+            if self._fin_sent:
+                self._finish(None)  # The peer closed the connection after receiving everything
+            else:
+                self._fail(ConnectionResetError('uTP connection reset by peer'))
+            return
+
+        if self._state == ConnectionState.syn_sent:
+            if packet_type != PacketType.state:
+                return
+            # The state packet carries the sequence number of the peer's first data packet
+            self._ack_nr = (seq_nr - 1) & _SEQ_MASK
+            self._state = ConnectionState.connected
+            self._process_ack(packet_type, ack_nr, timestamp_difference, selective_ack)
+            if not self._connect_waiter.done():
+                self._connect_waiter.set_result(None)
+            return
+
+        if packet_type == PacketType.syn:
+            # Our response to the SYN was lost
+            if self._state == ConnectionState.syn_received:
+                self._send_state()
+            return
+        if self._state == ConnectionState.syn_received:
+            # The peer received our state packet, so it's ready to receive data
+            self._state = ConnectionState.connected
+
+        self._process_ack(packet_type, ack_nr, timestamp_difference, selective_ack)
+        if self._state == ConnectionState.closed:
+            return
+
+        if packet_type in (PacketType.data, PacketType.fin):
+            self._receive_payload(packet_type, seq_nr, payload)
+        self._flush()
+
+    def _receive_payload(self, packet_type: PacketType, seq_nr: int, payload: bytes):
+        self._schedule_ack()
+
+        distance = _seq_diff(seq_nr, self._ack_nr)
+        if distance <= 0 or distance > UTPConnection.MAX_REORDERED_PACKETS:
+            return  # A duplicate or a packet far outside of the window
+        if distance > 1:
+            self._reordered[seq_nr] = (packet_type, payload)
+            return
+
+        while True:
+            self._ack_nr = seq_nr
+            if packet_type == PacketType.fin:
+                self._eof_received()
+                return
+            self._deliver(payload)
+
+            seq_nr = (seq_nr + 1) & _SEQ_MASK
+            item = self._reordered.pop(seq_nr, None)
+            if item is None:
+                return
+            packet_type, payload = item
+
+    def _deliver(self, data: bytes):
+        if not data:
+            return
+        if self._reading_paused or self._pending_data:
+            self._pending_data.append(data)
+            self._pending_size += len(data)
+            return
+        self._feed_protocol(data)
+
+    def _feed_protocol(self, data: bytes):
+        protocol = self._protocol
+        if self._state == ConnectionState.closed:
+            return
+        if not isinstance(protocol, asyncio.BufferedProtocol):
+            protocol.data_received(data)
+            return
+
+        data = memoryview(data)
+        # The protocol may close the connection while it processes the data
+        while data and self._state != ConnectionState.closed:
+            buf = protocol.get_buffer(len(data))
+            if not len(buf):
+                # The protocol can't accept more data (e.g. the peer declared a too long message)
+                self._abort(RuntimeError('get_buffer() returned an empty buffer'))
+                return
+            size = min(len(buf), len(data))
+            buf[:size] = data[:size]
+            protocol.buffer_updated(size)
+            data = data[size:]
+
+    def _eof_received(self):
+        self._send_state()
+        keep_open = self._protocol.eof_received()
+        if not keep_open:
+            self._finish(None)
+
+    def pause_reading(self):
+        self._reading_paused = True
+
+    def resume_reading(self):
+        if not self._reading_paused:
+            return
+        self._reading_paused = False
+        pending = self._pending_data
+        while pending and not self._reading_paused and self._state != ConnectionState.closed:
+            data = pending.popleft()
+            self._pending_size -= len(data)
+            self._feed_protocol(data)
+        if self._state != ConnectionState.closed:
+            self._send_state()  # Let the peer know the window is open again
+
+    def is_reading(self) -> bool:
+        return not self._reading_paused
+
+    # Closing
+
+    def is_closing(self) -> bool:
+        return self._closing or self._state == ConnectionState.closed
+
+    def close(self):
+        if self.is_closing():
+            return
+        self._closing = True
+        if self._state == ConnectionState.connected:
+            self._flush()
+        else:
+            self.abort()
+
+    def abort(self):
+        self._abort(None)
+
+    def _abort(self, exc: Optional[Exception]):
+        if self._state == ConnectionState.closed:
+            return
+        if self._state != ConnectionState.syn_sent:
+            self._send_packet(PacketType.reset, self._seq_nr, b'')
+        if exc is not None:
+            self._fail(exc)
+        else:
+            self._finish(None)
+
+    def _fail(self, exc: Exception):
+        if self._connect_waiter is not None and not self._connect_waiter.done():
+            self._connect_waiter.set_exception(exc)
+        self._finish(exc)
+
+    def _finish(self, exc: Optional[Exception]):
+        if self._state == ConnectionState.closed:
+            return
+        self._state = ConnectionState.closed
+        self._closing = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._socket.unregister(self)
+        self._in_flight.clear()
+        self._resend_count = 0
+        self._reordered.clear()
+        self._pending_data.clear()
+        self._send_buffer = bytearray()
+
+        if self._protocol is not None:
+            self._loop.call_soon(self._protocol.connection_lost, exc)
+
+
+class UTPSocket(asyncio.DatagramProtocol):
+    """UDP endpoint multiplexing uTP connections. Accepts incoming connections if `protocol_factory` is set."""
+
+    def __init__(self, protocol_factory: Callable[[], asyncio.BaseProtocol]=None):
+        self._protocol_factory = protocol_factory
+        self._transport = None  # type: asyncio.DatagramTransport
+        self._connections = {}  # type: Dict[Tuple[Address, int], UTPConnection]
+        self._unsupported_addresses = OrderedDict()  # type: Dict[Address, float]  # Values are times of failures
+
+    @classmethod
+    async def create(cls, port: int, protocol_factory: Callable[[], asyncio.BaseProtocol]=None) -> 'UTPSocket':
+        utp_socket = cls(protocol_factory)
+        await asyncio.get_event_loop().create_datagram_endpoint(lambda: utp_socket, local_addr=('0.0.0.0', port))
+        return utp_socket
+
+    SOCKET_BUFFER_SIZE = 2 ** 21  # Holds a whole window of every connection during bursts
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self._transport = transport
+
+        sock = transport.get_extra_info('socket')
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, UTPSocket.SOCKET_BUFFER_SIZE)
+            except OSError:
+                pass  # The system limit is used
+
+    def connection_lost(self, exc: Optional[Exception]):
+        for connection in list(self._connections.values()):
+            connection._fail(exc if exc is not None else ConnectionResetError('uTP socket closed'))
+
+    def error_received(self, exc: Exception):
+        logger.debug('uTP socket error: %r', exc)
+
+    def get_extra_info(self, name: str, default=None):
+        if self._transport is None:
+            return default
+        return self._transport.get_extra_info(name, default)
+
+    def send_datagram(self, data: bytes, address: Address):
+        if self._transport is not None and not self._transport.is_closing():
+            self._transport.sendto(data, address)
+
+    def unregister(self, connection: UTPConnection):
+        key = (connection.get_extra_info('peername'), connection.receive_id)
+        if self._connections.get(key) is connection:
+            del self._connections[key]
+
+    def datagram_received(self, data: bytes, addr: Tuple):
+        if len(data) < HEADER_SIZE:
+            return
+        (type_ver, extension, connection_id, timestamp, timestamp_difference,
+         wnd_size, seq_nr, ack_nr) = _header_struct.unpack_from(data)
+        packet_type = _packet_types.get(type_ver >> 4)
+        if type_ver & 0x0F != UTP_VERSION or packet_type is None:
+            return
+
+        pos = HEADER_SIZE
+        selective_ack = None
+        while extension:
+            if pos + 2 > len(data):
+                return
+            next_extension, length = data[pos], data[pos + 1]
+            if extension == SELECTIVE_ACK_EXTENSION:
+                selective_ack = data[pos + 2:pos + 2 + length]
+            extension = next_extension
+            pos += 2 + length
+        if pos > len(data):
+            return
+        payload = data[pos:]
+
+        address = addr[:2]
+        if packet_type == PacketType.syn:
+            connection = self._connections.get((address, (connection_id + 1) & _SEQ_MASK))
+            if connection is None:
+                self._accept(address, connection_id, seq_nr, timestamp)
+                return
+        elif packet_type == PacketType.reset:
+            connection = self._find_reset_connection(address, connection_id)
+            if connection is None:
+                return
+        else:
+            connection = self._connections.get((address, connection_id))
+            if connection is None:
+                # E.g. the connection was closed, but the peer didn't receive the acknowledgement of its FIN
+                self._send_reset(address, connection_id, seq_nr)
+                return
+        connection.packet_received(packet_type, seq_nr, ack_nr, timestamp, timestamp_difference, wnd_size,
+                                   selective_ack, payload)
+
+    def _find_reset_connection(self, address: Address, connection_id: int) -> Optional[UTPConnection]:
+        # A reset sent in response to an unknown packet carries the peer's receive ID, i.e. our send ID.
+        # Our receive ID differs from it by one depending on who initiated the connection.
+        connection = self._connections.get((address, connection_id))
+        if connection is not None:
+            return connection
+        for receive_id in ((connection_id + 1) & _SEQ_MASK, (connection_id - 1) & _SEQ_MASK):
+            connection = self._connections.get((address, receive_id))
+            if connection is not None and connection.send_id == connection_id:
+                return connection
+        return None
+
+    def _send_reset(self, address: Address, connection_id: int, ack_nr: int):
+        header = _header_struct.pack((PacketType.reset.value << 4) | UTP_VERSION, 0, connection_id,
+                                     _get_timestamp(), 0, 0, random.randrange(2 ** 16), ack_nr)
+        self.send_datagram(header, address)
+
+    def _accept(self, address: Address, connection_id: int, seq_nr: int, timestamp: int):
+        if self._protocol_factory is None:
+            return
+        connection = UTPConnection(self, address, (connection_id + 1) & _SEQ_MASK, connection_id,
+                                   ConnectionState.syn_received)
+        self._connections[(address, connection.receive_id)] = connection
+        connection.accept(seq_nr, timestamp)
+
+        protocol = self._protocol_factory()
+        connection.set_protocol(protocol)
+        protocol.connection_made(connection)
+
+    async def create_connection(self, protocol_factory: Callable[[], asyncio.BaseProtocol],
+                                host: str, port: int) -> Tuple[UTPConnection, asyncio.BaseProtocol]:
+        address = (host, port)
+        while True:
+            receive_id = random.randrange(2 ** 16)
+            if (address, receive_id) not in self._connections:
+                break
+        connection = UTPConnection(self, address, receive_id, (receive_id + 1) & _SEQ_MASK,
+                                   ConnectionState.syn_sent)
+        self._connections[(address, receive_id)] = connection
+        try:
+            await connection.connect()
+        except BaseException:
+            connection.abort()
+            raise
+
+        protocol = protocol_factory()
+        connection.set_protocol(protocol)
+        protocol.connection_made(connection)
+        return connection, protocol
+
+    MAX_UNSUPPORTED_ADDRESSES = 4096
+    UNSUPPORTED_ADDRESS_RETRY_INTERVAL = 60 * 60
+
+    def is_supported(self, host: str, port: int) -> bool:
+        """Returns False if a connection to this address recently failed, so the peer likely doesn't support uTP."""
+
+        failure_time = self._unsupported_addresses.get((host, port))
+        if failure_time is None:
+            return True
+        if time.monotonic() - failure_time >= UTPSocket.UNSUPPORTED_ADDRESS_RETRY_INTERVAL:
+            del self._unsupported_addresses[(host, port)]
+            return True
+        return False
+
+    def mark_unsupported(self, host: str, port: int):
+        address = (host, port)
+        self._unsupported_addresses.pop(address, None)
+        self._unsupported_addresses[address] = time.monotonic()
+        if len(self._unsupported_addresses) > UTPSocket.MAX_UNSUPPORTED_ADDRESSES:
+            self._unsupported_addresses.popitem(last=False)
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
@@ -0,0 +1,57 @@
+import math
+import time
+
+
+__all__ = ['RateMeter']
+
+
+class RateMeter:
+    """Exponentially weighted moving average of a transfer rate.
+
+    add() only accumulates the amount of data, the average is recalculated when update() is called
+    (periodically, with a time taken from a monotonic clock), so transferring a block doesn't require
+    to query the clock.
+    """
+
+    __slots__ = ('_time_constant', '_pending', '_rate', '_weight', '_last_update', '_last_active')
+
+    DEFAULT_TIME_CONSTANT = 20
+
+    def __init__(self, time_constant: float=DEFAULT_TIME_CONSTANT, now: float=None):
+        self._time_constant = time_constant
+        self._pending = 0
+        self._rate = 0.0
+        # The average starts from zero, so it's underestimated until enough time passes. The weight of the data
+        # included into the average is tracked to compensate for that.
+        self._weight = 0.0
+        self._last_update = now if now is not None else time.monotonic()
+        self._last_active = None  # type: Optional[float]
+
+    def add(self, size: int):
+        self._pending += size
+
+    def update(self, now: float):
+        elapsed = now - self._last_update
+        if elapsed <= 0:
+            return
+
+        alpha = 1 - math.exp(-elapsed / self._time_constant)
+        self._rate += alpha * (self._pending / elapsed - self._rate)
+        self._weight += alpha * (1 - self._weight)
+        if self._pending:
+            self._last_active = now
+        self._pending = 0
+        self._last_update = now
+
+    @property
+    def rate(self) -> float:
+        """Average rate (in bytes per second) as of the last update."""
+        return self._rate / self._weight if self._weight else 0.0
+
+    @property
+    def measured(self) -> bool:
+        return self._weight > 0
+
+    def is_active(self, now: float, period: float) -> bool:
+        """Returns whether any data was added during the last `period` seconds (with the precision of updates)."""
+        return self._last_active is not None and now - self._last_active <= period
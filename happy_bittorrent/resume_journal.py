@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import struct
+from typing import Awaitable, Optional
+
+from bitarray import bitarray
+
+from happy_bittorrent.disk_io import DiskIOEngine
+
+
+__all__ = ['ResumeJournal']
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class ResumeJournal:
+    """Append-only file with resume data of a torrent.
+
+    The file starts with a header and a bitmap of downloaded pieces. It's followed by records about pieces
+    that were downloaded (or invalidated) after the bitmap was written. Records are written in batches with
+    a single fdatasync() call. Compaction folds the records into a new bitmap.
+    """
+
+    MAGIC = b'HBRJ'
+    VERSION = 1
+    HEADER_FMT = '!4sBI'  # Magic, version, piece count
+    HEADER_LEN = struct.calcsize(HEADER_FMT)
+    RECORD_FMT = '!I'
+    RECORD_LEN = struct.calcsize(RECORD_FMT)
+    INVALIDATED_FLAG = 1 << 31
+
+    SYNC_DELAY = 1
+    COMPACTION_RATIO = 2  # Compact when records take more space than the bitmap multiplied by this ratio
+
+    def __init__(self, path: str, piece_count: int):
+        self._path = path
+        self._piece_count = piece_count
+        self._bitmap_len = (piece_count + 7) // 8
+
+        self._io_engine = DiskIOEngine.get_instance()
+        self._fd = None  # type: Optional[int]
+        self._record_count = 0
+        self._pending = []  # type: List[Tuple[int, bytes]]
+        self._appended_count = 0
+        # Records written to the current file while a compaction is waiting. They may be absent in its bitmap.
+        self._written = []  # type: List[Tuple[int, bytes]]
+        self._compactions_waiting = 0
+        self._write_lock = asyncio.Lock()
+        self._sync_handle = None  # type: Optional[asyncio.Handle]
+        self._removed = False
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def load(self) -> Optional[bitarray]:
+        """Returns the bitmap of downloaded pieces or None if the file doesn't exist or is corrupted."""
+
+        try:
+            with open(self._path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        if len(data) < ResumeJournal.HEADER_LEN + self._bitmap_len:
+            return None
+        magic, version, piece_count = struct.unpack_from(ResumeJournal.HEADER_FMT, data)
+        if magic != ResumeJournal.MAGIC or version != ResumeJournal.VERSION or piece_count != self._piece_count:
+            return None
+
+        bitmap_end = ResumeJournal.HEADER_LEN + self._bitmap_len
+        result = bitarray(endian='big')
+        result.frombytes(data[ResumeJournal.HEADER_LEN:bitmap_end])
+        del result[self._piece_count:]
+
+        # A record could be written partially in case of a crash, such a record is ignored
+        record_data = memoryview(data)[bitmap_end:]
+        self._record_count = len(record_data) // ResumeJournal.RECORD_LEN
+        for (record,) in struct.iter_unpack(ResumeJournal.RECORD_FMT,
+                                            record_data[:self._record_count * ResumeJournal.RECORD_LEN]):
+            index = record & ~ResumeJournal.INVALIDATED_FLAG
+            if index < self._piece_count:
+                result[index] = not record & ResumeJournal.INVALIDATED_FLAG
+        return result
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self._record_count * ResumeJournal.RECORD_LEN > self._bitmap_len * ResumeJournal.COMPACTION_RATIO
+
+    def _write_snapshot(self, data: bytes):
+        temp_path = self._path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            ResumeJournal._write_fully(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_path, self._path)
+
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+
+    def compact(self, downloaded: bitarray) -> Awaitable[None]:
+        """Rewrites the file with the given bitmap. Records appended before the call are considered to be
+        included in it, so the bitmap must be taken right before calling the method."""
+
+        assert len(downloaded) == self._piece_count
+
+        data = struct.pack(ResumeJournal.HEADER_FMT, ResumeJournal.MAGIC, ResumeJournal.VERSION,
+                           self._piece_count) + downloaded.tobytes()
+        # The count is taken synchronously, so records appended before the coroutine starts aren't lost
+        self._compactions_waiting += 1
+        return self._compact(data, self._appended_count)
+
+    async def _compact(self, data: bytes, covered_count: int):
+        try:
+            async with self._write_lock:
+                if self._removed:
+                    return
+                # Records that are already written to the old file but missing in the bitmap are written again
+                self._pending = [item for item in self._written + self._pending if item[0] >= covered_count]
+                self._written = []
+
+                await self._io_engine.submit(self._write_snapshot, data)
+                self._record_count = 0
+                if self._pending:
+                    self._schedule_sync()
+        finally:
+            self._compactions_waiting -= 1
+
+    def start_compaction(self, downloaded: bitarray):
+        asyncio.ensure_future(self.compact(downloaded)).add_done_callback(self._check_write_result)
+
+    def append(self, piece_index: int, downloaded: bool=True):
+        if self._removed:
+            return
+        record = piece_index if downloaded else piece_index | ResumeJournal.INVALIDATED_FLAG
+        self._pending.append((self._appended_count, struct.pack(ResumeJournal.RECORD_FMT, record)))
+        self._appended_count += 1
+        self._schedule_sync()
+
+    def _schedule_sync(self):
+        if self._sync_handle is None:
+            self._sync_handle = asyncio.get_event_loop().call_later(ResumeJournal.SYNC_DELAY, self._start_sync)
+
+    def _cancel_sync(self):
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+
+    def _start_sync(self):
+        self._sync_handle = None
+        asyncio.ensure_future(self.sync()).add_done_callback(self._check_write_result)
+
+    def _check_write_result(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning('failed to write resume data to %s: %r', self._path, task.exception())
+
+    @staticmethod
+    def _write_fully(fd: int, data: bytes):
+        data = memoryview(data)
+        while data:
+            written_count = os.write(fd, data)
+            data = data[written_count:]
+
+    def _write_records(self, data: bytes):
+        size = os.fstat(self._fd).st_size
+        try:
+            ResumeJournal._write_fully(self._fd, data)
+        except OSError:
+            # Records stay pending, so a partially written batch is removed to keep the following ones aligned
+            os.ftruncate(self._fd, size)
+            raise
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(self._fd)
+        else:
+            os.fsync(self._fd)
+
+    async def sync(self):
+        async with self._write_lock:
+            self._cancel_sync()
+            if self._removed or not self._pending:
+                return
+            if self._fd is None:
+                raise RuntimeError("Journal file isn't opened (compact() must be called first)")
+
+            # Records are removed from the queue only when they're written, so they're retried after a failure.
+            # Records appended during the writing stay in the queue.
+            count = len(self._pending)
+            await self._io_engine.submit(self._write_records, b''.join(data for _, data in self._pending[:count]))
+            records = self._pending[:count]
+            del self._pending[:count]
+            self._record_count += len(records)
+            if self._compactions_waiting:
+                self._written += records
+
+    async def close(self):
+        await self.sync()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    async def remove(self):
+        self._removed = True
+        async with self._write_lock:
+            self._cancel_sync()
+            self._pending = []
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
@@ -19,7 +19,6 @@ setup(
     platforms='any',
     install_requires=[
         'aiohttp>=2.0.7',
-        'bencodepy>=0.9.5',
         'bitarray>=0.8.1'
     ],
     classifiers=[
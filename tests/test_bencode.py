@@ -0,0 +1,161 @@
+import hashlib
+import os
+import pickle
+
+import pytest
+
+from happy_bittorrent import bencode
+from happy_bittorrent.bencode import DecodingError
+from happy_bittorrent.models import DownloadInfo, RawFileList, TorrentInfo
+
+
+@pytest.mark.parametrize('data, expected', [
+    (b'i0e', 0),
+    (b'i42e', 42),
+    (b'i-42e', -42),
+    (b'0:', b''),
+    (b'4:spam', b'spam'),
+    (b'le', []),
+    (b'l4:spami42ee', [b'spam', 42]),
+    (b'de', {}),
+    (b'd3:cow3:moo4:spaml1:a1:bee', {b'cow': b'moo', b'spam': [b'a', b'b']}),
+    (b'd1:ad1:bli1ei2eeee', {b'a': {b'b': [1, 2]}}),
+])
+def test_decode(data, expected):
+    assert bencode.decode(data) == expected
+    assert bencode.skip_value(data, 0) == (None, len(data))
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'i42',
+    b'ie',
+    b'i03e',
+    b'i-0e',
+    b'i+3e',
+    b'i1_0e',
+    b'i 1e',
+    b'i-e',
+    b'5:spam',
+    b'+1:a',
+    b'l4:spam',
+    b'x',
+])
+def test_invalid_data(data):
+    with pytest.raises(DecodingError):
+        bencode.decode(data)
+    with pytest.raises(DecodingError):
+        bencode.skip_value(data, 0)
+
+
+@pytest.mark.parametrize('data', [
+    b'd4:spame',
+    b'di1ei2ee',
+    b'i1ei2e',
+])
+def test_invalid_structure(data):
+    # skip_value() only finds the end of a value, so these errors are detected only when the value is decoded
+    with pytest.raises(DecodingError):
+        bencode.decode(data)
+
+
+def test_too_deep_nesting():
+    with pytest.raises(DecodingError):
+        bencode.decode(b'l' * 100000 + b'e' * 100000)
+
+
+@pytest.mark.parametrize('value', [
+    0, -7, 2 ** 70, b'', b'\x00\xff', [], [1, [b'x', []]], {b'a': 1, b'b': {b'c': [b'd']}},
+])
+def test_encode_round_trip(value):
+    assert bencode.decode(bencode.encode(value)) == value
+
+
+def test_encode_sorts_keys():
+    assert bencode.encode({'b': 1, b'a': 'x'}) == b'd1:a1:x1:bi1ee'
+    with pytest.raises(TypeError):
+        bencode.encode(1.5)
+
+
+def test_values_end_inside_document():
+    data = b'xxl4:spamd1:ai-1eeei7e'
+    value, end = bencode.decode_value(data, 2)
+    assert value == [b'spam', {b'a': -1}]
+    assert data[end:] == b'i7e'
+    assert bencode.skip_value(data, 2) == (None, end)
+    assert bencode.decode_list(data, 2) == (value, end)
+
+
+def test_decode_dict_with_parsers():
+    data = b'd5:emptyle6:lengthi5e4:listli1ei2ee6:pieces4:abcde'
+    parsers = {b'list': bencode.skip_value, b'pieces': bencode.decode_string_view}
+    dictionary, end = bencode.decode_dict(data, 0, parsers)
+    assert end == len(data)
+    assert dictionary[b'empty'] == []
+    assert dictionary[b'length'] == 5
+    assert dictionary[b'list'] is None
+
+    view = dictionary[b'pieces']
+    assert isinstance(view, memoryview) and view.obj is data
+    assert view == b'abcd'
+
+    with pytest.raises(DecodingError):
+        bencode.decode_dict(b'li1ee', 0, {})
+    with pytest.raises(DecodingError):
+        bencode.decode_dict(b'di1ei2ee', 0, {})
+    with pytest.raises(DecodingError):
+        bencode.decode_string_view(b'i1e', 0)
+
+
+PIECE_LENGTH = 2 ** 14
+
+
+def make_info_dict(files) -> bytes:
+    # Keys are deliberately unsorted, so encoding the decoded dictionary again gives different bytes
+    total_size = sum(length for _, length in files)
+    piece_count = (total_size + PIECE_LENGTH - 1) // PIECE_LENGTH
+    file_list = b''.join(b'd4:pathl' + b''.join(bencode.encode(elem) for elem in path) + b'e6:lengthi%dee' % length
+                         for path, length in files)
+    return (b'd4:name4:test6:pieces' + bencode.encode(os.urandom(20 * piece_count)) +
+            b'5:filesl' + file_list + b'e12:piece lengthi%de' % PIECE_LENGTH + b'7:privatei1ee')
+
+
+def test_info_hash_uses_original_bytes():
+    info_dict = make_info_dict([(['a', 'b'], 3 * PIECE_LENGTH), (['c'], 100)])
+    assert bencode.encode(bencode.decode(info_dict)) != info_dict
+
+    data = b'xx' + info_dict + b'yy'
+    info, end = DownloadInfo.parse(data, 2)
+    assert end == len(data) - 2
+    assert info.info_hash == hashlib.sha1(info_dict).digest()
+    assert info.suggested_name == 'test'
+    assert info.private
+    assert info.piece_count == 4
+    assert info.total_size == 3 * PIECE_LENGTH + 100
+
+
+def test_torrent_file(tmpdir):
+    info_dict = make_info_dict([(['a'], PIECE_LENGTH + 1)])
+    path = tmpdir.join('test.torrent')
+    path.write_binary(b'd8:announce19:http://example.com/4:info' + info_dict + b'e')
+
+    torrent_info = TorrentInfo.from_file(str(path), download_dir=str(tmpdir))
+    assert torrent_info.announce_list == [['http://example.com/']]
+    assert torrent_info.download_info.info_hash == hashlib.sha1(info_dict).digest()
+
+
+def test_raw_file_list():
+    files = [(['dir', 'a'], 10), (['b'], 0), (['c'], 2 ** 40)]
+    data = b'xx' + bencode.encode([{'path': path, 'length': length} for path, length in files])
+    file_list, end = RawFileList.parse(data, 2)
+    assert end == len(data)
+    assert file_list.count == 3
+    assert file_list.total_size == 10 + 2 ** 40
+
+    for restored in (file_list, pickle.loads(pickle.dumps(file_list))):
+        assert [(info.path, info.length) for info in restored.decode()] == files
+
+    with pytest.raises(ValueError):
+        RawFileList.parse(bencode.encode([{'path': ['a'], 'length': -1}]), 0)
+    with pytest.raises(ValueError):
+        RawFileList.parse(bencode.encode([{'path': ['a']}]), 0)
@@ -0,0 +1,68 @@
+import os
+
+from conftest import run
+from happy_bittorrent.file_structure import FileStructure
+from happy_bittorrent.models import DownloadInfo, FileInfo
+
+
+PIECE_LENGTH = 2 ** 14
+
+
+def make_download_info() -> DownloadInfo:
+    # Pieces 1 and 4 straddle boundaries of the files, pieces 2 and 3 lie only in the file "b"
+    files = [FileInfo(PIECE_LENGTH * 3 // 2, ['a']), FileInfo(3 * PIECE_LENGTH, ['b']),
+             FileInfo(PIECE_LENGTH * 3 // 2, ['c'])]
+    info = DownloadInfo(os.urandom(20), PIECE_LENGTH, os.urandom(20) * 6, 'name', files)
+    info.reset_run_state()
+    return info
+
+
+def write_and_read_pieces(tmp_path, select_before, select_after):
+    async def test():
+        info = make_download_info()
+        if select_before is not None:
+            info.select_files(*select_before)
+        file_structure = FileStructure(str(tmp_path), info)
+        info.select_files(*select_after)
+
+        data = os.urandom(info.total_size)
+        pieces = [index for index in range(info.piece_count) if info.pieces[index].selected]
+        for index in pieces:
+            await file_structure.write(index * PIECE_LENGTH, memoryview(data)[index * PIECE_LENGTH:
+                                                                              (index + 1) * PIECE_LENGTH])
+        for index in pieces:
+            expected = data[index * PIECE_LENGTH:(index + 1) * PIECE_LENGTH]
+            assert bytes(await file_structure.read_piece(index)) == expected
+        file_structure.close()
+        return pieces
+
+    return run(test())
+
+
+def test_file_deselected_after_creation(tmp_path):
+    pieces = write_and_read_pieces(tmp_path, None, ([['b']], 'blacklist'))
+    assert pieces == [0, 1, 4, 5]
+
+
+def test_file_selected_after_creation(tmp_path):
+    pieces = write_and_read_pieces(tmp_path, ([['b']], 'blacklist'), ([['b']], 'whitelist'))
+    assert pieces == [1, 2, 3, 4]
+    assert os.path.isfile(os.path.join(str(tmp_path), 'name', 'b'))
+
+
+def test_selection_toggled_with_written_pieces(tmp_path):
+    async def test():
+        info = make_download_info()
+        info.select_files([['b']], 'blacklist')
+        file_structure = FileStructure(str(tmp_path), info)
+
+        data = os.urandom(info.total_size)
+        await file_structure.write(0, memoryview(data))
+        info.select_files([['a']], 'blacklist')
+        for index in range(info.piece_count):
+            if index not in (2, 3):  # These pieces lie only in the file "b", which wasn't selected
+                expected = data[index * PIECE_LENGTH:(index + 1) * PIECE_LENGTH]
+                assert bytes(await file_structure.read_piece(index)) == expected
+        file_structure.close()
+
+    run(test())
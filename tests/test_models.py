@@ -0,0 +1,58 @@
+import os
+import pickle
+
+from bitarray import bitarray
+
+from happy_bittorrent.models import AllocationPolicy, BlockRequest, DownloadInfo, FileInfo, Peer, TorrentInfo
+
+
+PIECE_LENGTH = 2 ** 16
+
+
+def make_download_info() -> DownloadInfo:
+    files = [FileInfo(2 * PIECE_LENGTH, ['a']), FileInfo(2 * PIECE_LENGTH, ['b'])]
+    info = DownloadInfo(os.urandom(20), PIECE_LENGTH, os.urandom(20) * 4, 'name', files)
+    info.reset_run_state()
+    return info
+
+
+def test_state_round_trip():
+    info = make_download_info()
+    info.pieces[1].mark_downloaded_blocks(Peer('10.0.0.1', 6881), BlockRequest(1, 0, 2 ** 14))
+    info.pieces[2].mark_as_downloaded()
+    info.set_file_priority([['b']], 1)
+    info.select_files([['a']], 'blacklist')
+    info.add_selection_listener(lambda: None)
+
+    restored = pickle.loads(pickle.dumps(info))
+    assert restored.info_hash == info.info_hash
+    assert restored.pieces.piece_hashes == info.pieces.piece_hashes
+    assert restored.get_downloaded_bitmap() == bitarray('0010')
+    assert restored.pieces.selected_bitmap == bitarray('0011')
+    assert [item.priority for item in restored.files] == [0, 1]
+    assert restored.selected_file_count == 1
+
+    # Blocks of partially downloaded pieces aren't downloaded again after a restart
+    assert restored.pieces[1].are_any_blocks_downloaded()
+    assert not restored.pieces[1].are_all_blocks_downloaded()
+    assert not restored.pieces[0].are_any_blocks_downloaded()
+
+    restored.set_downloaded_pieces(bitarray('0110'))
+    assert restored.pieces[1].downloaded
+    assert restored.pieces.get_progress(1, False) is None
+
+
+def test_state_of_older_versions():
+    # Objects pickled by older versions lack the fields added later
+    file_info = FileInfo.__new__(FileInfo)
+    file_info.__setstate__({'_length': 10, '_path': ['a'], '_md5sum': None, 'offset': 0, 'selected': True})
+    assert file_info.priority == 0
+
+    torrent_info = TorrentInfo(make_download_info(), [['http://example.com/']], download_dir='/tmp')
+    state = torrent_info.__getstate__()
+    del state['allocation_policy']
+    del state['checking_progress']
+    restored = TorrentInfo.__new__(TorrentInfo)
+    restored.__setstate__(state)
+    assert restored.allocation_policy == AllocationPolicy.sparse
+    assert restored.checking_progress is None
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import socket
+import struct
+
+from conftest import run
+from happy_bittorrent.disk_io import FileDescriptorCache
+from happy_bittorrent.file_structure import FileStructure
+from happy_bittorrent.models import DownloadInfo, FileInfo
+from happy_bittorrent.network.peer_wire_protocol import PeerWireProtocol
+
+
+PIECE_LENGTH = 2 ** 15
+BLOCK_LENGTH = 2 ** 14
+
+
+def test_send_file_messages(tmp_path):
+    async def test():
+        # The last file isn't created, so its data is sent as zeros
+        files = [FileInfo(1000, ['a']), FileInfo(3 * PIECE_LENGTH, ['b']), FileInfo(3000, ['c'])]
+        info = DownloadInfo(os.urandom(20), PIECE_LENGTH, os.urandom(20) * 4, 'name', files)
+        data = os.urandom(info.total_size - 3000)
+        file_structure = FileStructure(str(tmp_path), info)
+        await file_structure.write(0, memoryview(data))
+        data += bytes(3000)
+
+        loop = asyncio.get_event_loop()
+        sock, peer_sock = socket.socketpair()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        _, protocol = await loop.create_connection(PeerWireProtocol, sock=sock)
+        assert protocol.files_sendable
+        reader, writer = await asyncio.open_connection(sock=peer_sock)
+
+        expected = []
+        for offset in range(0, info.total_size, BLOCK_LENGTH):
+            piece_index, block_begin = divmod(offset, PIECE_LENGTH)
+            length = min(BLOCK_LENGTH, info.total_size - offset)
+            header = struct.pack('!IB2I', length + 9, 7, piece_index, block_begin)
+            protocol.send_file(header, await file_structure.open_block(piece_index, block_begin, length))
+            expected.append(header + data[offset:offset + length])
+
+            # Control messages may overtake file messages, but can't be written in the middle of them
+            control_message = struct.pack('!IBI', 5, 4, piece_index)
+            protocol.send((control_message,))
+            expected.append(control_message)
+        await protocol.drain()
+
+        received = await reader.readexactly(sum(len(message) for message in expected))
+        messages = []
+        while received:
+            (length,) = struct.unpack_from('!I', received)
+            messages.append(received[:4 + length])
+            received = received[4 + length:]
+        assert sorted(messages) == sorted(expected)
+        assert [message for message in messages if message[4] == 7] == \
+            [message for message in expected if message[4] == 7]
+
+        protocol.close()
+        writer.close()
+        await asyncio.sleep(0)
+        file_structure.close()
+        assert not FileDescriptorCache.get_instance().open_file_count
+
+    run(test())
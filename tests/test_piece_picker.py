@@ -0,0 +1,169 @@
+import os
+import random
+
+from bitarray import bitarray
+
+from happy_bittorrent.algorithms.piece_picker import PiecePicker
+from happy_bittorrent.models import DownloadInfo, FileInfo, Peer
+
+
+PIECE_LENGTH = 2 ** 14
+PIECE_COUNT = 300
+
+
+def make_download_info() -> DownloadInfo:
+    # Pieces 0-99 belong to the first file, pieces 100-299 belong to the second one
+    files = [FileInfo(100 * PIECE_LENGTH, ['a']), FileInfo(200 * PIECE_LENGTH, ['b'])]
+    info = DownloadInfo(os.urandom(20), PIECE_LENGTH, os.urandom(20) * PIECE_COUNT, 'name', files)
+    info.reset_run_state()
+    return info
+
+
+def make_bitmap(indexes=()) -> bitarray:
+    result = bitarray(PIECE_COUNT, endian='big')
+    result.setall(False)
+    for index in indexes:
+        result[index] = True
+    return result
+
+
+def random_bitmap(rng: random.Random) -> bitarray:
+    return make_bitmap(rng.sample(range(PIECE_COUNT), rng.randrange(PIECE_COUNT)))
+
+
+def check_buckets(picker: PiecePicker, info: DownloadInfo, started: set):
+    counts = info.availability.counts
+    expected_pending = info.pieces.get_non_finished_bitmap() & ~make_bitmap(started)
+    assert picker._pending == expected_pending
+    assert picker.pending_count == expected_pending.count()
+
+    for count, bucket in picker._buckets.items():
+        assert not (bucket & ~expected_pending).any()
+        for index in bucket.search(bitarray('1')):
+            assert counts[index] == count
+    for index in expected_pending.search(bitarray('1')):
+        assert picker._buckets[counts[index]][index]
+
+
+def test_buckets_stay_consistent():
+    rng = random.Random(1)
+    info = make_download_info()
+    availability = info.availability
+    peers = [Peer('10.0.0.{}'.format(i), 6881) for i in range(10)]
+    connected = []
+    picker = PiecePicker(info)
+    started = set()
+
+    for _ in range(2000):
+        action = rng.randrange(7)
+        if action == 0 and len(connected) < len(peers):
+            peer = rng.choice([peer for peer in peers if peer not in connected])
+            availability.add_peer(peer)
+            connected.append(peer)
+        elif not connected:
+            continue
+        elif action == 1:
+            availability.add_pieces(rng.choice(connected), random_bitmap(rng))
+        elif action == 2:
+            availability.add_piece(rng.choice(connected), rng.randrange(PIECE_COUNT))
+        elif action == 3:
+            availability.add_all_pieces(rng.choice(connected))
+        elif action == 4:
+            peer = rng.choice(connected)
+            availability.remove_peer(peer)
+            connected.remove(peer)
+        elif action == 5:
+            index = picker.pick(rng.sample(connected, min(3, len(connected))))
+            if index is not None:
+                assert index not in started
+                started.add(index)
+        elif action == 6 and started:
+            index = rng.choice(sorted(started))
+            started.remove(index)
+            info.pieces[index].mark_as_downloaded()
+            picker.finish(index)
+        check_buckets(picker, info, started)
+
+    picker.close()
+
+
+def test_rarest_piece_is_picked():
+    info = make_download_info()
+    availability = info.availability
+    peers = [Peer('10.0.0.{}'.format(i), 6881) for i in range(3)]
+    for peer in peers:
+        availability.add_peer(peer)
+        availability.add_pieces(peer, make_bitmap(range(10)))
+    availability.add_pieces(peers[0], make_bitmap([42]))
+    availability.add_pieces(peers[1], make_bitmap([42, 43]))
+
+    picker = PiecePicker(info)
+    assert picker.pick(peers) == 43
+    assert picker.pick(peers) == 42
+    assert picker.pick([peers[2]]) in range(10)
+    assert picker.in_progress_count == 3
+
+
+def test_higher_priority_is_picked_first():
+    info = make_download_info()
+    peer = Peer('10.0.0.1', 6881)
+    info.availability.add_peer(peer)
+    info.availability.add_pieces(peer, make_bitmap([5, 150]))
+
+    info.set_file_priority([['b']], 1)
+    picker = PiecePicker(info)
+    assert picker.pick([peer]) == 150
+    assert picker.pick([peer]) == 5
+
+
+def test_selection_change_is_applied():
+    info = make_download_info()
+    peer = Peer('10.0.0.1', 6881)
+    info.availability.add_peer(peer)
+    info.availability.add_all_pieces(peer)
+
+    picker = PiecePicker(info)
+    started = picker.pick([peer])
+    assert started is not None
+
+    info.select_files([['b']], 'whitelist')
+    expected = make_bitmap(range(100, PIECE_COUNT))
+    expected[started] = False
+    assert picker._pending == expected
+    assert picker.pending_count == expected.count()
+
+    info.set_file_priority([['a']], 1)
+    assert picker.pick([peer]) in range(100, PIECE_COUNT)
+
+    picker.close()
+    pending = picker.get_pending_pieces()
+    info.select_files([['a']], 'whitelist')
+    assert picker.get_pending_pieces() == pending  # The picker doesn't listen to changes after close()
+
+
+def test_extra_candidates_and_preferred():
+    info = make_download_info()
+    peer = Peer('10.0.0.1', 6881)
+    info.availability.add_peer(peer)
+    info.availability.add_pieces(peer, make_bitmap([1, 2, 3]))
+
+    picker = PiecePicker(info)
+    assert picker.pick([], extra_candidates=make_bitmap([7])) == 7
+    assert picker.pick([peer], preferred=make_bitmap([3])) == 3
+    assert picker.pick([], extra_candidates=make_bitmap([7])) is None
+
+
+def test_pieces_in_progress_are_limited():
+    info = make_download_info()
+    peer = Peer('10.0.0.1', 6881)
+    info.availability.add_peer(peer)
+    info.availability.add_all_pieces(peer)
+
+    picker = PiecePicker(info)
+    picked = [picker.pick([peer]) for _ in range(PiecePicker.MAX_PIECES_IN_PROGRESS)]
+    assert None not in picked and len(set(picked)) == len(picked)
+    assert picker.pick([peer]) is None
+
+    info.pieces[picked[0]].mark_as_downloaded()
+    picker.finish(picked[0])
+    assert picker.pick([peer]) is not None
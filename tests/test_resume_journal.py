@@ -0,0 +1,199 @@
+import asyncio
+import os
+
+import pytest
+
+from bitarray import bitarray
+
+from conftest import run
+from happy_bittorrent.resume_journal import ResumeJournal
+
+
+PIECE_COUNT = 20
+
+
+def make_bitmap(indexes=()) -> bitarray:
+    result = bitarray(PIECE_COUNT, endian='big')
+    result.setall(False)
+    for index in indexes:
+        result[index] = True
+    return result
+
+
+def load(path: str, piece_count: int=PIECE_COUNT):
+    return ResumeJournal(path, piece_count).load()
+
+
+def test_missing_file(tmpdir):
+    assert load(str(tmpdir.join('journal'))) is None
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('journal'))
+
+    async def write():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap([0, 5]))
+        journal.append(7)
+        journal.append(19)
+        journal.append(5, downloaded=False)
+        await journal.close()
+
+    run(write())
+    assert load(path) == make_bitmap([0, 7, 19])
+
+
+def test_records_are_batched(tmpdir):
+    path = str(tmpdir.join('journal'))
+
+    async def write():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap())
+        size = os.path.getsize(path)
+        for index in range(3):
+            journal.append(index)
+        assert os.path.getsize(path) == size  # Nothing is written until the delayed sync
+
+        await asyncio.sleep(ResumeJournal.SYNC_DELAY + 0.5)
+        assert os.path.getsize(path) == size + 3 * ResumeJournal.RECORD_LEN
+        await journal.close()
+
+    run(write())
+    assert load(path) == make_bitmap([0, 1, 2])
+
+
+def test_torn_record_is_ignored(tmpdir):
+    path = str(tmpdir.join('journal'))
+
+    async def write():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap([1]))
+        journal.append(2)
+        await journal.close()
+
+    run(write())
+    with open(path, 'ab') as f:
+        f.write(b'\0\0')  # A part of a record for piece 3
+    assert load(path) == make_bitmap([1, 2])
+
+
+def test_failed_write_is_retried(tmpdir, monkeypatch):
+    path = str(tmpdir.join('journal'))
+    write = os.write
+    failures = [OSError(28, 'No space left on device')]
+
+    def write_partially(fd: int, data: bytes) -> int:
+        # Every call writes a single byte, the second call fails once
+        if len(data) == 3 * ResumeJournal.RECORD_LEN - 1 and failures:
+            raise failures.pop()
+        return write(fd, data[:1])
+
+    async def test():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap([0]))
+        size = os.path.getsize(path)
+        monkeypatch.setattr(os, 'write', write_partially)
+        for index in range(1, 4):
+            journal.append(index)
+        with pytest.raises(OSError):
+            await journal.sync()
+        assert os.path.getsize(path) == size  # The written byte is removed
+
+        journal.append(4)
+        await journal.close()
+        monkeypatch.undo()
+
+    run(test())
+    assert load(path) == make_bitmap([0, 1, 2, 3, 4])
+
+
+def test_header_mismatch(tmpdir):
+    path = str(tmpdir.join('journal'))
+
+    async def write():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap([1]))
+        await journal.close()
+
+    run(write())
+    assert load(path, PIECE_COUNT + 1) is None
+
+    with open(path, 'r+b') as f:
+        f.write(b'XXXX')
+    assert load(path) is None
+
+
+def test_compaction_folds_records(tmpdir):
+    path = str(tmpdir.join('journal'))
+
+    async def write():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap())
+        downloaded = make_bitmap()
+        for index in range(PIECE_COUNT):
+            journal.append(index)
+            downloaded[index] = True
+        await journal.sync()
+        assert journal.needs_compaction
+
+        await journal.compact(downloaded)
+        assert not journal.needs_compaction
+        assert os.path.getsize(path) == ResumeJournal.HEADER_LEN + len(downloaded.tobytes())
+        await journal.close()
+
+    run(write())
+    assert load(path).all()
+
+
+def test_record_appended_after_compaction_start(tmpdir):
+    # The bitmap doesn't include the piece, so its record must survive the compaction
+    path = str(tmpdir.join('journal'))
+
+    async def write():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap())
+        journal.start_compaction(make_bitmap())
+        journal.append(3)
+        await asyncio.sleep(0.1)
+        await journal.close()
+
+    run(write())
+    assert load(path) == make_bitmap([3])
+
+
+def test_record_synced_before_compaction_runs(tmpdir):
+    # A sync waiting for the lock before the compaction writes the record into the file being replaced
+    path = str(tmpdir.join('journal'))
+
+    async def write():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap())
+        journal.append(1)
+        first_sync = asyncio.ensure_future(journal.sync())
+        await asyncio.sleep(0)
+        second_sync = asyncio.ensure_future(journal.sync())
+        await asyncio.sleep(0)
+
+        journal.start_compaction(make_bitmap([1]))
+        journal.append(2)
+        await asyncio.gather(first_sync, second_sync)
+        await asyncio.sleep(0.1)
+        await journal.close()
+
+    run(write())
+    assert load(path) == make_bitmap([1, 2])
+
+
+def test_remove(tmpdir):
+    path = str(tmpdir.join('journal'))
+
+    async def write():
+        journal = ResumeJournal(path, PIECE_COUNT)
+        await journal.compact(make_bitmap())
+        journal.append(1)
+        await journal.remove()
+        journal.append(2)
+        await journal.close()
+
+    run(write())
+    assert not os.path.exists(path)
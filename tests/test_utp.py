@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import os
+import random
+
+import pytest
+
+from conftest import run
+from happy_bittorrent.network.utp import PacketType, UTPConnection, UTPSocket
+
+
+class ReceivingProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.transport = None
+        self.hash = hashlib.sha1()
+        self.received = 0
+        self.eof = False
+        self.lost = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self.hash.update(data)
+        self.received += len(data)
+
+    def eof_received(self):
+        self.eof = True
+        return False
+
+    def connection_lost(self, exc):
+        self.lost.set_result(exc)
+
+
+class SendingProtocol(ReceivingProtocol):
+    def __init__(self):
+        super().__init__()
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+
+async def open_pair():
+    server_protocols = []
+
+    def factory():
+        protocol = ReceivingProtocol()
+        server_protocols.append(protocol)
+        return protocol
+
+    server = await UTPSocket.create(0, factory)
+    client = await UTPSocket.create(0)
+    port = server.get_extra_info('sockname')[1]
+    transport, protocol = await asyncio.wait_for(client.create_connection(SendingProtocol, '127.0.0.1', port), 10)
+    await asyncio.sleep(0.1)  # The server creates its protocol when the first packet from the client arrives
+    assert len(server_protocols) == 1
+    return server, client, transport, protocol, server_protocols[0]
+
+
+async def send_and_close(size: int):
+    server, client, transport, protocol, server_protocol = await open_pair()
+    data = os.urandom(size)
+    chunk_size = 2 ** 16
+    for begin in range(0, size, chunk_size):
+        await protocol.can_write.wait()
+        transport.write(data[begin:begin + chunk_size])
+    transport.close()
+
+    assert await asyncio.wait_for(server_protocol.lost, 30) is None
+    assert server_protocol.eof
+    assert server_protocol.received == size
+    assert server_protocol.hash.digest() == hashlib.sha1(data).digest()
+    assert await asyncio.wait_for(protocol.lost, 10) is None
+
+    await asyncio.sleep(0.1)
+    assert not server._connections and not client._connections
+    server.close()
+    client.close()
+
+
+def test_transfer():
+    run(send_and_close(2 ** 20))
+
+
+@pytest.mark.parametrize('loss_rate, reorder_rate', [(0.05, 0), (0, 0.1), (0.03, 0.05)])
+def test_transfer_with_loss(monkeypatch, loss_rate, reorder_rate):
+    rng = random.Random(1)
+    send_datagram = UTPSocket.send_datagram
+
+    def unreliable_send_datagram(self, data, address):
+        value = rng.random()
+        if value < loss_rate:
+            return
+        if value < loss_rate + reorder_rate:
+            asyncio.get_event_loop().call_later(0.005, send_datagram, self, data, address)
+            return
+        send_datagram(self, data, address)
+
+    monkeypatch.setattr(UTPSocket, 'send_datagram', unreliable_send_datagram)
+    run(send_and_close(2 ** 18))
+
+
+def test_server_closes_first():
+    async def test():
+        server, client, transport, protocol, server_protocol = await open_pair()
+        # The accepting side can send data only after the initiator sent something
+        transport.write(b'request')
+        await asyncio.sleep(0.1)
+        assert server_protocol.received == len(b'request')
+        server_protocol.transport.write(b'reply')
+        server_protocol.transport.close()
+
+        assert await asyncio.wait_for(protocol.lost, 10) is None
+        assert protocol.eof
+        assert protocol.received == len(b'reply')
+        assert await asyncio.wait_for(server_protocol.lost, 10) is None
+        server.close()
+        client.close()
+
+    run(test())
+
+
+def test_abort():
+    async def test():
+        server, client, transport, protocol, server_protocol = await open_pair()
+        transport.abort()
+
+        assert await asyncio.wait_for(protocol.lost, 10) is None
+        assert await asyncio.wait_for(server_protocol.lost, 10) is not None
+        assert not server_protocol.eof
+        server.close()
+        client.close()
+
+    run(test())
+
+
+def test_connection_timeout(monkeypatch):
+    monkeypatch.setattr(UTPConnection, 'INITIAL_TIMEOUT', 0.05)
+    monkeypatch.setattr(UTPConnection, 'MAX_TRANSMISSIONS', 2)
+
+    async def test():
+        server = await UTPSocket.create(0)  # Doesn't accept connections
+        client = await UTPSocket.create(0)
+        port = server.get_extra_info('sockname')[1]
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.create_connection(SendingProtocol, '127.0.0.1', port), 10)
+        assert not client._connections
+        server.close()
+        client.close()
+
+    run(test())
+
+
+def test_unsupported_addresses(monkeypatch):
+    utp_socket = UTPSocket()
+    assert utp_socket.is_supported('10.0.0.1', 6881)
+    utp_socket.mark_unsupported('10.0.0.1', 6881)
+    assert not utp_socket.is_supported('10.0.0.1', 6881)
+    assert utp_socket.is_supported('10.0.0.1', 6882)
+
+    monkeypatch.setattr(UTPSocket, 'UNSUPPORTED_ADDRESS_RETRY_INTERVAL', 0)
+    assert utp_socket.is_supported('10.0.0.1', 6881)
+    monkeypatch.undo()
+
+    monkeypatch.setattr(UTPSocket, 'MAX_UNSUPPORTED_ADDRESSES', 2)
+    for port in range(3):
+        utp_socket.mark_unsupported('10.0.0.2', port)
+    assert utp_socket.is_supported('10.0.0.2', 0)
+    assert not utp_socket.is_supported('10.0.0.2', 2)
+
+
+class FullBufferProtocol(asyncio.BufferedProtocol):
+    def __init__(self):
+        self.lost = asyncio.get_event_loop().create_future()
+
+    def get_buffer(self, sizehint: int):
+        return memoryview(bytearray())
+
+    def buffer_updated(self, nbytes: int):
+        raise AssertionError('No data can be received')
+
+    def connection_lost(self, exc):
+        self.lost.set_result(exc)
+
+
+def test_protocol_not_accepting_data():
+    async def test():
+        server_protocols = []
+
+        def factory():
+            protocol = FullBufferProtocol()
+            server_protocols.append(protocol)
+            return protocol
+
+        server = await UTPSocket.create(0, factory)
+        client = await UTPSocket.create(0)
+        port = server.get_extra_info('sockname')[1]
+        transport, protocol = await client.create_connection(SendingProtocol, '127.0.0.1', port)
+        transport.write(b'data')
+
+        assert isinstance(await asyncio.wait_for(server_protocols[0].lost, 10), RuntimeError)
+        assert isinstance(await asyncio.wait_for(protocol.lost, 10), ConnectionResetError)
+        server.close()
+        client.close()
+
+    run(test())
+
+
+def test_selective_ack_of_unknown_packets():
+    async def test():
+        server, client, transport, protocol, server_protocol = await open_pair()
+        transport.write(os.urandom(2 ** 14))
+        first_seq_nr = next(iter(transport._in_flight))
+        # The peer claims to have received only packets that were never sent
+        selective_ack = bytes([0, 0, 0, 0xFF])
+        transport.packet_received(PacketType.state, transport._ack_nr, (first_seq_nr - 1) & 0xFFFF, 0, 0,
+                                  UTPConnection.RECEIVE_WINDOW, selective_ack, b'')
+        assert first_seq_nr in transport._in_flight
+
+        transport.close()
+        assert await asyncio.wait_for(server_protocol.lost, 10) is None
+        server.close()
+        client.close()
+
+    run(test())